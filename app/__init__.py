@@ -38,6 +38,12 @@ def create_app(config_name):
     compress.init_app(app)
     RQ(app)
 
+    # Record the SQL statements each request runs, and request latencies
+    from instrumentation import instrument_requests
+    instrument_requests(app)
+    from metrics import record_request_metrics
+    record_request_metrics(app)
+
     # Register Jinja template functions
     from utils import register_template_utils
     register_template_utils(app)
@@ -71,4 +77,7 @@ def create_app(config_name):
     from admin import admin as admin_blueprint
     app.register_blueprint(admin_blueprint, url_prefix='/admin')
 
+    from api import api as api_blueprint
+    app.register_blueprint(api_blueprint, url_prefix='/api')
+
     return app
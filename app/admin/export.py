@@ -0,0 +1,122 @@
+import csv
+import json
+import zlib
+from io import BytesIO
+
+from flask import request
+
+from .. import db
+from ..api.filters import filter_dates, parse_date, parse_datetime, parse_int
+from ..models import Agency, IncidentReport, Location
+
+EXPORT_PAGE_SIZE = 1000  # reports read from the database at a time
+EXPORT_CHUNK_SIZE = 1 << 16  # bytes sent to the client at a time
+
+CSV_COLUMNS = ['DATE', 'LOCATION', 'AGENCY ID', 'VEHICLE ID', 'DURATION',
+               'LICENSE PLATE', 'DESCRIPTION', 'REPORT ID']
+
+
+def export_query():
+    """Query for the reports to export, filtered by the request's arguments:
+    start and end dates (YYYY-MM-DD, inclusive), an agency id, and for
+    incremental exports since_id (reports with greater ids) or since_date
+    (reports dated after it). Ordered by id, so that the last id exported
+    can be passed as the next since_id."""
+    query = db.session.query(
+        IncidentReport.id,
+        IncidentReport.date,
+        Location.original_user_text,
+        Agency.name,
+        IncidentReport.vehicle_id,
+        IncidentReport.duration,
+        IncidentReport.license_plate,
+        IncidentReport.description
+    ).outerjoin(IncidentReport.location).outerjoin(IncidentReport.agency)
+
+    query = filter_dates(query, parse_date('start'), parse_date('end'))
+
+    agency_id = parse_int('agency')
+    if agency_id is not None:
+        query = query.filter(IncidentReport.agency_id == agency_id)
+
+    since_id = parse_int('since_id')
+    if since_id is not None:
+        query = query.filter(IncidentReport.id > since_id)
+
+    since_date = parse_datetime('since_date')
+    if since_date is not None:
+        query = query.filter(IncidentReport.date > since_date)
+
+    return query.order_by(IncidentReport.id).yield_per(EXPORT_PAGE_SIZE)
+
+
+def encode(s):
+    return s.encode('utf-8') if s else ''
+
+
+def csv_chunks(reports):
+    """Yields a csv of the reports, a chunk at a time."""
+    buffer = BytesIO()
+    wr = csv.writer(buffer, delimiter=',', quoting=csv.QUOTE_MINIMAL)
+    wr.writerow(CSV_COLUMNS)
+
+    for (report_id, date, location, agency, vehicle_id, duration,
+            license_plate, description) in reports:
+        wr.writerow([date, encode(location), encode(agency),
+                     encode(vehicle_id), duration, encode(license_plate),
+                     encode(description), report_id])
+
+        # Send the csv in chunks rather than a response write per row
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def jsonl_chunks(reports):
+    """Yields the reports as JSON Lines, one object per line, a chunk at a
+    time."""
+    lines = []
+    size = 0
+    for (report_id, date, location, agency, vehicle_id, duration,
+            license_plate, description) in reports:
+        line = json.dumps({
+            'id': report_id,
+            'date': date.isoformat() if date else None,
+            'location': location,
+            'agency': agency,
+            'vehicle_id': vehicle_id,
+            'duration': int(duration.total_seconds()) if duration else None,
+            'license_plate': license_plate,
+            'description': description
+        }, sort_keys=True) + '\n'
+        lines.append(line)
+        size += len(line)
+
+        if size >= EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    yield ''.join(lines)
+
+
+def gzip_chunks(chunks):
+    """Gzip compresses a stream of chunks."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def accepts_gzip():
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+
+# Map of format to (chunk generator, mimetype)
+EXPORT_FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'jsonl': (jsonl_chunks, 'application/x-ndjson'),
+}
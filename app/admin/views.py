@@ -1,5 +1,5 @@
-import csv
 import datetime
+import hmac
 from ..decorators import admin_required
 from flask import (
     render_template,
@@ -9,6 +9,8 @@ from flask import (
     url_for,
     request,
     Response,
+    stream_with_context,
+    current_app,
 )
 from flask.ext.login import login_required, current_user
 from flask.ext.rq import get_queue
@@ -27,6 +29,8 @@ from ..models import User, Role, Agency, EditableHTML, IncidentReport
 from .. import db
 from ..utils import parse_phone_number, url_for_external
 from ..email import send_email
+from ..metrics import prometheus_text
+from .export import EXPORT_FORMATS, accepts_gzip, export_query, gzip_chunks
 
 
 @admin.route('/')
@@ -76,7 +80,8 @@ def invite_user():
 @admin_required
 def registered_users():
     """View all registered users."""
-    users = User.query.all()
+    users = User.query.options(db.joinedload(User.role),
+                               db.subqueryload(User.agencies)).all()
     roles = Role.query.all()
     agencies = Agency.query.all()
     return render_template('admin/registered_users.html', users=users,
@@ -246,7 +251,12 @@ def add_agency():
 def all_agencies():
     """View all agencies."""
     agencies = Agency.query.all()
-    return render_template('admin/all_agencies.html', agencies=agencies)
+    report_counts = dict(
+        db.session.query(IncidentReport.agency_id,
+                         db.func.count(IncidentReport.id))
+        .group_by(IncidentReport.agency_id))
+    return render_template('admin/all_agencies.html', agencies=agencies,
+                           report_counts=report_counts)
 
 
 @admin.route('/agency/<int:agency_id>')
@@ -329,28 +339,42 @@ def update_editor_contents():
 @login_required
 @admin_required
 def download_reports():
-    """Download a csv file of all incident reports."""
-
-    def encode(s):
-        return s.encode('utf-8') if s else ''
-
-    current_date = str(datetime.date.today())
-    csv_name = 'IncidentReports-' + current_date + '.csv'
-    outfile = open(csv_name, 'w+')
-    print('initial file contents:', outfile.read())
-
-    wr = csv.writer(outfile, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-    reports = db.session.query(IncidentReport).all()
-    wr.writerow(['DATE', 'LOCATION', 'AGENCY ID', 'VEHICLE ID', 'DURATION',
-                'LICENSE PLATE', 'DESCRIPTION'])
-    for r in reports:
-        wr.writerow([r.date, r.location, r.agency.name,
-                     r.vehicle_id, r.duration,
-                     r.license_plate, encode(r.description)])
-
-    endfile = open(csv_name, 'r+')
-    data = endfile.read()
-    return Response(
-        data,
-        mimetype="text/csv",
-        headers={"Content-disposition": "attachment; filename=" + csv_name})
+    """Download a file of incident reports, as csv or with format=jsonl as
+    JSON Lines. Reports can be filtered by date, agency, and for incremental
+    exports since_id or since_date; see export_query. The file is streamed
+    as the reports are read, and gzip compressed if the client accepts it."""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    generate, mimetype = EXPORT_FORMATS[export_format]
+
+    chunks = generate(export_query())
+    headers = {
+        'Content-disposition': 'attachment; filename=IncidentReports-{}.{}'
+        .format(datetime.date.today(), export_format),
+        'Vary': 'Accept-Encoding'
+    }
+    if accepts_gzip():
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers=headers)
+
+
+@admin.route('/metrics')
+def metrics():
+    """Latency histograms in the Prometheus text format. Available
+    to administrators, and to scrapers with the METRICS_TOKEN as a bearer
+    token."""
+    token = current_app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not (token and hmac.compare_digest(str(authorization),
+                                          'Bearer ' + str(token))):
+        if not current_user.is_authenticated():
+            return current_app.login_manager.unauthorized()
+        if not current_user.is_admin():
+            abort(403)
+
+    return Response(prometheus_text(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,62 @@
+from .. import db
+from ..models import IncidentReport, Location
+from .filters import filter_bounds, filter_dates
+from .grid import cell_index, cell_size, snap_bounds
+
+# Cells with fewer reports than this are sent as individual markers instead
+# of a cluster, same as the old client-side MarkerClusterer
+# minimumClusterSize.
+MIN_CLUSTER_SIZE = 15
+
+
+def located_reports_query(*columns):
+    """Query the given columns over reports that have coordinates."""
+    return db.session.query(*columns) \
+        .select_from(IncidentReport) \
+        .join(Location, Location.incident_report_id == IncidentReport.id) \
+        .filter(Location.latitude.isnot(None),
+                Location.longitude.isnot(None))
+
+
+def cluster_reports(zoom, bounds=None, start=None, end=None,
+                    min_cluster_size=MIN_CLUSTER_SIZE):
+    """Bucket the reports inside bounds into grid cells for the given zoom
+    level.
+
+    Returns a (clusters, reports) tuple: a list of dicts with the centroid and
+    report count of each cell holding at least min_cluster_size reports, and
+    a list of dicts with the id and coordinates of the reports in the
+    remaining cells.
+    """
+    size = cell_size(zoom)
+    if bounds is not None:
+        bounds = snap_bounds(bounds, size)
+
+    latitude, longitude = Location.latitude, Location.longitude
+    cell_y = cell_index(latitude, size).label('cell_y')
+    cell_x = cell_index(longitude, size).label('cell_x')
+    count = db.func.count(IncidentReport.id).label('count')
+
+    cells = located_reports_query(cell_y, cell_x, count,
+                                  db.func.avg(latitude),
+                                  db.func.avg(longitude))
+    cells = filter_dates(filter_bounds(cells, bounds), start, end) \
+        .group_by(cell_y, cell_x)
+
+    clusters = [
+        {'lat': lat, 'lng': lng, 'count': n}
+        for _, _, n, lat, lng in cells.having(count >= min_cluster_size)
+    ]
+
+    # Reports in sparse cells are sent individually
+    sparse = cells.having(count < min_cluster_size).subquery()
+    points = located_reports_query(IncidentReport.id, latitude, longitude) \
+        .join(sparse, db.and_(sparse.c.cell_y == cell_index(latitude, size),
+                              sparse.c.cell_x == cell_index(longitude, size)))
+    points = filter_dates(filter_bounds(points, bounds), start, end)
+    reports = [
+        {'id': report_id, 'lat': lat, 'lng': lng}
+        for report_id, lat, lng in points.order_by(IncidentReport.id)
+    ]
+
+    return clusters, reports
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+from flask import abort, request
+from flask.ext.login import current_user
+
+from ..models import IncidentReport, Location
+
+
+def parse_bounds(arg='bbox'):
+    """Parse a viewport bounding box of the form
+    'lat_lo,lng_lo,lat_hi,lng_hi' (what google.maps.LatLngBounds.toUrlValue
+    returns) from the request. Returns None if the argument is missing."""
+    value = request.args.get(arg)
+    if not value:
+        return None
+    try:
+        south, west, north, east = [float(v) for v in value.split(',')]
+    except ValueError:
+        abort(400)
+    if south > north or west > east:
+        abort(400)
+    return south, west, north, east
+
+
+def parse_near(arg='near', radius_arg='radius'):
+    """Parse a point 'lat,lng' and a radius in meters from the request.
+    Returns None if the point is missing."""
+    value = request.args.get(arg)
+    if not value:
+        return None
+    try:
+        latitude, longitude = [float(v) for v in value.split(',')]
+        radius = float(request.args.get(radius_arg, ''))
+    except ValueError:
+        abort(400)
+    if radius <= 0:
+        abort(400)
+    return latitude, longitude, radius
+
+
+def parse_date(arg):
+    """Parse a YYYY-MM-DD date from the request. Returns None if the argument
+    is missing."""
+    value = request.args.get(arg)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        abort(400)
+
+
+def parse_datetime(arg):
+    """Parse a YYYY-MM-DD date or an ISO 8601 YYYY-MM-DDTHH:MM:SS[.ffffff]
+    time from the request. Returns None if the argument is missing."""
+    value = request.args.get(arg)
+    if not value:
+        return None
+    for time_format in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                        '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    abort(400)
+
+
+def parse_int(arg, default=None, minimum=None, maximum=None):
+    """Parse an integer from the request, clamped to [minimum, maximum]."""
+    value = request.args.get(arg)
+    if not value:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400)
+    if minimum is not None:
+        value = max(value, minimum)
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+
+def filter_bounds(query, bounds):
+    """Restrict a query joined with Location to the given bounding box."""
+    if bounds is None:
+        return query
+    return query.filter(Location.within_bounds(*bounds))
+
+
+def filter_near(query, near):
+    """Restrict a query joined with Location to within a radius of a
+    point."""
+    if near is None:
+        return query
+    return query.filter(Location.within_radius(*near))
+
+
+def filter_dates(query, start=None, end=None):
+    """Restrict a query to reports between the start and end dates,
+    inclusive of the whole end day."""
+    if start is not None:
+        query = query.filter(IncidentReport.date >= start)
+    if end is not None:
+        query = query.filter(IncidentReport.date < end + timedelta(days=1))
+    return query
+
+
+def visible_agency_ids():
+    """Returns None if the current user may see the agency of every report,
+    otherwise the set of agency ids the user is affiliated with. Reports with
+    show_agency_publicly set are visible to everyone."""
+    if current_user.is_admin():
+        return None
+    return set(a.id for a in getattr(current_user, 'agencies', []))
+
+
+def agency_is_visible(agency_id, show_agency_publicly, visible_ids):
+    return visible_ids is None or show_agency_publicly or \
+        agency_id in visible_ids
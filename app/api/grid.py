@@ -0,0 +1,63 @@
+"""
+Grid cells over report coordinates, computed in SQL so that reports can be
+bucketed with a GROUP BY instead of in Python.
+"""
+import math
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from .. import db
+
+# Width in pixels of a cluster cell on screen, same as the old client-side
+# MarkerClusterer gridSize.
+CLUSTER_GRID_PIXELS = 50
+
+# Google Maps renders the whole world 256 pixels wide at zoom level 0.
+TILE_PIXELS = 256
+
+
+class floor(FunctionElement):
+    """SQL floor(), which SQLite does not have."""
+    type = db.Integer()
+    name = 'floor'
+
+
+@compiles(floor)
+def compile_floor(element, compiler, **kw):
+    return 'floor(%s)' % compiler.process(element.clauses, **kw)
+
+
+# SQLite only truncates towards zero, so shift values positive first. Grid cell
+# indexes are far smaller than the offset.
+SQLITE_FLOOR_OFFSET = 2 ** 30
+
+
+@compiles(floor, 'sqlite')
+def compile_floor_sqlite(element, compiler, **kw):
+    return '(CAST(%s + %d AS INTEGER) - %d)' % (
+        compiler.process(element.clauses, **kw),
+        SQLITE_FLOOR_OFFSET, SQLITE_FLOOR_OFFSET)
+
+
+def cell_size(zoom):
+    """Size in degrees of a CLUSTER_GRID_PIXELS wide cell at the given zoom
+    level."""
+    return 360.0 * CLUSTER_GRID_PIXELS / (TILE_PIXELS * 2 ** zoom)
+
+
+def cell_index(coordinate, size):
+    """SQL expression for the index of the grid cell containing coordinate.
+    Cells are aligned to a global grid so that they are stable as the map is
+    panned."""
+    return floor(coordinate / size)
+
+
+def snap_bounds(bounds, size):
+    """Grow a (south, west, north, east) bounding box outward to whole grid
+    cells, so that cells on the edge of the viewport are counted fully."""
+    south, west, north, east = bounds
+    return (math.floor(south / size) * size,
+            math.floor(west / size) * size,
+            (math.floor(north / size) + 1) * size,
+            (math.floor(east / size) + 1) * size)
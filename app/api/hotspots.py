@@ -0,0 +1,78 @@
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from .. import db
+from ..models import IncidentReport, Location
+from .clusters import located_reports_query
+from .filters import filter_bounds, filter_dates
+from .grid import cell_index, cell_size
+
+# Zoom level whose cluster grid cells are used for hotspots, about 100m
+# across in Philadelphia.
+HOTSPOT_ZOOM = 16
+
+HOTSPOT_ORDERS = ['count', 'duration']
+
+
+class duration_seconds(FunctionElement):
+    """Length in seconds of an Interval column."""
+    type = db.Float()
+    name = 'duration_seconds'
+
+
+@compiles(duration_seconds)
+def compile_duration_seconds(element, compiler, **kw):
+    return 'EXTRACT(EPOCH FROM %s)' % compiler.process(element.clauses, **kw)
+
+
+# SQLite stores intervals as datetimes after the epoch
+@compiles(duration_seconds, 'sqlite')
+def compile_duration_seconds_sqlite(element, compiler, **kw):
+    return "((julianday(%s) - julianday('1970-01-01')) * 86400)" % \
+        compiler.process(element.clauses, **kw)
+
+
+def hotspot_cells(zoom=HOTSPOT_ZOOM, bounds=None, start=None, end=None,
+                  agency_id=None, public_only=False, order='count',
+                  limit=10):
+    """The grid cells with the most reports, or the most total idling time
+    with order='duration'.
+
+    Only reports of the given agency are counted if agency_id is given, and
+    only those whose agency is shown publicly if public_only is True.
+
+    Returns a list of dicts with each cell's bounds, the centroid of its
+    reports, their count and total duration in seconds.
+    """
+    size = cell_size(zoom)
+    cell_y = cell_index(Location.latitude, size).label('cell_y')
+    cell_x = cell_index(Location.longitude, size).label('cell_x')
+    count = db.func.count(IncidentReport.id).label('count')
+    duration = db.func.coalesce(
+        db.func.sum(duration_seconds(IncidentReport.duration)), 0) \
+        .label('duration')
+
+    cells = located_reports_query(cell_y, cell_x, count, duration,
+                                  db.func.avg(Location.latitude),
+                                  db.func.avg(Location.longitude))
+    cells = filter_dates(filter_bounds(cells, bounds), start, end)
+    if agency_id is not None:
+        cells = cells.filter(IncidentReport.agency_id == agency_id)
+    if public_only:
+        cells = cells.filter(IncidentReport.show_agency_publicly)
+
+    ranking = count if order == 'count' else duration
+    cells = cells.group_by(cell_y, cell_x) \
+        .order_by(ranking.desc(), cell_y, cell_x) \
+        .limit(limit)
+
+    return [{
+        'south': y * size,
+        'west': x * size,
+        'north': (y + 1) * size,
+        'east': (x + 1) * size,
+        'lat': lat,
+        'lng': lng,
+        'count': n,
+        'duration': int(round(seconds)),
+    } for y, x, n, seconds, lat, lng in cells]
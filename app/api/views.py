@@ -0,0 +1,162 @@
+from flask import abort, jsonify, request
+
+from . import api
+from .. import db
+from ..models import Agency, IncidentReport, Location
+from .clusters import cluster_reports
+from .hotspots import HOTSPOT_ORDERS, HOTSPOT_ZOOM, hotspot_cells
+from .filters import (
+    agency_is_visible,
+    filter_bounds,
+    filter_dates,
+    filter_near,
+    parse_bounds,
+    parse_date,
+    parse_int,
+    parse_near,
+    visible_agency_ids,
+)
+
+REPORTS_PAGE_SIZE = 500
+MAX_REPORTS_PAGE_SIZE = 1000
+MAX_CLUSTER_ZOOM = 21
+HOTSPOTS_LIMIT = 10
+MAX_HOTSPOTS_LIMIT = 100
+
+
+@api.route('/reports')
+def reports():
+    """Compact JSON for the map markers of the reports inside a viewport.
+
+    Query arguments:
+        bbox: 'lat_lo,lng_lo,lat_hi,lng_hi' viewport bounding box
+        near, radius: 'lat,lng' point and radius in meters around it
+        start, end: YYYY-MM-DD date range (inclusive)
+        after: page cursor, the `next` value of the previous page
+        limit: page size
+
+    Reports are returned in id order, `next` is None on the last page.
+    """
+    bounds = parse_bounds()
+    near = parse_near()
+    start, end = parse_date('start'), parse_date('end')
+    after = parse_int('after', default=0)
+    limit = parse_int('limit', default=REPORTS_PAGE_SIZE, minimum=1,
+                      maximum=MAX_REPORTS_PAGE_SIZE)
+
+    query = db.session.query(
+        IncidentReport.id,
+        Location.latitude,
+        Location.longitude,
+        IncidentReport.date,
+        IncidentReport.duration,
+        IncidentReport.agency_id,
+        IncidentReport.show_agency_publicly,
+        Agency.name,
+    ).join(Location, Location.incident_report_id == IncidentReport.id) \
+        .outerjoin(Agency, Agency.id == IncidentReport.agency_id) \
+        .filter(IncidentReport.id > after,
+                Location.latitude.isnot(None),
+                Location.longitude.isnot(None))
+    query = filter_near(filter_bounds(query, bounds), near)
+    query = filter_dates(query, start, end)
+    rows = query.order_by(IncidentReport.id).limit(limit + 1).all()
+
+    visible_ids = visible_agency_ids()
+    results = []
+    for (report_id, lat, lng, date, duration, agency_id, show_agency_publicly,
+         agency_name) in rows[:limit]:
+        results.append({
+            'id': report_id,
+            'lat': lat,
+            'lng': lng,
+            'date': date.isoformat() if date else None,
+            'duration': int(duration.total_seconds()) if duration else None,
+            'agency': agency_name if agency_is_visible(
+                agency_id, show_agency_publicly, visible_ids) else None,
+        })
+
+    return jsonify(reports=results,
+                   next=results[-1]['id'] if len(rows) > limit else None)
+
+
+@api.route('/clusters')
+def clusters():
+    """Report clusters for the map at low zoom levels.
+
+    Query arguments:
+        zoom: map zoom level, which decides the size of the grid cells
+        bbox: 'lat_lo,lng_lo,lat_hi,lng_hi' viewport bounding box
+        start, end: YYYY-MM-DD date range (inclusive)
+
+    Returns the centroid and size of each dense grid cell, and the reports in
+    sparse cells individually.
+    """
+    zoom = parse_int('zoom', minimum=0, maximum=MAX_CLUSTER_ZOOM)
+    if zoom is None:
+        abort(400)
+    clusters, reports = cluster_reports(zoom, bounds=parse_bounds(),
+                                        start=parse_date('start'),
+                                        end=parse_date('end'))
+    return jsonify(clusters=clusters, reports=reports)
+
+
+@api.route('/hotspots')
+def hotspots():
+    """The grid cells with the most idling reports.
+
+    Query arguments:
+        zoom: map zoom level whose grid cells to use, default HOTSPOT_ZOOM
+        bbox: 'lat_lo,lng_lo,lat_hi,lng_hi' bounding box
+        start, end: YYYY-MM-DD date range (inclusive)
+        agency: agency id, to only count that agency's reports
+        order: 'count' to rank cells by number of reports (the default), or
+            'duration' by total idling time
+        limit: number of cells
+
+    Reports whose agency the user may not see are not counted towards an
+    agency.
+    """
+    zoom = parse_int('zoom', default=HOTSPOT_ZOOM, minimum=0,
+                     maximum=MAX_CLUSTER_ZOOM)
+    limit = parse_int('limit', default=HOTSPOTS_LIMIT, minimum=1,
+                      maximum=MAX_HOTSPOTS_LIMIT)
+    order = request.args.get('order', 'count')
+    if order not in HOTSPOT_ORDERS:
+        abort(400)
+
+    agency_id = parse_int('agency')
+    public_only = agency_id is not None and not agency_is_visible(
+        agency_id, False, visible_agency_ids())
+
+    cells = hotspot_cells(zoom, bounds=parse_bounds(),
+                          start=parse_date('start'), end=parse_date('end'),
+                          agency_id=agency_id, public_only=public_only,
+                          order=order, limit=limit)
+    return jsonify(hotspots=cells)
+
+
+@api.route('/reports/<int:report_id>')
+def report(report_id):
+    """Details of a single report, as shown in the map's info window."""
+    report = IncidentReport.query.get(report_id)
+    if report is None:
+        abort(404)
+
+    result = {
+        'id': report.id,
+        'date': report.date.isoformat() if report.date else None,
+        'duration': int(report.duration.total_seconds())
+        if report.duration else None,
+        'description': report.description,
+    }
+    if agency_is_visible(report.agency_id, report.show_agency_publicly,
+                         visible_agency_ids()):
+        result.update({
+            'vehicle_id': report.vehicle_id,
+            'license_plate': report.license_plate,
+            'agency': report.agency.name if report.agency else None,
+            'picture_url': report.picture_url,
+            'picture_thumbnail_url': report.picture_thumbnail_url,
+        })
+    return jsonify(**result)
@@ -27,7 +27,6 @@ vendor_js = Bundle(
     'vendor/jquery-ui.js',
     'vendor/jQDateRangeSlider-min.js',
     'vendor/oms.min.js',
-    'vendor/markerclusterer.js',
     filters='jsmin',
     output='scripts/vendor.js'
 )
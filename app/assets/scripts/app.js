@@ -43,3 +43,69 @@ $(document).ready(function () {
         };
 })(jQuery);
 
+
+// Downscale a picture chosen with a file input to at most maxDimension pixels
+// on its longest side before it is uploaded, by redrawing it on a canvas
+// (browsers draw it upright, according to its EXIF orientation). The server
+// re-encodes pictures anyway, so this only saves upload time; the original
+// file is sent if the browser can't do this.
+function downscaleImageInput(input, maxDimension) {
+    if (!window.DataTransfer || !window.URL || !window.HTMLCanvasElement ||
+            !HTMLCanvasElement.prototype.toBlob) {
+        return;
+    }
+    var pending = null;
+
+    $(input).on('change', function () {
+        var inputElement = this;
+        var file = this.files[0];
+        if (!file || !/^image\/(jpeg|png)$/.test(file.type)) {
+            return;
+        }
+        var done = pending = $.Deferred();
+        var url = URL.createObjectURL(file);
+        var image = new Image();
+        image.onload = function () {
+            URL.revokeObjectURL(url);
+            var scale = maxDimension /
+                Math.max(image.naturalWidth, image.naturalHeight);
+            if (scale >= 1) {
+                done.resolve();
+                return;
+            }
+            var canvas = document.createElement('canvas');
+            canvas.width = Math.round(image.naturalWidth * scale);
+            canvas.height = Math.round(image.naturalHeight * scale);
+            var context = canvas.getContext('2d');
+            context.fillStyle = '#fff';  // JPEGs can't be transparent
+            context.fillRect(0, 0, canvas.width, canvas.height);
+            context.drawImage(image, 0, 0, canvas.width, canvas.height);
+            canvas.toBlob(function (blob) {
+                if (blob && blob.size < file.size) {
+                    var transfer = new DataTransfer();
+                    transfer.items.add(new File(
+                        [blob], file.name.replace(/\.[^.]*$/, '') + '.jpg',
+                        {type: 'image/jpeg'}));
+                    inputElement.files = transfer.files;
+                }
+                done.resolve();
+            }, 'image/jpeg', 0.9);
+        };
+        image.onerror = function () {
+            URL.revokeObjectURL(url);
+            done.resolve();
+        };
+        image.src = url;
+    });
+
+    // Wait for the picture to be downscaled before submitting its form
+    $(input).closest('form').on('submit', function (event) {
+        if (pending !== null && pending.state() === 'pending') {
+            event.preventDefault();
+            var form = this;
+            pending.always(function () {
+                form.submit();
+            });
+        }
+    });
+}
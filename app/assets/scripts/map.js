@@ -1,10 +1,22 @@
 // Global Marker Wrappers and Map
-var globalMarkers = null;
+var globalMarkers = {};
 var globalMap = null;
-var markerCluster = null;
+var globalOms = null;
 
+// Markers are fetched lazily from the reports api as the map is panned.
+// Up to CLUSTER_MAX_ZOOM the server groups reports into clusters, and only
+// sends individual markers for sparse areas. markerRequest identifies the
+// latest viewport so that responses for stale viewports can be dropped.
+var CLUSTER_MAX_ZOOM = 15;
+var reportsApiUrl = null;
+var clustersApiUrl = null;
+var clusterMarkers = [];
+var markerRequest = 0;
 
-// Geographic bounds centered according to incident report locations
+// Date range selected on the slider, null until the slider is moved
+var selectedDateRange = null;
+
+// Geographic bounds the center button returns the map to
 var geographicBounds = null;
 
 // Initial map center coordinates
@@ -16,21 +28,182 @@ initial_coords = new google.maps.LatLng(INITIAL_CENTER_LAT, INITIAL_CENTER_LONG)
 var BOUNDS_MIN;
 var BOUNDS_MAX = new Date();
 
-// Take a list of markers and a map, put them on the map, set the
-// minimum date, and set the location bounds
-function storeMarkerState(markers, map, minDate, bounds, oms) {
-    globalMarkers = markers;
+// Set up the map for lazily loading markers, set the minimum date, and set
+// the location bounds
+function storeMarkerState(map, minDate, bounds, oms, reportsUrl, clustersUrl) {
     globalMap = map;
-    markerCluster = new MarkerClusterer(map, markers, {gridSize: 50, maxZoom: 15, minimumClusterSize: 15, imagePath: 'static/images/clusterer/m'});
-    for (mw = 0; mw < globalMarkers.length; mw++)
-    {
-        (globalMarkers[mw]).setMap(globalMap);
-        oms.addMarker(globalMarkers[mw]);
-
-    }
+    globalOms = oms;
+    reportsApiUrl = reportsUrl;
+    clustersApiUrl = clustersUrl;
     BOUNDS_MIN = minDate;
     geographicBounds = bounds;
     map.fitBounds(bounds);
+    google.maps.event.addListener(map, 'idle', loadVisibleMarkers);
+}
+
+// Fetch the clusters or markers inside the current viewport
+function loadVisibleMarkers() {
+    var bounds = globalMap.getBounds();
+    if (!bounds) {
+        return;
+    }
+    markerRequest++;
+    if (globalMap.getZoom() <= CLUSTER_MAX_ZOOM) {
+        fetchClusters(bounds.toUrlValue(), globalMap.getZoom(), markerRequest);
+    } else {
+        clearClusters();
+        fetchMarkerPage(bounds.toUrlValue(), 0, markerRequest);
+    }
+}
+
+// Add the selected date range to api request parameters
+function withDateRange(params) {
+    if (selectedDateRange !== null) {
+        params.start = formatDate(selectedDateRange.start);
+        params.end = formatDate(selectedDateRange.end);
+    }
+    return params;
+}
+
+function fetchClusters(bbox, zoom, request) {
+    var params = withDateRange({bbox: bbox, zoom: zoom});
+    $.getJSON(clustersApiUrl, params, function(data) {
+        if (request !== markerRequest) {
+            return;
+        }
+        clearMarkers();
+        for (var i = 0; i < data.clusters.length; i++) {
+            addCluster(data.clusters[i]);
+        }
+        addMarkers(data.reports);
+    });
+}
+
+function fetchMarkerPage(bbox, after, request) {
+    var params = withDateRange({bbox: bbox, after: after});
+    $.getJSON(reportsApiUrl, params, function(data) {
+        if (request !== markerRequest) {
+            return;
+        }
+        addMarkers(data.reports);
+        if (data.next !== null) {
+            fetchMarkerPage(bbox, data.next, request);
+        }
+    });
+}
+
+// Add markers for the given reports, skipping ones already on the map
+function addMarkers(reports) {
+    for (var i = 0; i < reports.length; i++) {
+        var report = reports[i];
+        if (globalMarkers[report.id] !== undefined) {
+            continue;
+        }
+        var marker = new google.maps.Marker({
+            position: {lat: report.lat, lng: report.lng},
+            icon: "../static/images/marker.png"
+        });
+        marker.reportId = report.id;
+        globalMarkers[report.id] = marker;
+        marker.setMap(globalMap);
+        globalOms.addMarker(marker);
+    }
+}
+
+// Add a cluster marker, using the same icons as MarkerClusterer. Clicking a
+// cluster zooms in on it.
+function addCluster(cluster) {
+    var icon = Math.min(String(cluster.count).length, 5);
+    var marker = new google.maps.Marker({
+        position: {lat: cluster.lat, lng: cluster.lng},
+        icon: {url: 'static/images/clusterer/m' + icon + '.png',
+               anchor: new google.maps.Point(26, 26)},
+        label: String(cluster.count),
+        map: globalMap
+    });
+    google.maps.event.addListener(marker, 'click', function() {
+        globalMap.setCenter(marker.getPosition());
+        globalMap.setZoom(Math.min(globalMap.getZoom() + 2, CLUSTER_MAX_ZOOM + 1));
+    });
+    clusterMarkers.push(marker);
+}
+
+function clearClusters() {
+    for (var i = 0; i < clusterMarkers.length; i++) {
+        clusterMarkers[i].setMap(null);
+    }
+    clusterMarkers = [];
+}
+
+// Remove every cluster and marker from the map
+function clearMarkers() {
+    clearClusters();
+    globalOms.clearMarkers();
+    for (var id in globalMarkers) {
+        globalMarkers[id].setMap(null);
+    }
+    globalMarkers = {};
+}
+
+// Fetch the details of the report behind a marker and show them in the info
+// container
+function showReportInfo(marker) {
+    $.getJSON(reportsApiUrl + '/' + marker.reportId, function(report) {
+        var content = $('<div id="replaceable" class="ui segment">');
+        content.append('<button id="close_info" class="ui icon button close">' +
+                       '<i class="remove icon"></i></button>');
+        content.append($('<h3>').text('Date: ' + formatDateTime(report.date)));
+        content.append($('<p>').text('Duration (h:m:s): ' + formatDuration(report.duration)));
+        if (report.agency !== undefined) {
+            content.append($('<p>').text('Vehicle ID: ' + report.vehicle_id));
+            content.append($('<p>').text('License Plate: ' + (report.license_plate || '')));
+            content.append($('<p>').text('Agency: ' + (report.agency || '')));
+            if (report.picture_url) {
+                var link = $('<a target="_blank" rel="noopener noreferrer">')
+                    .attr('href', report.picture_url);
+                if (report.picture_thumbnail_url) {
+                    link.append($('<img class="ui image" alt="report picture">')
+                        .attr('src', report.picture_thumbnail_url));
+                } else {
+                    link.text('Link to Picture');
+                }
+                content.append($('<p>').append(link));
+            }
+        }
+        content.append($('<p>').text('Description: ' + (report.description || '')));
+        $('#replaceable').replaceWith(content);
+        $('#close_info').on('click', function() {
+            $('#info_container').hide();
+        });
+    });
+}
+
+function pad(number) {
+    return (number < 10 ? '0' : '') + number;
+}
+
+// Format a Date as YYYY-MM-DD for the api
+function formatDate(date) {
+    return date.getFullYear() + '-' + pad(date.getMonth() + 1) + '-' + pad(date.getDate());
+}
+
+// Format an ISO date string from the api as MM-DD-YYYY at HH:MM AM
+function formatDateTime(isoString) {
+    var parts = isoString.split('T');
+    var date = parts[0].split('-');
+    var time = parts[1].split(':');
+    var hour = parseInt(time[0], 10);
+    var suffix = hour < 12 ? 'AM' : 'PM';
+    hour = hour % 12 === 0 ? 12 : hour % 12;
+    return date[1] + '-' + date[2] + '-' + date[0] + ' at ' + pad(hour) + ':' + time[1] + ' ' + suffix;
+}
+
+// Format a duration in seconds as h:mm:ss
+function formatDuration(seconds) {
+    if (seconds === null) {
+        return '';
+    }
+    return Math.floor(seconds / 3600) + ':' + pad(Math.floor(seconds / 60) % 60) + ':' + pad(seconds % 60);
 }
 
 // Use Google geocoder to update geolocation given an address through
@@ -153,11 +326,6 @@ $(document).ready(function() {
     });
 });
 
-function getNextDate(startDate) {
-    startDate.setDate(startDate.getDate()+1);
-    return startDate;
-}
-
 function initializeDateSlider() {
     $("#slider").dateRangeSlider({
         bounds: {
@@ -194,22 +362,10 @@ function initializeDateSlider() {
         beginMonth = monthObj[String(data.values.min).substring(4, 7)];
         endMonth = monthObj[String(data.values.max).substring(4, 7)];
         beginDate = new Date(beginYear, beginMonth, beginDay);
-        endDate = getNextDate(new Date(endYear, endMonth, endDay));
 
-        var markersDisplayedOnMap = [];
-        for (mw = 0; mw < globalMarkers.length; mw++) {
-            if ((globalMarkers[mw].incidentDate.getTime() < beginDate.getTime()) ||
-                (globalMarkers[mw].incidentDate.getTime() >= endDate.getTime())) {
-                globalMarkers[mw].setMap(null);
-            }
-            else
-            {
-                globalMarkers[mw].setMap(globalMap);
-                markersDisplayedOnMap.push(globalMarkers[mw]);
-            }
-        }
-        markerCluster.setMap(null);
-        markerCluster.clearMarkers();
-        markerCluster = new MarkerClusterer(map, markersDisplayedOnMap, {gridSize: 50, maxZoom: 15, minimumClusterSize: 15, imagePath: 'static/images/clusterer/m'});
+        // Refetch the markers for the new date range
+        selectedDateRange = {start: beginDate, end: new Date(endYear, endMonth, endDay)};
+        clearMarkers();
+        loadVisibleMarkers();
     });
 }
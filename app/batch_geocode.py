@@ -0,0 +1,75 @@
+import functools
+from multiprocessing.pool import ThreadPool
+
+import requests
+from flask import current_app
+
+from app.models import GeocodeResult
+from app.rate_limit import TokenBucket
+from app.utils import GeocodeError, google_geocode, normalize_address
+
+
+def batch_geocode(addresses, workers=None, rate=None, geocoder=None,
+                  use_cache=True):
+    """Geocode many addresses concurrently.
+
+    Identical addresses (after normalization) are only geocoded once, and
+    cached results are used where possible. The rest are geocoded by a pool
+    of worker threads, limited to rate requests a second overall. New
+    results are added to the cache (but not committed).
+
+    geocoder is a function from an address to a (latitude, longitude) tuple,
+    by default the Google API.
+
+    Returns a dict from each address to its (latitude, longitude) tuple,
+    (None, None) if geocoding failed.
+    """
+    # The pool's threads have no app context, so everything they need from
+    # the config is read here
+    config = current_app.config
+    workers = workers or config['GEOCODE_WORKERS']
+    rate = rate or config['GEOCODE_RATE_LIMIT']
+    viewport = config['VIEWPORT']
+    if geocoder is None:
+        geocoder = functools.partial(google_geocode, viewport=viewport,
+                                     key=config['GOOGLE_GEOCODE_KEY'],
+                                     max_retries=config['GEOCODE_MAX_RETRIES'])
+
+    # One address to geocode for each distinct normalized address
+    unique = {}
+    for address in addresses:
+        unique.setdefault(normalize_address(address), address)
+
+    coords = {}
+    if use_cache:
+        cached = GeocodeResult.lookup_many(unique.values(), viewport)
+        for normalized, address in unique.items():
+            result = cached.get(GeocodeResult.cache_key(address, viewport))
+            if result is not None:
+                coords[normalized] = (result.latitude, result.longitude)
+
+    missing = [(normalized, address) for normalized, address in unique.items()
+               if normalized not in coords]
+    bucket = TokenBucket(rate)
+
+    def geocode_one(address):
+        bucket.acquire()
+        try:
+            return geocoder(address), True
+        except (GeocodeError, requests.RequestException):
+            return (None, None), False
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(geocode_one, [a for _, a in missing])
+    finally:
+        pool.close()
+        pool.join()
+
+    for (normalized, address), (result, cacheable) in zip(missing, results):
+        coords[normalized] = result
+        if use_cache and cacheable:
+            GeocodeResult.store(address, viewport, *result)
+
+    return dict((address, coords[normalize_address(address)])
+                for address in addresses)
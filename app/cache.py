@@ -0,0 +1,129 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+from flask.ext.rq import get_connection
+from redis import RedisError
+
+
+class LRUCache(object):
+    """Thread-safe in-process cache of up to maxsize entries, evicting the
+    least recently used. Entries expire after their ttl in seconds."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # key: (value, expiry time)
+        self.lock = Lock()
+
+    def get(self, key):
+        """Returns the cached value, or None."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                return None
+            self.entries[key] = entry  # now the most recently used
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + ttl)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisBacked(object):
+    """Base of the stores below, which keep values in Redis under keys
+    starting with prefix, with an LRUCache of up to maxsize entries in each
+    process."""
+
+    def __init__(self, prefix, maxsize=1024):
+        self.prefix = prefix
+        self.local = LRUCache(maxsize)
+        self.redis = None
+        self.pid = None
+
+    def get_redis(self):
+        # Redis connections can't be shared with a forked process
+        if self.redis is None or self.pid != os.getpid():
+            self.redis, self.pid = get_connection(), os.getpid()
+        return self.redis
+
+
+class TieredCache(RedisBacked):
+    """An LRUCache in front of Redis, which is shared by all web and RQ
+    worker processes. Values must be JSON serializable. If Redis can't be
+    reached, only the in-process tier is used."""
+
+    def get(self, key):
+        """Returns the cached value, or None."""
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        try:
+            pipe = self.get_redis().pipeline()
+            pipe.get(self.prefix + key)
+            pipe.pttl(self.prefix + key)
+            data, ttl = pipe.execute()
+        except RedisError:
+            current_app.logger.warning('Redis cache unavailable',
+                                       exc_info=True)
+            return None
+        if data is None:
+            return None
+
+        value = json.loads(data)
+        if ttl > 0:
+            self.local.set(key, value, ttl / 1000.0)
+        return value
+
+    def set(self, key, value, ttl):
+        """Caches value for ttl seconds."""
+        self.local.set(key, value, ttl)
+        try:
+            self.get_redis().setex(name=self.prefix + key,
+                                   value=json.dumps(value), time=int(ttl))
+        except RedisError:
+            current_app.logger.warning('Redis cache unavailable',
+                                       exc_info=True)
+
+    def clear_local(self):
+        self.local.clear()
+
+
+class RedisStore(RedisBacked):
+    """Values kept in Redis, so that every web and RQ worker process sees
+    the latest value. Values must be JSON serializable. If Redis can't be
+    reached, values are kept in an in-process LRUCache instead, which only
+    that process sees."""
+
+    def get(self, key):
+        """Returns the stored value, or None."""
+        try:
+            data = self.get_redis().get(self.prefix + key)
+        except RedisError:
+            current_app.logger.warning('Redis store unavailable',
+                                       exc_info=True)
+            return self.local.get(key)
+        return None if data is None else json.loads(data)
+
+    def set(self, key, value, ttl):
+        """Stores value for ttl seconds."""
+        try:
+            self.get_redis().setex(name=self.prefix + key,
+                                   value=json.dumps(value), time=int(ttl))
+        except RedisError:
+            current_app.logger.warning('Redis store unavailable',
+                                       exc_info=True)
+            self.local.set(key, value, ttl)
+
+    def clear_local(self):
+        self.local.clear()
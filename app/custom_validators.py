@@ -70,9 +70,11 @@ class StrippedLength(object):
 
 
 class ValidLocation(object):
-    """Geocode the address to make sure it is valid."""
+    """Geocode the address to make sure it is valid. The coordinates are kept
+    on the field as field.coordinates, so they need not be geocoded again."""
     def __call__(self, form, field):
         lat, lng = geocode(field.data)
+        field.coordinates = (lat, lng)
         if lat is None or lng is None:
             raise ValidationError('We could not find that location. Please '
                                   'respond with a full address including city '
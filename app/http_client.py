@@ -0,0 +1,100 @@
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.metrics import timed_phase, upstream_latency
+
+# Requests that are safe to send again if the first attempt failed
+IDEMPOTENT_METHODS = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+
+# Responses worth retrying, as the upstream may answer the next attempt
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class Upstream(object):
+    """An external service, called through one pooled requests session so
+    that connections (and their TLS handshakes) are reused.
+
+    Requests time out after connect_timeout seconds without a connection and
+    read_timeout seconds without data. Idempotent requests that fail with a
+    connection error, timeout or a RETRY_STATUSES response are retried up to
+    max_retries times, with exponential backoff and jitter. Every attempt's
+    latency is recorded in app.metrics.upstream_latency, and counts towards
+    the http phase of the current request.
+    """
+
+    def __init__(self, name, connect_timeout=3.05, read_timeout=10,
+                 max_retries=2, backoff=0.25, pool_size=10):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.session = None
+        self.pid = None
+
+    def get_session(self):
+        # Connections can't be shared with a forked process, so each process
+        # gets its own session
+        if self.session is None or self.pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.session, self.pid = session, os.getpid()
+        return self.session
+
+    def request(self, method, url, **kwargs):
+        """Sends a request, taking the same arguments as
+        requests.Session.request. Returns the response, whatever its
+        status. Raises a requests.RequestException if there was no
+        response."""
+        method = method.upper()
+        kwargs.setdefault('timeout', self.timeout)
+        retries = self.max_retries if method in IDEMPOTENT_METHODS else 0
+
+        for attempt in range(retries + 1):
+            start = time.time()
+            try:
+                with timed_phase('http'):
+                    response = self.get_session().request(method, url,
+                                                          **kwargs)
+            except requests.Timeout:
+                self.record(start, 'timeout')
+                if attempt == retries:
+                    raise
+            except requests.ConnectionError:
+                self.record(start, 'connection_error')
+                if attempt == retries:
+                    raise
+            else:
+                self.record(start, '{}xx'.format(response.status_code // 100))
+                if response.status_code not in RETRY_STATUSES or \
+                        attempt == retries:
+                    return response
+            time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def record(self, start, outcome):
+        upstream_latency.observe((self.name, outcome), time.time() - start)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+google = Upstream('google')
+openweathermap = Upstream('openweathermap', read_timeout=5)
+# Uploads can take a while, and the image may have to be fetched by Imgur
+imgur = Upstream('imgur', read_timeout=30)
+twilio = Upstream('twilio')
+# Wherever pictures to be stored are linked from
+image_hosts = Upstream('image_hosts', read_timeout=30)
@@ -0,0 +1,222 @@
+import hashlib
+from io import BytesIO
+
+from flask import current_app
+from flask.ext.rq import get_connection, get_queue
+from PIL import Image
+from sqlalchemy.exc import IntegrityError
+
+from app import db, http_client
+from app.models import IncidentReport, StoredImage
+from app.storage import delete_image, upload_image
+
+SPOOL_PREFIX = 'image-spool:'
+
+# The transpositions that turn an image stored with the given EXIF
+# orientation upright
+ORIENTATION_TAG = 0x0112
+ORIENTATION_TRANSPOSES = {
+    2: [Image.FLIP_LEFT_RIGHT],
+    3: [Image.ROTATE_180],
+    4: [Image.FLIP_TOP_BOTTOM],
+    5: [Image.TRANSPOSE],
+    6: [Image.ROTATE_270],
+    7: [Image.TRANSPOSE, Image.ROTATE_180],
+    8: [Image.ROTATE_90],
+}
+
+
+def process_image(data):
+    """Re-encodes an uploaded image as a JPEG of at most IMAGE_MAX_DIMENSION
+    pixels on its longest side, and makes an IMAGE_THUMBNAIL_DIMENSION
+    thumbnail of it. The EXIF data, which may include where the picture was
+    taken, is dropped after turning the image upright. Returns the image's
+    and thumbnail's data. Raises an IOError if data isn't an image."""
+    max_dimension = current_app.config['IMAGE_MAX_DIMENSION']
+    thumbnail_dimension = current_app.config['IMAGE_THUMBNAIL_DIMENSION']
+
+    image = Image.open(BytesIO(data))
+    # Let JPEGs be decoded at a fraction of their size, which is much faster
+    # for full resolution phone pictures
+    image.draft('RGB', (max_dimension, max_dimension))
+    image = upright(image)
+    image.thumbnail((max_dimension, max_dimension), Image.ANTIALIAS)
+    thumbnail = image.copy()
+    thumbnail.thumbnail((thumbnail_dimension, thumbnail_dimension),
+                        Image.ANTIALIAS)
+    return encode_jpeg(image), encode_jpeg(thumbnail)
+
+
+def upright(image):
+    """Returns an RGB copy of image, transposed according to its EXIF
+    orientation."""
+    try:
+        exif = image._getexif() or {}
+    except (AttributeError, IndexError, KeyError, SyntaxError, TypeError,
+            ValueError):
+        # Not a JPEG, or its EXIF data is broken
+        exif = {}
+
+    if image.mode in ('RGBA', 'LA') or \
+            (image.mode == 'P' and 'transparency' in image.info):
+        # JPEGs can't be transparent, so show transparent parts as white
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    else:
+        image = image.convert('RGB')
+
+    for method in ORIENTATION_TRANSPOSES.get(exif.get(ORIENTATION_TAG), []):
+        image = image.transpose(method)
+    return image
+
+
+def perceptual_hash(data):
+    """Returns the 64 bit difference hash of an image's data, in hex. It
+    compares the brightness of neighbouring pixels in a 9x8 grayscale copy
+    of the image, so it is the same for most copies of a picture that were
+    rescaled or re-encoded."""
+    image = Image.open(BytesIO(data)).convert('L').resize((9, 8),
+                                                          Image.ANTIALIAS)
+    pixels = list(image.getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            i = row * 9 + column
+            bits = bits << 1 | (pixels[i] > pixels[i + 1])
+    return '{:016x}'.format(bits)
+
+
+def encode_jpeg(image):
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=current_app.config['IMAGE_QUALITY'],
+               optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def spool_image(data):
+    """Stores an uploaded image in Redis until it is uploaded, since the RQ
+    workers may not share a file system with the web process. Images are
+    stored by the sha256 of their contents, so concurrent uploads can't
+    overwrite each other and the same image uploaded twice is stored once.
+    Returns the image's key."""
+    key = hashlib.sha256(data).hexdigest()
+    get_connection().setex(
+        name=SPOOL_PREFIX + key, value=data,
+        time=int(current_app.config['IMAGE_SPOOL_TTL'].total_seconds()))
+    return key
+
+
+def attach_uploaded_picture(report, file_storage):
+    """Spools a picture uploaded with the report form. Its upload must be
+    enqueued with enqueue_picture_upload once the report is committed; until
+    then the report shows a pending picture. Returns the image's key."""
+    key = spool_image(file_storage.read())
+    report.picture_pending = True
+    return key
+
+
+def enqueue_picture_upload(report_id, image_key):
+    get_queue().enqueue(upload_report_picture, report_id, image_key)
+
+
+def upload_report_picture(report_id, image_key):
+    """RQ job that processes a spooled picture, stores it and its thumbnail
+    and attaches them to the report."""
+    report = IncidentReport.query.get(report_id)
+    if report is None:
+        return
+
+    data = get_connection().get(SPOOL_PREFIX + image_key)
+    if data is None:
+        current_app.logger.error('Spooled picture %s of report %d expired',
+                                 image_key, report_id)
+        report.picture_pending = False
+        db.session.commit()
+        return
+
+    attach_picture(report, data)
+
+
+def upload_mms_picture(report_id, media_url):
+    """RQ job that downloads a picture texted in with a report from Twilio,
+    then processes and uploads it like upload_report_picture."""
+    report = IncidentReport.query.get(report_id)
+    if report is None:
+        return
+
+    response = http_client.twilio.get(
+        media_url, auth=(current_app.config['TWILIO_ACCOUNT_SID'],
+                         current_app.config['TWILIO_AUTH_TOKEN']))
+    response.raise_for_status()
+    attach_picture(report, response.content)
+
+
+def attach_picture(report, data):
+    """Attaches a picture to the report. A picture that was stored before,
+    going by its sha256 (or its perceptual_hash, if IMAGE_DEDUP_PERCEPTUAL)
+    is reused. Otherwise the picture is processed with process_image, and
+    it and its thumbnail are stored with the IMAGE_STORAGE backend."""
+    digest = hashlib.sha256(data).hexdigest()
+    stored = StoredImage.query.filter_by(sha256=digest).first()
+
+    if stored is None:
+        try:
+            image, thumbnail = process_image(data)
+        except IOError:
+            current_app.logger.error('Picture of report %d is not an image',
+                                     report.id, exc_info=True)
+            report.picture_pending = False
+            db.session.commit()
+            return
+
+        phash = perceptual_hash(thumbnail)
+        if current_app.config['IMAGE_DEDUP_PERCEPTUAL']:
+            stored = StoredImage.query.filter_by(phash=phash).first()
+        if stored is None:
+            stored = store_picture(digest, phash, image, thumbnail)
+
+    report.picture_url = stored.url
+    report.picture_deletehash = stored.deletehash
+    report.picture_thumbnail_url = stored.thumbnail_url
+    report.picture_thumbnail_deletehash = stored.thumbnail_deletehash
+    report.picture_pending = False
+    db.session.commit()
+
+
+def store_picture(sha256, phash, image, thumbnail):
+    """Stores a processed picture and its thumbnail, and adds them to the
+    StoredImage index. Returns their StoredImage."""
+    url, deletehash = upload_image(image_data=image)
+    thumbnail_url, thumbnail_deletehash = upload_image(image_data=thumbnail)
+    stored = StoredImage(sha256=sha256, phash=phash, url=url,
+                         deletehash=deletehash, thumbnail_url=thumbnail_url,
+                         thumbnail_deletehash=thumbnail_deletehash)
+    db.session.add(stored)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another job stored the same picture meanwhile, so use its copy
+        db.session.rollback()
+        stored = StoredImage.query.filter_by(sha256=sha256).one()
+        for handle in (deletehash, thumbnail_deletehash):
+            # Local storage will have stored it in the same file
+            if handle not in (stored.deletehash, stored.thumbnail_deletehash):
+                delete_image(handle)
+    return stored
+
+
+def release_pictures(report):
+    """Enqueues the deletion of the report's picture and thumbnail, unless
+    another report has the same picture, and removes them from the
+    StoredImage index. Called before the report is deleted."""
+    for deletehash in (report.picture_deletehash,
+                       report.picture_thumbnail_deletehash):
+        if deletehash and not IncidentReport.query.filter(
+                IncidentReport.id != report.id,
+                db.or_(IncidentReport.picture_deletehash == deletehash,
+                       IncidentReport.picture_thumbnail_deletehash ==
+                       deletehash)).count():
+            StoredImage.query.filter_by(deletehash=deletehash).delete()
+            get_queue().enqueue(delete_image, deletehash)
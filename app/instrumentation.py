@@ -0,0 +1,119 @@
+import heapq
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RequestStats(object):
+    """The SQL statements run while handling a request."""
+
+    def __init__(self, keep_slowest=3):
+        self.started = time.time()
+        self.queries = 0
+        self.db_time = 0.0
+        self.keep_slowest = keep_slowest
+        self.slowest = []  # min-heap of (duration, statement)
+
+    def record(self, statement, duration):
+        self.queries += 1
+        self.db_time += duration
+        if len(self.slowest) < self.keep_slowest:
+            heapq.heappush(self.slowest, (duration, statement))
+        elif self.slowest and duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (duration, statement))
+
+    def slowest_statements(self):
+        """Returns the slowest (duration, statement) pairs, slowest first."""
+        return sorted(self.slowest, reverse=True)
+
+    def elapsed(self):
+        return time.time() - self.started
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start_time', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start_times = conn.info.get('query_start_time')
+    if not start_times:
+        return
+    duration = time.time() - start_times.pop()
+    if has_request_context():
+        stats = getattr(g, 'db_stats', None)
+        if stats is not None:
+            stats.record(statement, duration)
+
+
+def handle_error(context):
+    # Drop the start time of the failed statement
+    if context.connection is not None:
+        start_times = context.connection.info.get('query_start_time')
+        if start_times:
+            start_times.pop()
+
+
+def instrument_requests(app):
+    """Records the number of SQL statements each request runs, the time
+    spent in them and the slowest ones.
+
+    With DB_STATS_HEADERS (on by default in debug mode) the numbers are sent
+    back in X-DB-Queries, X-DB-Time and X-Request-Time headers, times being
+    in milliseconds. Requests taking longer than SLOW_REQUEST_TIME seconds
+    or running more than SLOW_REQUEST_QUERIES statements, and statements
+    taking longer than SLOW_QUERY_TIME seconds, are logged as warnings.
+    """
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
+
+    @app.before_request
+    def start_db_stats():
+        g.db_stats = RequestStats(app.config.get('DB_STATS_SLOWEST', 3))
+
+    @app.after_request
+    def report_db_stats(response):
+        stats = getattr(g, 'db_stats', None)
+        if stats is None:
+            return response
+        elapsed = stats.elapsed()
+
+        show_headers = app.config.get('DB_STATS_HEADERS')
+        if show_headers or show_headers is None and app.debug:
+            response.headers['X-DB-Queries'] = str(stats.queries)
+            response.headers['X-DB-Time'] = '%.1f' % (stats.db_time * 1000)
+            response.headers['X-Request-Time'] = '%.1f' % (elapsed * 1000)
+
+        log_slow_request(app, stats, elapsed)
+        return response
+
+
+def log_slow_request(app, stats, elapsed):
+    """Logs the request if it is over the configured thresholds."""
+    slow_time = app.config.get('SLOW_REQUEST_TIME')
+    slow_queries = app.config.get('SLOW_REQUEST_QUERIES')
+    slow_query_time = app.config.get('SLOW_QUERY_TIME')
+
+    reasons = []
+    if slow_time is not None and elapsed > slow_time:
+        reasons.append('took %.3fs' % elapsed)
+    if slow_queries is not None and stats.queries > slow_queries:
+        reasons.append('ran %d queries' % stats.queries)
+    if slow_query_time is not None and stats.slowest and \
+            max(stats.slowest)[0] > slow_query_time:
+        reasons.append('ran slow queries')
+    if not reasons:
+        return
+
+    lines = ['Slow request %s %s: %s (%d queries, %.3fs in the database)' % (
+        request.method, request.full_path, ', '.join(reasons), stats.queries,
+        stats.db_time)]
+    for duration, statement in stats.slowest_statements():
+        lines.append('  %.3fs %s' % (duration, ' '.join(statement.split())))
+    app.logger.warning('\n'.join(lines))
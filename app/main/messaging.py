@@ -1,20 +1,16 @@
 import string
 import itertools
-from flask import request, make_response, current_app
+from flask import request, current_app
 from flask.ext.rq import get_queue
 from . import main
-from .. import db
-from ..utils import (
-    geocode,
-    upload_image,
-    attach_image_to_incident_report,
-    url_for_external
-)
+from .. import db, http_client
+from ..cache import RedisStore
+from ..images import upload_mms_picture
+from ..utils import geocode, url_for_external
 from ..models import Agency, IncidentReport, Location, User
 from ..reports.forms import IncidentReportForm
-from datetime import datetime, timedelta
+from datetime import timedelta
 import twilio.twiml
-from twilio.rest import TwilioRestClient
 
 
 STEP_INIT = 0
@@ -28,6 +24,15 @@ STEP_DESCRIPTION = 7
 STEP_PICTURE = 8
 
 
+# The state of each SMS conversation is stored, by the sender's number, as a
+# list of these fields
+CONVERSATION_FIELDS = ['step', 'location', 'lat', 'lng', 'agency_name',
+                       'license_plate', 'vehicle_id', 'duration',
+                       'description']
+
+conversations = RedisStore('sms-conversation:')
+
+
 @main.route('/report_incident', methods=['GET'])  # noqa
 def handle_message():
     """Called by Twilio when a text message is received."""
@@ -40,57 +45,51 @@ def handle_message():
 
     twiml = twilio.twiml.Response()
 
-    # Retrieve incident cookies
-    step = int(request.cookies.get('messagecount', 0))
-    vehicle_id = str(request.cookies.get('vehicle_id', ''))
-    agency_name = str(request.cookies.get('agency_name', ''))
-    license_plate = str(request.cookies.get('license_plate', ''))
-    duration = int(request.cookies.get('duration', 0))
-    description = str(request.cookies.get('description', ''))
-    location = str(request.cookies.get('location', ''))
-    picture_url = str(request.cookies.get('picture_url', ''))
+    conversation = load_conversation(phone_number)
+    step = conversation['step']
 
     if 'report' == body.lower():
-        # reset report variables/cookies
-        vehicle_id = ''
-        agency_name = ''
-        license_plate = ''
-        duration = 0
-        description = ''
-        location = ''
-        picture_url = ''
-
+        # reset the conversation
+        conversation = new_conversation()
         step = handle_start_report(twiml)
 
     elif step == STEP_LOCATION:
-        location, step = handle_location_step(body, step, twiml)
+        (conversation['location'], conversation['lat'], conversation['lng'],
+         step) = handle_location_step(body, step, twiml)
 
     elif step == STEP_AGENCY:
-        agency_name, step = handle_agency_step(body, step, twiml)
+        conversation['agency_name'], step = handle_agency_step(body, step,
+                                                               twiml)
 
     elif step == STEP_OTHER_AGENCY:
-        agency_name, step = handle_other_agency_step(body, step, twiml)
+        conversation['agency_name'], step = handle_other_agency_step(
+            body, step, twiml)
 
     elif step == STEP_LICENSE_PLATE:
-        license_plate, step = handle_license_plate_step(body, step, twiml)
+        conversation['license_plate'], step = handle_license_plate_step(
+            body, step, twiml)
 
     elif step == STEP_VEHICLE_ID:
-        vehicle_id, step = handle_vehicle_id_step(body, step, twiml)
+        conversation['vehicle_id'], step = handle_vehicle_id_step(body, step,
+                                                                  twiml)
 
     elif step == STEP_DURATION:
-        duration, step = handle_duration_step(body, step, twiml)
+        conversation['duration'], step = handle_duration_step(body, step,
+                                                              twiml)
 
     elif step == STEP_DESCRIPTION:
-        description, step = handle_description_step(body, step, twiml)
+        conversation['description'], step = handle_description_step(
+            body, step, twiml)
 
     elif step == STEP_PICTURE:
-        step, image_job_id = handle_picture_step(step, message_sid,
-                                                 twilio_hosted_media_url)
+        new_incident = handle_create_report(
+            conversation['agency_name'], conversation['description'],
+            conversation['duration'], conversation['license_plate'],
+            conversation['location'], conversation['lat'],
+            conversation['lng'], conversation['vehicle_id'], phone_number)
 
-        new_incident = handle_create_report(agency_name, description, duration,
-                                            license_plate, location,
-                                            picture_url, vehicle_id,
-                                            phone_number)
+        handle_picture_step(new_incident, message_sid,
+                            twilio_hosted_media_url)
 
         twiml.message('Thanks! See your report on the map at {}'
                       .format(url_for_external('main.index')))
@@ -103,15 +102,8 @@ def handle_message():
             twiml.message('See all your reports at {}'
                           .format(url_for_external('reports.view_my_reports')))
 
-        if image_job_id is not None:
-            get_queue().enqueue(
-                attach_image_to_incident_report,
-                depends_on=image_job_id,
-                incident_report=new_incident,
-                image_job_id=image_job_id,
-            )
-
-        # reset report variables/cookies
+        # reset the conversation
+        conversation = new_conversation()
         step = STEP_INIT
 
     else:
@@ -119,24 +111,43 @@ def handle_message():
                       'idling incident.'
                       .format(current_app.config['APP_NAME']))
 
-    response = make_response(str(twiml))
+    conversation['step'] = step
+    save_conversation(phone_number, conversation)
 
-    set_cookie(response, 'messagecount', str(step))
-    set_cookie(response, 'agency_name', agency_name)
-    set_cookie(response, 'vehicle_id', vehicle_id)
-    set_cookie(response, 'license_plate', license_plate)
-    set_cookie(response, 'duration', str(duration))
-    set_cookie(response, 'description', description)
-    set_cookie(response, 'location', location)
-    set_cookie(response, 'picture_url', picture_url)
+    return str(twiml)
 
-    return response
+
+def new_conversation():
+    return dict(step=STEP_INIT, location='', lat=None, lng=None,
+                agency_name='', license_plate='', vehicle_id='', duration=0,
+                description='')
+
+
+def load_conversation(phone_number):
+    """Returns the state of the SMS conversation with phone_number, as a
+    dict of CONVERSATION_FIELDS. A new conversation is started if there is
+    none, or it was stored with different fields."""
+    values = conversations.get(phone_number)
+    if values is None or len(values) != len(CONVERSATION_FIELDS):
+        return new_conversation()
+    return dict(zip(CONVERSATION_FIELDS, values))
+
+
+def save_conversation(phone_number, conversation):
+    """Stores the state of the SMS conversation with phone_number until
+    SMS_CONVERSATION_TTL after its last message."""
+    conversations.set(
+        phone_number, [conversation[f] for f in CONVERSATION_FIELDS],
+        current_app.config['SMS_CONVERSATION_TTL'].total_seconds())
 
 
 def handle_create_report(agency_name, description, duration, license_plate,
-                         location, picture_url, vehicle_id, phone_number):
+                         location, lat, lon, vehicle_id, phone_number):
     """Create a report with given fields."""
-    lat, lon = geocode(location)
+    # The location was geocoded in handle_location_step, so this is only
+    # needed if the coordinates were lost along the way.
+    if lat is None or lon is None:
+        lat, lon = geocode(location)
     agency = Agency.get_agency_by_name(agency_name)
     if agency is None:
         agency = Agency(name=agency_name, is_official=False,
@@ -155,7 +166,6 @@ def handle_create_report(agency_name, description, duration, license_plate,
             longitude=lon,
             original_user_text=location
         ),
-        picture_url=picture_url if picture_url else None,
         user=User.query.filter_by(phone_number=phone_number).first()
     )
     db.session.add(new_incident)
@@ -181,6 +191,7 @@ def handle_location_step(body, step, twiml):
 
     if len(errors) == 0:
         location = body
+        lat, lng = validator_form.location.coordinates
         step = STEP_AGENCY
         agencies = Agency.query.filter_by(is_official=True).order_by(
             Agency.name).all()
@@ -191,10 +202,10 @@ def handle_location_step(body, step, twiml):
                       .format(letters[-1]))
         twiml.message(agencies_listed)
     else:
-        location = ''
+        location, lat, lng = '', None, None
         reply_with_errors(errors, twiml, 'location')
 
-    return location, step
+    return location, lat, lng, step
 
 
 def handle_agency_step(body_upper, step, twiml):
@@ -314,30 +325,26 @@ def handle_description_step(body, step, twiml):
     return description, step
 
 
-def handle_picture_step(step, message_sid, twilio_hosted_media_url):
-    """Handle a message from the user containing the report's picture."""
-    image_job_id = None
-    if twilio_hosted_media_url is not None:
-        account_sid = current_app.config['TWILIO_ACCOUNT_SID']
-        auth_token = current_app.config['TWILIO_AUTH_TOKEN']
+def handle_picture_step(incident_report, message_sid,
+                        twilio_hosted_media_url):
+    """Handle a message from the user containing the report's picture. The
+    picture is processed and stored in the background, then deleted from
+    Twilio."""
+    if twilio_hosted_media_url is None:
+        return
 
-        image_job_id = get_queue().enqueue(
-            upload_image,
-            imgur_client_id=current_app.config['IMGUR_CLIENT_ID'],
-            imgur_client_secret=current_app.config['IMGUR_CLIENT_SECRET'],
-            app_name=current_app.config['APP_NAME'],
-            image_url=twilio_hosted_media_url
-        ).id
-
-        get_queue().enqueue(
-            delete_mms,
-            depends_on=image_job_id,
-            account_sid=account_sid,
-            auth_token=auth_token,
-            message_sid=message_sid
-        )
+    incident_report.picture_pending = True
+    db.session.commit()
 
-    return step, image_job_id
+    upload_job = get_queue().enqueue(upload_mms_picture, incident_report.id,
+                                     twilio_hosted_media_url)
+    get_queue().enqueue(
+        delete_mms,
+        depends_on=upload_job,
+        account_sid=current_app.config['TWILIO_ACCOUNT_SID'],
+        auth_token=current_app.config['TWILIO_AUTH_TOKEN'],
+        message_sid=message_sid
+    )
 
 
 def reply_with_errors(errors, twiml, field_name):
@@ -349,9 +356,15 @@ def reply_with_errors(errors, twiml, field_name):
 
 def delete_mms(account_sid, auth_token, message_sid):
     """Deletes the media attached to the given message from Twilio."""
-    client = TwilioRestClient(account_sid, auth_token)
-    for media in client.messages.get(message_sid).media_list.list():
-        media.delete()
+    url = 'https://api.twilio.com/2010-04-01/Accounts/{}/Messages/{}/Media' \
+        .format(account_sid, message_sid)
+    auth = (account_sid, auth_token)
+    response = http_client.twilio.get(url + '.json', auth=auth)
+    response.raise_for_status()
+    for media in response.json()['media_list']:
+        http_client.twilio.delete(
+            '{}/{}.json'.format(url, media['sid']), auth=auth
+        ).raise_for_status()
 
 
 def get_agencies_listed(agencies, letters):
@@ -386,13 +399,6 @@ def all_strings(max_count):
         repeat_size += 1
 
 
-def set_cookie(resp, key, val, expiration=1):
-    """Sets a expiring cookie in the response."""
-    expires = datetime.utcnow() + timedelta(hours=expiration)
-    expires_str = expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
-    resp.set_cookie(key, value=val, expires=expires_str)
-
-
 def data_errors(field, data, form):
     """Return errors in given data using a WTForm field."""
     field.data = data
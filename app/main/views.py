@@ -2,14 +2,13 @@ import pytz
 
 from datetime import timedelta, datetime
 
-from flask import render_template, current_app, flash
-from werkzeug import secure_filename
+from flask import render_template, current_app, flash, send_from_directory
 
 from . import main
 from app import models, db
 from app.reports.forms import IncidentReportForm
 from app.models import IncidentReport, Agency, EditableHTML
-from app.utils import upload_image, geocode
+from app.images import attach_uploaded_picture, enqueue_picture_upload
 
 
 @main.route('/error', methods=['GET', 'POST'])
@@ -21,14 +20,15 @@ def cause_error():
 @main.route('/map', methods=['GET', 'POST'])
 def index():
     form = IncidentReportForm()
-    agencies = Agency.query.all()
 
     if form.validate_on_submit():
 
-        # If geocode happened client-side, it's not necessary to geocode again.
-        lat, lng = form.latitude.data, form.longitude.data
-        if not lat or not lng:
-            lat, lng = geocode(form.location.data)
+        # If geocode happened client-side, use those coordinates. Otherwise
+        # use the ones found while validating the location.
+        try:
+            lat, lng = float(form.latitude.data), float(form.longitude.data)
+        except (TypeError, ValueError):
+            lat, lng = form.location.coordinates
 
         l = models.Location(original_user_text=form.location.data,
                             latitude=lat,
@@ -55,24 +55,17 @@ def index():
             description=form.description.data,
         )
 
+        image_key = None
         if form.picture_file.data.filename:
-            filepath = secure_filename(form.picture_file.data.filename)
-            form.picture_file.data.save(filepath)
-
-            # synchronously upload image because heroku resets the file system
-            # after the request
-            link, deletehash = upload_image(
-                imgur_client_id=current_app.config['IMGUR_CLIENT_ID'],
-                imgur_client_secret=current_app.config['IMGUR_CLIENT_SECRET'],
-                app_name=current_app.config['APP_NAME'],
-                image_file_path=filepath
-            )
-
-            new_incident.picture_url = link
-            new_incident.picture_deletehash = deletehash
+            image_key = attach_uploaded_picture(new_incident,
+                                                form.picture_file.data)
 
         db.session.add(new_incident)
         db.session.commit()
+
+        # The picture is stored in the background
+        if image_key is not None:
+            enqueue_picture_upload(new_incident.id, image_key)
         flash('Report successfully submitted.', 'success')
 
     # pre-populate form
@@ -82,10 +75,13 @@ def index():
         current_app.config['TIMEZONE']))
     form.process()
 
+    # Markers are fetched from the api as the map is panned; only the date of
+    # the oldest report is needed to set up the date slider.
+    min_date = db.session.query(db.func.min(IncidentReport.date)).scalar()
+
     return render_template('main/map.html',
-                           agencies=agencies,
                            form=form,
-                           incident_reports=IncidentReport.query.all())
+                           min_date=min_date)
 
 
 @main.route('/about')
@@ -100,3 +96,13 @@ def faq():
     editable_html_obj = EditableHTML.get_editable_html('faq')
     return render_template('main/faq.html',
                            editable_html_obj=editable_html_obj)
+
+
+@main.route('/images/<path:filename>')
+def stored_image(filename):
+    """Pictures stored by app.storage.LocalStorage. They're named by their
+    contents, so they can be cached forever."""
+    return send_from_directory(current_app.config['IMAGE_STORAGE_PATH'],
+                               filename,
+                               cache_timeout=int(timedelta(days=365)
+                                                 .total_seconds()))
@@ -0,0 +1,180 @@
+import math
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+
+from flask import g, has_request_context, request
+
+
+def log_linear_bounds(lowest, highest, steps_per_doubling):
+    """Bucket upper bounds from lowest to at least highest, growing by a
+    constant factor as in an HDR histogram: the bucket a value falls in is
+    within 2 ** (1 / steps_per_doubling) of it, however large it is."""
+    steps = int(math.ceil(math.log(float(highest) / lowest, 2) *
+                          steps_per_doubling - 1e-9))
+    return [lowest * 2 ** (float(i) / steps_per_doubling)
+            for i in range(steps + 1)]
+
+
+# Latency bucket bounds in seconds, from 1ms to about a minute, each about
+# 19% wider than the last
+LATENCY_BOUNDS = log_linear_bounds(0.001, 65.536, 4)
+
+
+class Histogram(object):
+    """Counts of observed values by bucket, with their sum. Safe to update
+    from several threads."""
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last is for overflow
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def cumulative_counts(self):
+        """Returns a list of (upper bound, number of values at most it),
+        ending with (inf, count)."""
+        with self.lock:
+            counts = list(self.counts)
+        total = 0
+        cumulative = []
+        for bound, count in zip(self.bounds + [float('inf')], counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+class LatencyMetrics(object):
+    """A family of latency histograms, one for each combination of label
+    values. Kept in memory, so each server process has its own."""
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.histograms = {}
+        self.lock = Lock()
+
+    def observe(self, labels, seconds):
+        """Records a latency. labels is a tuple of label values."""
+        histogram = self.histograms.get(labels)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(labels, Histogram())
+        histogram.observe(seconds)
+
+    def get(self, *labels):
+        return self.histograms.get(labels)
+
+    def clear(self):
+        with self.lock:
+            self.histograms = {}
+
+    def prometheus_text(self):
+        """The histograms in the Prometheus text exposition format."""
+        name = self.name
+        lines = [
+            '# HELP {} {}'.format(name, self.description),
+            '# TYPE {} histogram'.format(name),
+        ]
+        for values, histogram in sorted(self.histograms.items()):
+            labels = ','.join('{}="{}"'.format(label_name, value)
+                              for label_name, value
+                              in zip(self.label_names, values))
+            cumulative = histogram.cumulative_counts()
+            for bound, total in cumulative:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    name, labels, le, total))
+            lines.append('{}_sum{{{}}} {!r}'.format(name, labels,
+                                                    histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, labels,
+                                                    cumulative[-1][1]))
+        return '\n'.join(lines) + '\n'
+
+
+latency = LatencyMetrics('request_duration_seconds',
+                         'Request latency by endpoint and phase.',
+                         ['endpoint', 'phase'])
+
+# Calls to other services, by upstream and outcome: the status class of the
+# response (e.g. 2xx), timeout or connection_error
+upstream_latency = LatencyMetrics(
+    'upstream_request_duration_seconds',
+    'Latency of calls to other services by upstream and outcome.',
+    ['upstream', 'outcome'])
+
+ALL_METRICS = [latency, upstream_latency]
+
+
+def prometheus_text():
+    """All the metrics in the Prometheus text exposition format."""
+    return ''.join(metrics.prometheus_text() for metrics in ALL_METRICS)
+
+
+def add_phase_time(phase, seconds):
+    """Adds to the time the current request has spent in a phase."""
+    if has_request_context():
+        phase_times = getattr(g, 'phase_times', None)
+        if phase_times is not None:
+            phase_times[phase] += seconds
+
+
+@contextmanager
+def timed_phase(phase):
+    """Counts the time spent in the block towards a phase of the current
+    request, e.g. with timed_phase('http') around calls to other services."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.time() - start)
+
+
+def record_request_metrics(app):
+    """Records each request's latency, and the time it spent in the
+    database (as counted by app.instrumentation), calling other services
+    and rendering templates, by endpoint."""
+    wrap_template_rendering(app)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.time()
+        g.phase_times = defaultdict(float)
+
+    # Runs after the response has been sent when it is streamed
+    @app.teardown_request
+    def record_request_latency(exc):
+        started = getattr(g, 'request_started', None)
+        if started is None:
+            return
+        endpoint = request.endpoint or 'unmatched'
+        latency.observe((endpoint, 'total'), time.time() - started)
+
+        db_stats = getattr(g, 'db_stats', None)
+        if db_stats is not None:
+            latency.observe((endpoint, 'db'), db_stats.db_time)
+        for phase in ['http', 'template']:
+            latency.observe((endpoint, phase), g.phase_times[phase])
+
+
+def wrap_template_rendering(app):
+    """Makes the app's templates count their rendering time towards the
+    template phase. Included and extended templates are rendered as part of
+    the template that uses them, so they are not counted twice."""
+    base = app.jinja_env.template_class
+
+    class TimedTemplate(base):
+        def render(self, *args, **kwargs):
+            with timed_phase('template'):
+                return base.render(self, *args, **kwargs)
+
+    app.jinja_env.template_class = TimedTemplate
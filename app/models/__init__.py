@@ -7,3 +7,5 @@ from agency import *  # noqa
 from user import *  # noqa
 from incident_report import *  # noqa
 from miscellaneous import *  # noqa
+from geocode import *  # noqa
+from stored_image import *  # noqa
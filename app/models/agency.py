@@ -28,8 +28,10 @@ class Agency(db.Model):
     # configure this relationship.
     users = db.relationship('User', secondary=agency_user_table,
                             backref='agencies', lazy='select')
+    # An agency can have many thousands of reports, so they are queried
+    # rather than loaded with the agency.
     incident_reports = db.relationship('IncidentReport', backref='agency',
-                                       lazy='joined')
+                                       lazy='dynamic')
 
     def __init__(self, **kwargs):
         super(Agency, self).__init__(**kwargs)
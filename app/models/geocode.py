@@ -0,0 +1,93 @@
+import hashlib
+
+from datetime import datetime
+from flask import current_app
+from .. import db
+from ..utils import normalize_address
+
+
+class GeocodeResult(db.Model):
+    """Cached result of geocoding an address. Failed geocodes are cached too,
+    with null coordinates and a shorter lifetime."""
+    __tablename__ = 'geocode_results'
+    id = db.Column(db.Integer, primary_key=True)
+
+    # sha1 of the normalized address and the viewport it was geocoded in
+    key = db.Column(db.String(40), index=True)
+    address = db.Column(db.Text)  # the normalized address
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    expires = db.Column(db.DateTime, index=True)
+
+    @staticmethod
+    def cache_key(address, viewport):
+        key = u'{}|{}'.format(normalize_address(address), viewport)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def lookup(address, viewport):
+        """Returns the unexpired cached result for address, or None."""
+        return GeocodeResult.query \
+            .filter_by(key=GeocodeResult.cache_key(address, viewport)) \
+            .filter(GeocodeResult.expires > datetime.utcnow()) \
+            .order_by(GeocodeResult.expires.desc()) \
+            .first()
+
+    @staticmethod
+    def lookup_many(addresses, viewport, chunk_size=500):
+        """Returns a dict from cache key to unexpired cached result for the
+        given addresses, looked up a chunk of addresses at a time."""
+        keys = list(set(GeocodeResult.cache_key(a, viewport)
+                        for a in addresses))
+        results = {}
+        for i in range(0, len(keys), chunk_size):
+            query = GeocodeResult.query \
+                .filter(GeocodeResult.key.in_(keys[i:i + chunk_size])) \
+                .filter(GeocodeResult.expires > datetime.utcnow()) \
+                .order_by(GeocodeResult.expires)
+            # Later (longer lived) results overwrite earlier ones
+            for result in query:
+                results[result.key] = result
+        return results
+
+    @staticmethod
+    def store(address, viewport, latitude, longitude):
+        """Cache a geocoding result. The entry is added to the session but
+        not committed, so that geocoding never commits a caller's
+        half-finished changes."""
+        if latitude is None or longitude is None:
+            ttl = current_app.config['GEOCODE_NEGATIVE_CACHE_TTL']
+        else:
+            ttl = current_app.config['GEOCODE_CACHE_TTL']
+        result = GeocodeResult(
+            key=GeocodeResult.cache_key(address, viewport),
+            address=normalize_address(address),
+            latitude=latitude,
+            longitude=longitude,
+            expires=datetime.utcnow() + ttl
+        )
+        db.session.add(result)
+        return result
+
+    @staticmethod
+    def evict(max_entries=None):
+        """Delete expired results and, if max_entries is given, the results
+        closest to expiring beyond that many. Returns the number deleted."""
+        deleted = GeocodeResult.query \
+            .filter(GeocodeResult.expires <= datetime.utcnow()) \
+            .delete(synchronize_session=False)
+
+        if max_entries is not None:
+            cutoff = db.session.query(GeocodeResult.expires) \
+                .order_by(GeocodeResult.expires.desc()) \
+                .offset(max_entries).limit(1).scalar()
+            if cutoff is not None:
+                deleted += GeocodeResult.query \
+                    .filter(GeocodeResult.expires <= cutoff) \
+                    .delete(synchronize_session=False)
+
+        db.session.commit()
+        return deleted
+
+    def __repr__(self):
+        return '<GeocodeResult \'%s\'>' % self.address
@@ -1,28 +1,154 @@
+import math
 import pytz
 
 from datetime import datetime, timedelta
 from flask import current_app
-from flask.ext.rq import get_queue
+from flask.ext.rq import get_connection, get_queue
+from redis import RedisError
+from sqlalchemy import DDL, event
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ColumnElement
 from .. import db
 from . import Agency, User
 from ..email import send_email
+from ..rate_limit import RedisRateLimiter
 from ..utils import get_current_weather, url_for_external
 
 
+# Meters in a degree of latitude
+METERS_PER_DEGREE = 111320
+
+
 class Location(db.Model):
     __tablename__ = 'locations'
     id = db.Column(db.Integer, primary_key=True)
-    latitude = db.Column(db.String(50))
-    longitude = db.Column(db.String(50))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
     # TODO: ensure original_user_text is always non-null
     original_user_text = db.Column(db.Text)  # the raw text which we geocoded
     incident_report_id = db.Column(db.Integer,
                                    db.ForeignKey('incident_reports.id'))
 
+    # Databases without a spatial index below can still range scan latitude
+    __table_args__ = (
+        db.Index('ix_locations_latitude_longitude', 'latitude', 'longitude'),
+    )
+
+    @staticmethod
+    def within_bounds(south, west, north, east):
+        """Filter criterion for locations inside a bounding box, which uses
+        the spatial index where there is one."""
+        return WithinBounds(south, west, north, east)
+
+    @staticmethod
+    def within_radius(latitude, longitude, meters):
+        """Filter criterion for locations within meters of a point. Distances
+        use an equirectangular approximation, which is plenty accurate at the
+        scale of a city."""
+        dlat = float(meters) / METERS_PER_DEGREE
+        dlng = dlat / math.cos(math.radians(latitude))
+        y = (Location.latitude - latitude) / dlat
+        x = (Location.longitude - longitude) / dlng
+        return db.and_(
+            Location.within_bounds(latitude - dlat, longitude - dlng,
+                                   latitude + dlat, longitude + dlng),
+            x * x + y * y <= 1
+        )
+
     def __repr__(self):
         return str(self.original_user_text)
 
 
+class WithinBounds(ColumnElement):
+    """Location is inside a bounding box. Compiled for each database to use
+    its spatial index."""
+    type = db.Boolean()
+
+    def __init__(self, south, west, north, east):
+        self.south, self.west, self.north, self.east = \
+            south, west, north, east
+
+    def between(self):
+        return db.and_(Location.latitude.between(self.south, self.north),
+                       Location.longitude.between(self.west, self.east))
+
+
+@compiles(WithinBounds)
+def compile_within_bounds(element, compiler, **kw):
+    return compiler.process(element.between(), **kw)
+
+
+@compiles(WithinBounds, 'postgresql')
+def compile_within_bounds_postgresql(element, compiler, **kw):
+    # Matches the expression of the ix_locations_point GiST index
+    point = db.func.point(Location.longitude, Location.latitude)
+    box = db.func.box(db.func.point(element.west, element.south),
+                      db.func.point(element.east, element.north))
+    return compiler.process(point.op('<@')(box), **kw)
+
+
+# R-tree of location coordinates for SQLite, kept up to date by triggers
+locations_rtree = db.Table(
+    'locations_rtree', db.MetaData(),
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('min_latitude', db.Float),
+    db.Column('max_latitude', db.Float),
+    db.Column('min_longitude', db.Float),
+    db.Column('max_longitude', db.Float)
+)
+
+
+@compiles(WithinBounds, 'sqlite')
+def compile_within_bounds_sqlite(element, compiler, **kw):
+    # The R-tree stores 32-bit floats rounded outwards, so it finds a
+    # superset of the locations, which are then checked exactly
+    rtree = locations_rtree.c
+    candidates = db.select([rtree.id]).where(db.and_(
+        rtree.max_latitude >= element.south,
+        rtree.min_latitude <= element.north,
+        rtree.max_longitude >= element.west,
+        rtree.min_longitude <= element.east
+    ))
+    return compiler.process(db.and_(Location.id.in_(candidates),
+                                    element.between()), **kw)
+
+
+SPATIAL_INDEX_DDL = {
+    'postgresql': [
+        'CREATE INDEX ix_locations_point ON locations '
+        'USING gist (point(longitude, latitude))',
+    ],
+    'sqlite': [
+        'CREATE VIRTUAL TABLE IF NOT EXISTS locations_rtree USING rtree('
+        'id, min_latitude, max_latitude, min_longitude, max_longitude)',
+
+        'CREATE TRIGGER locations_rtree_insert AFTER INSERT ON locations '
+        'WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN '
+        'INSERT INTO locations_rtree VALUES (new.id, new.latitude, '
+        'new.latitude, new.longitude, new.longitude); END',
+
+        'CREATE TRIGGER locations_rtree_update AFTER UPDATE OF latitude, '
+        'longitude ON locations BEGIN '
+        'DELETE FROM locations_rtree WHERE id = old.id; '
+        'INSERT INTO locations_rtree SELECT new.id, new.latitude, '
+        'new.latitude, new.longitude, new.longitude '
+        'WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL; END',
+
+        'CREATE TRIGGER locations_rtree_delete AFTER DELETE ON locations '
+        'BEGIN DELETE FROM locations_rtree WHERE id = old.id; END',
+    ],
+}
+
+for dialect, statements in SPATIAL_INDEX_DDL.items():
+    for statement in statements:
+        event.listen(Location.__table__, 'after_create',
+                     DDL(statement).execute_if(dialect=dialect))
+event.listen(Location.__table__, 'after_drop',
+             DDL('DROP TABLE IF EXISTS locations_rtree')
+             .execute_if(dialect='sqlite'))
+
+
 class IncidentReport(db.Model):
     __tablename__ = 'incident_reports'
     id = db.Column(db.Integer, primary_key=True)
@@ -34,15 +160,22 @@ class IncidentReport(db.Model):
                                uselist=False,
                                lazy='joined',
                                backref='incident_report')
-    date = db.Column(db.DateTime)  # datetime object
+    date = db.Column(db.DateTime, index=True)  # datetime object
     duration = db.Column(db.Interval)  # timedelta object
     agency_id = db.Column(db.Integer, db.ForeignKey('agencies.id'))
     picture_url = db.Column(db.Text)
 
-    # Should never be exposed to the user. This is the Imgur deletehash, so
-    # we can delete an image from Imgur in case of problems (e.g.
-    # legal issues).
+    # Should never be exposed to the user. This is the deletehash given by
+    # app.storage.upload_image, so we can delete an image in case of
+    # problems (e.g. legal issues).
     picture_deletehash = db.Column(db.Text)
+    # A small preview of the picture, and its deletehash. Pictures
+    # linked by url rather than uploaded have no thumbnail.
+    picture_thumbnail_url = db.Column(db.Text)
+    picture_thumbnail_deletehash = db.Column(db.Text)
+    # True while a picture sent with the report is being processed and
+    # stored by an RQ job (see app.images)
+    picture_pending = db.Column(db.Boolean, default=False)
     description = db.Column(db.Text)
     weather = db.Column(db.Text)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -64,12 +197,6 @@ class IncidentReport(db.Model):
                 current_app.config['TIMEZONE']))
             self.date = self.date.replace(tzinfo=None)
 
-        now = datetime.now(pytz.timezone(
-                current_app.config['TIMEZONE'])).replace(tzinfo=None)
-        if self.weather is None and self.location is not None and \
-                (now - self.date < timedelta(minutes=1)):
-            self.weather = get_current_weather(self.location)
-
         self.description = self.description.replace('\n', ' ').strip()
         self.description = self.description.replace('\r', ' ').strip()
 
@@ -107,6 +234,46 @@ class IncidentReport(db.Model):
                     index_page_link=index_page_link
                 )
 
+    def needs_weather(self):
+        """True if this report was just made, so that the current weather at
+        its location is the weather at the time of the report."""
+        now = datetime.now(pytz.timezone(
+            current_app.config['TIMEZONE'])).replace(tzinfo=None)
+        return self.weather is None and self.location is not None and \
+            now - self.date < timedelta(minutes=1)
+
+    @staticmethod
+    def listing_query(agency_ids=None, user_id=None, after=None,
+                      oldest_first=False):
+        """Query for reports newest first (or oldest first), optionally only
+        those of the given agencies or user.
+
+        after is a keyset cursor, the (date, id) of the last report of the
+        previous page; only reports listed after it are returned. The
+        ordering is served by the date indexes, so no sort is needed and
+        pages are as fast to fetch at the end of the list as at the start.
+        """
+        query = IncidentReport.query
+        if agency_ids is not None:
+            query = query.filter(IncidentReport.agency_id.in_(agency_ids)
+                                 if agency_ids else db.false())
+        if user_id is not None:
+            query = query.filter(IncidentReport.user_id == user_id)
+
+        date, report_id = IncidentReport.date, IncidentReport.id
+        if after is not None:
+            after_date, after_id = after
+            if oldest_first:
+                query = query.filter(date >= after_date, db.or_(
+                    date > after_date, report_id > after_id))
+            else:
+                query = query.filter(date <= after_date, db.or_(
+                    date < after_date, report_id < after_id))
+
+        if oldest_first:
+            return query.order_by(date, report_id)
+        return query.order_by(date.desc(), report_id.desc())
+
     @staticmethod
     def generate_fake(count=100, **kwargs):
         """Generate a number of fake reports for testing."""
@@ -135,10 +302,10 @@ class IncidentReport(db.Model):
         for i in range(count):
             l = Location(
                 original_user_text=fake.address(),
-                latitude=str(fake.geo_coordinate(center=39.951021,
-                                                 radius=0.01)),
-                longitude=str(fake.geo_coordinate(center=-75.197243,
-                                                  radius=0.01))
+                latitude=float(fake.geo_coordinate(center=39.951021,
+                                                   radius=0.01)),
+                longitude=float(fake.geo_coordinate(center=-75.197243,
+                                                    radius=0.01))
             )
             r = IncidentReport(
                 vehicle_id=rand_alphanumeric(6),
@@ -160,3 +327,63 @@ class IncidentReport(db.Model):
                 db.session.commit()
             except IntegrityError:
                 db.session.rollback()
+
+
+# Reports listed newest first for an agency or a user
+db.Index('ix_incident_reports_agency_id_date', IncidentReport.agency_id,
+         IncidentReport.date.desc(), IncidentReport.id.desc())
+db.Index('ix_incident_reports_user_id_date', IncidentReport.user_id,
+         IncidentReport.date.desc(), IncidentReport.id.desc())
+
+
+# The weather of new reports is looked up by an RQ job once they are
+# committed, so that making a report doesn't wait on the weather service.
+
+def collect_weather_reports(session, flush_context):
+    report_ids = session.info.setdefault('weather_report_ids', [])
+    report_ids.extend(obj.id for obj in session.new
+                      if isinstance(obj, IncidentReport) and
+                      obj.needs_weather())
+
+
+def enqueue_weather_jobs(session):
+    for report_id in session.info.pop('weather_report_ids', []):
+        try:
+            get_queue().enqueue(fill_in_weather, report_id)
+        except RedisError:
+            current_app.logger.exception(
+                'Could not enqueue the weather lookup for report %d',
+                report_id)
+
+
+def forget_weather_reports(session, previous_transaction):
+    session.info.pop('weather_report_ids', None)
+
+
+event.listen(Session, 'after_flush', collect_weather_reports)
+event.listen(Session, 'after_commit', enqueue_weather_jobs)
+event.listen(Session, 'after_soft_rollback', forget_weather_reports)
+
+
+def fill_in_weather(report_id):
+    """RQ job that fills in the weather of a new report. Lookups that miss
+    the weather cache are limited to WEATHER_RATE_LIMIT a minute for all
+    workers together."""
+    report = IncidentReport.query.get(report_id)
+    if report is None or report.weather is not None or \
+            report.location is None:
+        return
+    # e.g. an SMS report whose location couldn't be geocoded
+    if report.location.latitude is None or report.location.longitude is None:
+        return
+
+    weather = get_current_weather(report.location, RedisRateLimiter(
+        get_connection(), 'rate_limit:weather',
+        current_app.config['WEATHER_RATE_LIMIT']))
+    if weather is None:
+        return
+
+    # Don't overwrite weather set since the report was loaded
+    IncidentReport.query.filter_by(id=report_id, weather=None) \
+        .update({'weather': weather}, synchronize_session=False)
+    db.session.commit()
@@ -24,3 +24,18 @@ class EditableHTML(db.Model):
         )
         db.session.add(faq_editable_html)
         db.session.commit()
+
+
+class ImportCheckpoint(db.Model):
+    """Progress of a csv import, committed along with each batch of rows so
+    that an interrupted import can be resumed."""
+    __tablename__ = 'import_checkpoints'
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.Text)
+    file_hash = db.Column(db.String(40), unique=True)  # sha1 of the file
+    last_row = db.Column(db.Integer)  # last row number imported or rejected
+    updated = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<ImportCheckpoint \'%s\' row %d>' % (self.filename,
+                                                     self.last_row)
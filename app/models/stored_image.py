@@ -0,0 +1,25 @@
+from .. import db
+
+
+class StoredImage(db.Model):
+    """A picture stored with app.storage.upload_image, indexed by the hash of
+    the uploaded image so that reports sent with the same picture share one
+    stored copy (see app.images.attach_picture). Deleted along with the
+    stored images once no report uses it."""
+    __tablename__ = 'stored_images'
+    id = db.Column(db.Integer, primary_key=True)
+
+    # sha256 of the picture as uploaded, before it was processed
+    sha256 = db.Column(db.String(64), unique=True, index=True)
+    # Difference hash of the processed picture (see
+    # app.images.perceptual_hash), which is the same for pictures that look
+    # alike but were encoded differently
+    phash = db.Column(db.String(16), index=True)
+
+    url = db.Column(db.Text)
+    deletehash = db.Column(db.Text, index=True)
+    thumbnail_url = db.Column(db.Text)
+    thumbnail_deletehash = db.Column(db.Text)
+
+    def __repr__(self):
+        return '<StoredImage \'%s\'>' % self.url
@@ -66,7 +66,7 @@ class User(UserMixin, db.Model):
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
     incident_reports = db.relationship('IncidentReport',
                                        backref='user',
-                                       lazy='select')
+                                       lazy='dynamic')
     # also related to agencies via the agency_user_table
 
     def __init__(self, **kwargs):
@@ -1,121 +1,373 @@
 import csv
-import functools
+import hashlib
+import os
+from cStringIO import StringIO
+from collections import deque
 from datetime import datetime
-from app.utils import geocode, strip_non_alphanumeric_chars
-from app.models import Location, Agency, IncidentReport
+from itertools import islice
+from multiprocessing import Pool
+from flask import current_app
+from app.batch_geocode import batch_geocode
+from app.utils import strip_non_alphanumeric_chars
+from app.models import Location, Agency, IncidentReport, ImportCheckpoint
 from app.reports.forms import IncidentReportForm
 
+# The indices in the csv of different data
+VEHICLE_ID_INDEX = 8
+LICENSE_PLATE_INDEX = 9
+LOCATION_INDEX = 4
+DATE_INDEX = 0
+AGENCY_INDEX = 6
+PICTURE_INDEX = 13
+DESCRIPTION_INDEX = 11
 
-def parse_to_db(db, filename):
-    """Reads a csv and imports the data into a database."""
-    # The indices in the csv of different data
-    vehicle_id_index = 8
-    license_plate_index = 9
-    location_index = 4
-    date_index = 0
-    agency_index = 6
-    picture_index = 13
-    description_index = 11
 
-    validator_form = IncidentReportForm()
+class ImportRow(object):
+    """A csv row on its way through the import pipeline. Stages fill in
+    report, and set error if the row is rejected; later stages pass rejected
+    rows through untouched."""
+
+    def __init__(self, number, values):
+        self.number = number  # row number in the file, the header being 1
+        self.values = values
+        self.report = None  # dict of IncidentReport columns
+        self.error = None
+
+
+def parse_to_db(db, filename, batch_size=1000, resume=False, workers=1):
+    """Streams a csv into the database. Rows are parsed, validated, geocoded
+    and written batch_size at a time. Each batch is committed along with a
+    checkpoint, so that with resume an interrupted import of the same file
+    continues where it left off. Rejected rows are written with the reasons
+    to filename.rejected.csv.
+
+    With more than one worker, rows are parsed and validated by a pool of
+    that many processes, and geocoded and written by this one."""
+    file_hash = hash_file(filename)
+    checkpoint = ImportCheckpoint.query.filter_by(file_hash=file_hash).first()
+    if checkpoint is None:
+        checkpoint = ImportCheckpoint(file_hash=file_hash)
+    if checkpoint.last_row is None or not resume:
+        checkpoint.last_row = 1
+    checkpoint.filename = filename
+
+    rejected = RejectedRowWriter(filename + '.rejected.csv',
+                                 append=checkpoint.last_row > 1)
 
     with open(filename, 'rb') as csv_file:
         reader = csv.reader(csv_file)
         columns = reader.next()
+        rejected.columns = columns
 
-        for i, row in enumerate(reader, start=2):  # i is the row number
+        if workers > 1:
+            rows = validate_rows_parallel(filename, checkpoint.last_row,
+                                          workers)
+        else:
+            rows = validate_rows(read_rows(reader, checkpoint.last_row))
+        batches = geocode_batches(chunks(rows, batch_size))
+        persist_batches(db, batches, checkpoint, rejected)
 
-            address_text = row[location_index]
-            coords = geocode(address_text)
+    rejected.close()
+    return columns
 
-            # Ignore rows that do not have correct geocoding
-            if coords[0] is None or coords[1] is None:
-                print_error(i, 'Failed to geocode "{:s}"'.format(address_text))
 
-            # Insert correctly geocoded row to database
+def read_rows(reader, last_row, first_number=2):
+    """Parse stage. Yields the rows of the csv after row number last_row,
+    numbering them from first_number."""
+    for number, values in enumerate(reader, start=first_number):
+        if number > last_row:
+            yield ImportRow(number, values)
+
+
+def validate_rows(rows):
+    """Validate stage. Cleans up each row's fields and checks them with the
+    incident report form."""
+    form = IncidentReportForm()
+
+    for row in rows:
+        values = row.values
+        vehicle_id_text = values[VEHICLE_ID_INDEX].strip()
+        license_plate_text = values[LICENSE_PLATE_INDEX].strip()
+
+        # If the license plate is too short, just ignore it
+        if len(strip_non_alphanumeric_chars(license_plate_text)) < 3:
+            license_plate_text = ''
+
+        errors = []
+        errors += validate_field(form, form.vehicle_id, vehicle_id_text)
+        errors += validate_field(form, form.description,
+                                 values[DESCRIPTION_INDEX])
+        errors += validate_field(form, form.picture_url, values[PICTURE_INDEX])
+
+        try:
+            time1, time2 = parse_start_end_time(DATE_INDEX, values)
+        except ValueError as e:
+            errors.append(str(e))
+
+        if errors:
+            row.error = '; '.join(errors)
+            yield row
+            continue
+
+        # Assign correct agency name
+        agency_name = values[AGENCY_INDEX].rstrip()
+        if agency_name.upper() == 'OTHER':
+            agency_name = values[AGENCY_INDEX + 1].rstrip()
+
+        vehicle_id_text = strip_non_alphanumeric_chars(vehicle_id_text)
+        license_plate_text = strip_non_alphanumeric_chars(license_plate_text)
+
+        row.report = dict(
+            vehicle_id=vehicle_id_text if len(vehicle_id_text) > 0 else None,
+            license_plate=license_plate_text if len(license_plate_text) > 0
+            else None,
+            date=time1,
+            duration=time2 - time1,
+            agency_name=agency_name,
+            picture_url=values[PICTURE_INDEX],
+            description=values[DESCRIPTION_INDEX]
+            .replace('\n', ' ').replace('\r', ' ').strip()
+        )
+        yield row
+
+
+def validate_rows_parallel(filename, last_row, workers):
+    """Parse and validate stages, run on shards of the csv by a pool of
+    worker processes. Yields the rows in order, with at most two shards per
+    worker in flight at a time."""
+    pool = Pool(workers, initializer=init_worker,
+                initargs=(current_app._get_current_object(),))
+    try:
+        shards = ((filename, start, end, first_number, last_row)
+                  for start, end, first_number, end_number
+                  in shard_file(filename) if end_number > last_row)
+        for rows in ordered_map(pool, validate_shard, shards, 2 * workers):
+            for row in rows:
+                yield row
+    except BaseException:
+        # Including GeneratorExit, if the caller stops early
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+worker_context = None  # the request context of a pool worker
+
+
+def init_worker(app):
+    """Gives a worker process the context the validators need. The app is
+    inherited from the parent process when the worker is forked."""
+    global worker_context
+    worker_context = app.test_request_context()
+    worker_context.push()
+
+
+def validate_shard(shard):
+    """Returns the validated rows in a byte range of the csv."""
+    filename, start, end, first_number, last_row = shard
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    rows = read_rows(csv.reader(StringIO(data)), last_row, first_number)
+    return list(validate_rows(rows))
+
+
+def shard_file(filename, shard_size=1 << 20):
+    """Splits the rows of a csv after the header into byte ranges of about
+    shard_size bytes. Ranges end on row boundaries, which may not be line
+    boundaries when quoted fields contain newlines, so the csv is scanned
+    for them. Yields (start, end, first row number, last row number)
+    tuples."""
+    with open(filename, 'rb') as f:
+        offset = [0]
+
+        def lines():
+            for line in f:
+                offset[0] += len(line)
+                yield line
+
+        # The reader takes one line at a time, so offset is always the end
+        # of the row last read
+        reader = csv.reader(lines())
+        reader.next()
+        start, first_number, number = offset[0], 2, 1
+        for number, _ in enumerate(reader, start=2):
+            if offset[0] - start >= shard_size:
+                yield start, offset[0], first_number, number
+                start, first_number = offset[0], number + 1
+        if first_number <= number:
+            yield start, offset[0], first_number, number
+
+
+def ordered_map(pool, func, iterable, window):
+    """Like pool.imap, but only has window items in flight at a time, so
+    that results don't pile up while the consumer is slow."""
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def geocode_batches(batches):
+    """Geocode stage. Geocodes the addresses of each batch of rows together,
+    rejecting the rows that can not be geocoded."""
+    for batch in batches:
+        valid = [row for row in batch if row.error is None]
+        all_coords = batch_geocode(
+            [row.values[LOCATION_INDEX] for row in valid])
+
+        for row in valid:
+            address_text = row.values[LOCATION_INDEX]
+            coords = all_coords[address_text]
+            if coords[0] is None or coords[1] is None:
+                row.error = 'Failed to geocode "{:s}"'.format(address_text)
             else:
-                loc = Location(
+                row.report['location'] = dict(
                     latitude=coords[0],
                     longitude=coords[1],
-                    original_user_text=address_text)
-                db.session.add(loc)
-
-                time1, time2 = parse_start_end_time(date_index, row)
-
-                # Assign correct agency id
-                agency_name = row[agency_index].rstrip()
-                if agency_name.upper() == 'OTHER':
-                    agency_name = row[agency_index + 1].rstrip()
-                agency = Agency.get_agency_by_name(agency_name)
-
-                # Create new agency object if not in database
-                if agency is None:
-                    agency = Agency(name=agency_name)
-                    agency.is_public = True
-                    agency.is_official = False
-                    db.session.add(agency)
-                    db.session.commit()
-
-                vehicle_id_text = row[vehicle_id_index].strip()
-                license_plate_text = row[license_plate_index].strip()
-
-                # If the license plate is too short, just ignore it
-                if len(strip_non_alphanumeric_chars(license_plate_text)) < 3:
-                    license_plate_text = ''
-
-                # Validate all the fields
-                validate_field = functools.partial(
-                    validate_field_partial,
-                    form=validator_form,
-                    row_number=i
+                    original_user_text=address_text
                 )
+        yield batch
+
 
-                errors = 0
-
-                if not validate_field(
-                    field=validator_form.vehicle_id,
-                    data=vehicle_id_text
-                ):
-                    errors += 1
-
-                if not validate_field(
-                    field=validator_form.description,
-                    data=row[description_index]
-                ):
-                    errors += 1
-
-                if not validate_field(
-                    field=validator_form.picture_url,
-                    data=row[picture_index]
-                ):
-                    errors += 1
-
-                if errors == 0:
-                    vehicle_id_text = strip_non_alphanumeric_chars(
-                        vehicle_id_text)
-                    license_plate_text = strip_non_alphanumeric_chars(
-                        license_plate_text)
-
-                    incident = IncidentReport(
-                        vehicle_id=vehicle_id_text if len(vehicle_id_text) > 0
-                        else None,
-                        license_plate=license_plate_text if
-                        len(license_plate_text) > 0 else None,
-                        location=loc,
-                        date=time1,
-                        duration=time2 - time1,
-                        agency=agency,
-                        picture_url=row[picture_index],
-                        description=row[description_index],
-                        send_email_upon_creation=False,
-                    )
-                    db.session.add(incident)
+def persist_batches(db, batches, checkpoint, rejected):
+    """Persist stage. Writes each batch of reports and the checkpoint in one
+    transaction, then records the batch's rejected rows."""
+    # Map of agency name to (id, is_public), loaded once for the import
+    agencies = dict((name, (agency_id, is_public)) for name, agency_id,
+                    is_public in db.session.query(Agency.name, Agency.id,
+                                                  Agency.is_public))
 
+    for batch in batches:
+        reports = []
+        for row in batch:
+            if row.error is not None:
+                continue
+            report = row.report
+            agency_name = report.pop('agency_name').upper()
+
+            # Create new agency object if not in database
+            if agency_name not in agencies:
+                agency = Agency(name=agency_name)
+                agency.is_public = True
+                agency.is_official = False
+                db.session.add(agency)
+                db.session.flush()
+                agencies[agency.name] = (agency.id, agency.is_public)
+            report['agency_id'], report['show_agency_publicly'] = \
+                agencies[agency_name]
+            reports.append(report)
+
+        insert_reports(db, reports)
+        checkpoint.last_row = batch[-1].number
+        checkpoint.updated = datetime.utcnow()
+        db.session.add(checkpoint)
         db.session.commit()
-        return columns
+
+        for row in batch:
+            if row.error is not None:
+                rejected.write(row)
+
+
+def insert_reports(db, reports):
+    """Bulk inserts reports, given as dicts of IncidentReport columns with
+    a 'location' dict of Location columns, along with their locations."""
+    if not reports:
+        return
+    locations = [report.pop('location') for report in reports]
+
+    ids = reserve_ids(db, IncidentReport.__table__, len(reports))
+    if ids is None:
+        # Inserted one at a time to get each id back, but without the
+        # overhead of the ORM
+        db.session.bulk_insert_mappings(IncidentReport, reports,
+                                        return_defaults=True)
+        ids = [report['id'] for report in reports]
+    else:
+        for report, report_id in zip(reports, ids):
+            report['id'] = report_id
+        db.session.execute(IncidentReport.__table__.insert(), reports)
+
+    for location, report_id in zip(locations, ids):
+        location['incident_report_id'] = report_id
+    db.session.execute(Location.__table__.insert(), locations)
+
+
+def reserve_ids(db, table, count):
+    """Reserves count ids from table's id sequence, so that rows can be
+    inserted many at a time with known ids. Returns None for databases
+    without sequences."""
+    if db.engine.dialect.name != 'postgresql':
+        return None
+    result = db.session.execute(
+        "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+        "FROM generate_series(1, :count)",
+        {'table': table.name, 'count': count}
+    )
+    return [row[0] for row in result]
+
+
+class RejectedRowWriter(object):
+    """Writes rejected rows to a csv, with their row numbers and reasons in
+    front of the original columns. The file is only created once a row is
+    rejected."""
+
+    def __init__(self, filename, append=False):
+        self.filename = filename
+        self.append = append
+        self.columns = []
+        self.file = None
+        self.writer = None
+
+        # Don't leave the rejections of an earlier import behind
+        if not append and os.path.exists(filename):
+            os.remove(filename)
+
+    def write(self, row):
+        print_error(row.number, row.error)
+        if self.writer is None:
+            new = not os.path.exists(self.filename)
+            self.file = open(self.filename, 'ab')
+            self.writer = csv.writer(self.file)
+            if new:
+                self.writer.writerow(['Row', 'Reason'] + self.columns)
+        self.writer.writerow([row.number, row.error] + row.values)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def chunks(iterable, size):
+    """Yields lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def hash_file(filename):
+    """Returns the sha1 hex digest of a file's contents."""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
 
 
 def parse_start_end_time(date_index, row):
+    """Returns the start and end times in the row. Raises a ValueError if
+    they are not in a known format."""
+    time1 = time2 = None
     for date_format in ['%m/%d/%Y %H:%M', '%m/%d/%y %H:%M']:
         try:
             time1 = datetime.strptime(row[date_index], date_format)
@@ -128,22 +380,21 @@ def parse_start_end_time(date_index, row):
         except ValueError:
             pass
 
+    if time1 is None or time2 is None:
+        raise ValueError('Invalid date "{}" or "{}"'.format(
+            row[date_index], row[date_index + 1]))
     return time1, time2
 
 
-def validate_field_partial(field, data, form, row_number):
-    """TODO: docstring"""
+def validate_field(form, field, data):
+    """Validates data with a field of the form. Returns the field's
+    errors."""
     field.data = data
     field.raw_data = data
-    validated = field.validate(form)
-
-    if not validated:
-        for error in field.errors:
-            print_error(row_number, error)
-
-    return validated
+    field.validate(form)
+    return list(field.errors)
 
 
 def print_error(row_number, error_message):
-    """TODO: docstring"""
+    """Prints an error with a row of the csv."""
     print 'Row {:d}: {}'.format(row_number, error_message)
@@ -0,0 +1,56 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter. Allows rate acquisitions per
+    second on average, in bursts of up to capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, blocking until one is available."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) *
+                                  self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RedisRateLimiter(object):
+    """Rate limiter shared by all processes using the same Redis key, e.g.
+    the RQ workers. Allows limit acquisitions in each window of period
+    seconds."""
+
+    def __init__(self, redis, key, limit, period=60):
+        self.redis = redis
+        self.key = key
+        self.limit = limit
+        self.period = period
+
+    def acquire(self):
+        """Take a slot in the current window, blocking until the next window
+        if it is full."""
+        while True:
+            now = time.time()
+            window = int(now // self.period)
+            key = '{}:{}'.format(self.key, window)
+            pipe = self.redis.pipeline()
+            pipe.incr(key)
+            pipe.expire(key, self.period * 2)
+            count, _ = pipe.execute()
+            if count <= self.limit:
+                return
+            time.sleep((window + 1) * self.period - now)
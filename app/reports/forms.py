@@ -96,7 +96,7 @@ class IncidentReportForm(Form):
         'Upload a picture of the idling vehicle.',
         validators=[
             Optional(),
-            FileAllowed(['jpg', 'jpe', 'jpeg', 'png', 'gif', 'svg', 'bmp'],
+            FileAllowed(['jpg', 'jpe', 'jpeg', 'png', 'gif', 'bmp'],
                         'Only images are allowed.')
         ]
     )
@@ -1,23 +1,30 @@
 from datetime import datetime
 
-from flask import render_template, abort, flash, redirect, url_for, current_app
+from flask import (
+    render_template,
+    abort,
+    flash,
+    redirect,
+    url_for,
+    request,
+)
 from flask.ext.login import login_required, current_user
-from flask.ext.rq import get_queue
-from werkzeug import secure_filename
 
 from forms import EditIncidentReportForm
 
 from . import reports
 from .. import db
 from ..models import IncidentReport, Agency
+from ..api.filters import filter_dates, parse_date, parse_datetime, parse_int
 from ..decorators import admin_or_agency_required
-from ..utils import (
-    flash_errors,
-    geocode,
-    parse_timedelta,
-    delete_image,
-    upload_image,
+from ..images import (
+    attach_uploaded_picture,
+    enqueue_picture_upload,
+    release_pictures,
 )
+from ..utils import flash_errors, parse_timedelta
+
+REPORTS_PER_PAGE = 50
 
 
 @reports.route('/all')
@@ -29,32 +36,84 @@ def view_reports():
     Agency workers can see reports for their affiliated agencies.
     General users do not have access to this page."""
 
-    agencies = []
-
     if current_user.is_admin():
-        incident_reports = IncidentReport.query.all()
-        agencies = Agency.query.all()
-
-    elif current_user.is_agency_worker():
-        incident_reports = []
+        agencies = Agency.query.order_by(Agency.name).all()
+        agency_ids = None
+    else:
         agencies = current_user.agencies
-        for agency in current_user.agencies:
-            incident_reports.extend(agency.incident_reports)
+        agency_ids = [agency.id for agency in agencies]
 
-    # TODO test using real data
-    return render_template('reports/reports.html', reports=incident_reports,
-                           agencies=agencies)
+    return render_report_listing(agencies, agency_ids=agency_ids)
 
 
 @reports.route('/my-reports')
 @login_required
 def view_my_reports():
     """View all idling incident reports for this user."""
-    incident_reports = current_user.incident_reports
-    agencies = []
-
+    return render_report_listing([], user_id=current_user.id)
+
+
+def render_report_listing(agencies, agency_ids=None, user_id=None):
+    """Render a page of reports, filtered and ordered by the request's
+    arguments:
+        agency: agency id
+        start, end: YYYY-MM-DD date range (inclusive)
+        vehicle_id: exact vehicle ID
+        order: 'newest' (the default) or 'oldest'
+        after_date, after_id: the date and id of the last report on the
+            previous page
+
+    agency_ids and user_id restrict the reports the user may see.
+    """
+    filters = {}
+
+    agency_id = parse_int('agency')
+    if agency_id is not None:
+        filters['agency'] = agency_id
+        if agency_ids is None or agency_id in agency_ids:
+            agency_ids = [agency_id]
+        else:
+            agency_ids = []
+
+    oldest_first = request.args.get('order') == 'oldest'
+    if oldest_first:
+        filters['order'] = 'oldest'
+
+    after = None
+    after_date, after_id = parse_datetime('after_date'), parse_int('after_id')
+    if after_date is not None and after_id is not None:
+        after = (after_date, after_id)
+
+    query = IncidentReport.listing_query(agency_ids=agency_ids,
+                                         user_id=user_id, after=after,
+                                         oldest_first=oldest_first)
+
+    start, end = parse_date('start'), parse_date('end')
+    query = filter_dates(query, start, end)
+    if start is not None:
+        filters['start'] = request.args['start']
+    if end is not None:
+        filters['end'] = request.args['end']
+
+    vehicle_id = request.args.get('vehicle_id', '').strip()
+    if vehicle_id:
+        query = query.filter(IncidentReport.vehicle_id == vehicle_id)
+        filters['vehicle_id'] = vehicle_id
+
+    incident_reports = query.options(db.joinedload(IncidentReport.agency)) \
+        .limit(REPORTS_PER_PAGE + 1).all()
+    next_page = None
+    if len(incident_reports) > REPORTS_PER_PAGE:
+        incident_reports = incident_reports[:REPORTS_PER_PAGE]
+        last = incident_reports[-1]
+        next_page = dict(filters, after_date=last.date.isoformat(),
+                         after_id=last.id)
+
+    reverse_order = dict(filters, order='newest' if oldest_first else 'oldest')
     return render_template('reports/reports.html', reports=incident_reports,
-                           agencies=agencies)
+                           agencies=agencies, filters=filters,
+                           next_page=next_page, first_page=after is not None,
+                           reverse_order=reverse_order)
 
 
 @reports.route('/<int:report_id>')
@@ -95,7 +154,7 @@ def edit_report_info(report_id):
         report.vehicle_id = form.vehicle_id.data
         report.license_plate = form.license_plate.data
 
-        lat, lng = geocode(form.location.data)
+        lat, lng = form.location.coordinates
         report.location.latitude, report.location.longitude = lat, lng
         report.location.original_user_text = form.location.data
 
@@ -118,30 +177,26 @@ def edit_report_info(report_id):
 
         report.agency = agency
 
-        report.picture_url = form.picture_url.data
+        if form.picture_url.data != report.picture_url:
+            report.picture_url = form.picture_url.data
+            report.picture_thumbnail_url = None
         report.description = form.description.data
 
         report.bus_number = form.bus_number.data
         report.led_screen_number = form.led_screen_number.data
 
+        image_key = None
         if form.picture_file.data.filename:
-            filepath = secure_filename(form.picture_file.data.filename)
-            form.picture_file.data.save(filepath)
-
-            # synchronously upload image so that the user will be able to see
-            # the changes immediately.
-            link, deletehash = upload_image(
-                imgur_client_id=current_app.config['IMGUR_CLIENT_ID'],
-                imgur_client_secret=current_app.config['IMGUR_CLIENT_SECRET'],
-                app_name=current_app.config['APP_NAME'],
-                image_file_path=filepath
-            )
-
-            report.picture_url = link
-            report.picture_deletehash = deletehash
+            image_key = attach_uploaded_picture(report,
+                                                form.picture_file.data)
 
         db.session.add(report)
         db.session.commit()
+
+        # The picture is stored in the background, and shown as
+        # pending until then
+        if image_key is not None:
+            enqueue_picture_upload(report.id, image_key)
         flash('Report information updated.', 'form-success')
     elif form.errors.items():
         flash_errors(form)
@@ -192,14 +247,8 @@ def delete_report(report_id):
     report_user_id = None
 
     if report is not None:
-        if report.picture_deletehash:
-            # Asynchronously delete the report's image
-            get_queue().enqueue(
-                delete_image,
-                deletehash=report.picture_deletehash,
-                imgur_client_id=current_app.config['IMGUR_CLIENT_ID'],
-                imgur_client_secret=current_app.config['IMGUR_CLIENT_SECRET'],
-            )
+        # Asynchronously delete the report's picture and its thumbnail
+        release_pictures(report)
         report_user_id = report.user_id
 
         db.session.delete(report)
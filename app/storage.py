@@ -0,0 +1,155 @@
+import errno
+import hashlib
+import imghdr
+import os
+import tempfile
+from base64 import b64encode
+
+from flask import current_app
+
+from app import http_client
+
+
+class ImageStorage(object):
+    """Somewhere report pictures can be stored. Each stored image has a url
+    it can be seen at, and a handle with which it can be deleted."""
+
+    def upload(self, data):
+        """Stores an image's contents. Returns its url and handle."""
+        raise NotImplementedError
+
+    def upload_file(self, path):
+        with open(path, 'rb') as image_file:
+            return self.upload(image_file.read())
+
+    def upload_url(self, url):
+        """Stores the image at the given url. Raises a
+        requests.RequestException if it can't be downloaded."""
+        response = http_client.image_hosts.get(url)
+        response.raise_for_status()
+        return self.upload(response.content)
+
+    def delete(self, handle):
+        raise NotImplementedError
+
+
+class ImgurStorage(ImageStorage):
+    """Anonymous uploads of the app's Imgur client, whose handles are Imgur
+    deletehashes. Requests to Imgur raise a requests.RequestException if
+    they fail."""
+
+    def __init__(self, client_id):
+        self.headers = {'Authorization': 'Client-ID {}'.format(client_id)}
+
+    def upload(self, data):
+        return self.post(image=b64encode(data), type='base64')
+
+    def upload_url(self, url):
+        # Imgur can fetch the image itself
+        return self.post(image=url, type='url')
+
+    def post(self, **data):
+        data.update(
+            title='{} Image Upload'.format(current_app.config['APP_NAME']),
+            description='This is part of an idling vehicle report on {}.'
+            .format(current_app.config['APP_NAME'])
+        )
+        response = http_client.imgur.post('https://api.imgur.com/3/upload',
+                                          data=data, headers=self.headers)
+        response.raise_for_status()
+        result = response.json()['data']
+        return result['link'], result['deletehash']
+
+    def delete(self, deletehash):
+        response = http_client.imgur.delete(
+            'https://api.imgur.com/3/image/{}'.format(deletehash),
+            headers=self.headers)
+        response.raise_for_status()
+
+
+class LocalStorage(ImageStorage):
+    """Images stored in a directory, to be served at a base url by the app
+    (see main.stored_image) or a web server. Images are named by the sha256
+    of their contents, so storing the same image twice stores it once, and
+    its url can be cached forever. The handle is the image's path relative
+    to the directory."""
+
+    def __init__(self, path, url):
+        self.path = path
+        self.url = url
+
+    def upload(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        image_type = imghdr.what(None, data) or 'bin'
+        extension = 'jpg' if image_type == 'jpeg' else image_type
+        # Spread images over subdirectories, as a few filesystems slow down
+        # with very many files in one directory
+        handle = '{}/{}.{}'.format(digest[:2], digest, extension)
+        full_path = os.path.join(self.path, handle)
+
+        if not os.path.exists(full_path):
+            directory = os.path.dirname(full_path)
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Write to a temporary file first, so a partly written image is
+            # never served
+            fd, temp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as image_file:
+                image_file.write(data)
+            os.chmod(temp_path, 0o644)
+            os.rename(temp_path, full_path)
+        return self.url + handle, handle
+
+    def delete(self, handle):
+        try:
+            os.remove(os.path.join(self.path, handle))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def get_storage(name=None):
+    """Returns the image storage backend with the given name, by default
+    the IMAGE_STORAGE one."""
+    config = current_app.config
+    name = name or config['IMAGE_STORAGE']
+    if name == 'imgur':
+        return ImgurStorage(config['IMGUR_CLIENT_ID'])
+    if name == 'local':
+        return LocalStorage(
+            config['IMAGE_STORAGE_PATH'],
+            config['IMAGE_STORAGE_URL'] or
+            (config['DOMAIN'] or '') + '/images/')
+    raise ValueError('Unknown image storage {}'.format(name))
+
+
+def upload_image(image_data=None, image_file_path=None, image_url=None):
+    """Stores an image, given its contents, file path or url, with the
+    IMAGE_STORAGE backend. Returns the image's url and a deletehash to pass
+    to delete_image."""
+    storage = get_storage()
+    if image_data is not None:
+        url, handle = storage.upload(image_data)
+    elif image_file_path is not None:
+        url, handle = storage.upload_file(image_file_path)
+    elif image_url is not None:
+        url, handle = storage.upload_url(image_url)
+    else:
+        raise ValueError('Either image_data, image_file_path or image_url '
+                         'must be supplied.')
+
+    # Deletehashes say which backend stored the image, so it can be deleted
+    # after IMAGE_STORAGE is changed. Imgur's have no prefix, as they were
+    # stored before there were other backends.
+    if current_app.config['IMAGE_STORAGE'] == 'imgur':
+        return url, handle
+    return url, '{}:{}'.format(current_app.config['IMAGE_STORAGE'], handle)
+
+
+def delete_image(deletehash):
+    """Deletes an image stored by upload_image."""
+    name, _, handle = deletehash.rpartition(':')
+    get_storage(name or 'imgur').delete(handle)
@@ -1,14 +1,14 @@
+import math
 import re
+import random
 import requests
 import time
-import os
 
 from flask import url_for, flash, current_app
-from flask.ext.rq import get_queue
-from imgurpython import ImgurClient
 from datetime import timedelta
 
-from app import db
+from app import http_client
+from app.cache import TieredCache
 
 
 def register_template_utils(app):
@@ -70,36 +70,124 @@ def strip_non_alphanumeric_chars(input_string):
     return stripped
 
 
+class GeocodeError(Exception):
+    """The Google geocoding API returned an error status."""
+
+
+def normalize_address(address):
+    """Normalize address text so that trivially different spellings of the
+    same address (e.g. "Broad & Arch" and "broad and arch ") compare equal."""
+    if isinstance(address, str):
+        address = address.decode('utf-8', 'replace')
+    address = address.lower()
+    address = re.sub(r'\s+(and|at)\s+', ' & ', address)
+    address = re.sub(r'[^\w&#\s]', ' ', address, flags=re.UNICODE)
+    address = re.sub(r'\s*&\s*', ' & ', address)
+    return ' '.join(address.split())
+
+
 def geocode(address):
-    """Viewport-biased geocoding using Google API.
+    """Viewport-biased geocoding using Google API. Results, including failed
+    geocodes, are cached in the database (see app.models.GeocodeResult).
 
     Returns a tuple of (latitude, longitude), (None, None) if geocoding fails.
     """
+    from app.models import GeocodeResult
+    viewport = current_app.config['VIEWPORT']
+
+    cached = GeocodeResult.lookup(address, viewport)
+    if cached is not None:
+        return cached.latitude, cached.longitude
+
+    try:
+        lat, lng = google_geocode(address, viewport,
+                                  current_app.config['GOOGLE_GEOCODE_KEY'])
+    except (GeocodeError, requests.RequestException):
+        # Don't cache failures that may be temporary
+        return None, None
+    GeocodeResult.store(address, viewport, lat, lng)
+    return lat, lng
+
+
+def google_geocode(address, viewport, key, max_retries=0):
+    """Geocode address with the Google API key (None when unconfigured),
+    bypassing the cache. When over the query limit, backs off
+    (exponentially, with jitter) and retries up to max_retries times. Web
+    requests shouldn't wait, so only batch geocoding (see app.batch_geocode)
+    retries. Only this request waits, and the app config isn't read, so
+    this is safe to call from several threads at once, outside an app
+    context.
+
+    Returns a tuple of (latitude, longitude), (None, None) if the address was
+    not found. Raises GeocodeError if the request failed for another reason
+    (e.g. the query limit was still exceeded after retrying).
+    """
     url = "https://maps.googleapis.com/maps/api/geocode/json"
     payload = {
         'address': address,
-        'bounds': current_app.config['VIEWPORT'],
-        'key': current_app.config['GOOGLE_GEOCODE_KEY']
+        'bounds': viewport,
+        'key': key
     }
-    r = requests.get(url, params=payload)
-
-    # Google's geocode api is limited to 10 requests a second
-    if r.json()['status'] == 'OVER_QUERY_LIMIT':
-        time.sleep(1)
-        r = requests.get(url, params=payload)
-
-    if r.json()['status'] == 'ZERO_RESULTS' or len(r.json()['results']) is 0:
-        print r.json()
+    for attempt in range(max_retries + 1):
+        response = http_client.google.get(url, params=payload)
+        response.raise_for_status()
+        response = response.json()
+        if response['status'] != 'OVER_QUERY_LIMIT' or \
+                attempt == max_retries:
+            break
+        time.sleep(2 ** attempt * random.uniform(0.5, 1.5))
+
+    if response['status'] == 'ZERO_RESULTS' or \
+            (response['status'] == 'OK' and len(response['results']) == 0):
         return None, None
+    elif response['status'] != 'OK':
+        raise GeocodeError(response['status'])
     else:
-        coords = r.json()['results'][0]['geometry']['location']
+        coords = response['results'][0]['geometry']['location']
         return coords['lat'], coords['lng']
 
 
-def get_current_weather(location):
-    """Given an app.models.Location object, returns the current weather at
-    that location as a string."""
+# Weather looked up for one report is reused for reports nearby made soon
+# after, see weather_cache_key
+weather_cache = TieredCache('weather:')
+
+
+def weather_cache_key(latitude, longitude, now=None):
+    """Returns the cache key of the weather at a point, and the seconds
+    until it expires. Points share a key within a grid cell of
+    WEATHER_CACHE_CELL degrees, during a WEATHER_CACHE_TTL long window."""
+    cell = current_app.config['WEATHER_CACHE_CELL']
+    period = current_app.config['WEATHER_CACHE_TTL'].total_seconds()
+    if now is None:
+        now = time.time()
+    window = int(now // period)
+    key = '{:d}:{:d}:{:d}'.format(int(math.floor(latitude / cell)),
+                                  int(math.floor(longitude / cell)), window)
+    return key, (window + 1) * period - now
+
 
+def get_current_weather(location, rate_limiter=None):
+    """Given an app.models.Location object, returns the current weather at
+    that location as a string, or None if the location has no coordinates
+    or the weather service can't be reached. The weather is cached (see
+    weather_cache_key); rate_limiter, if given, is acquired before asking
+    the weather service."""
+    if location.latitude is None or location.longitude is None:
+        return None
+    key, ttl = weather_cache_key(location.latitude, location.longitude)
+    weather = weather_cache.get(key)
+    if weather is None:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+        weather = fetch_current_weather(location)
+        if weather is not None:
+            weather_cache.set(key, weather, max(ttl, 1))
+    return weather
+
+
+def fetch_current_weather(location):
+    """Returns the current weather at a location from OpenWeatherMap,
+    bypassing the cache."""
     url = "http://api.openweathermap.org/data/2.5/weather"
     payload = {
         'APPID': current_app.config['OPEN_WEATHER_MAP_API_KEY'],
@@ -107,8 +195,12 @@ def get_current_weather(location):
         'lat': location.latitude,
         'lon': location.longitude,
     }
-    r = requests.get(url, params=payload)
-    response = r.json()
+    try:
+        response = http_client.openweathermap.get(url, params=payload)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None
+    response = response.json()
     weather_text = ''
 
     weather_key = response.get('weather')
@@ -138,51 +230,6 @@ def get_current_weather(location):
     return weather_text.strip()
 
 
-def upload_image(imgur_client_id, imgur_client_secret, app_name,
-                 image_url=None, image_file_path=None):
-    """Uploads an image to Imgur by the image's url or file_path. Returns the
-    Imgur api response."""
-    if image_url is None and image_file_path is None:
-        raise ValueError('Either image_url or image_file_path must be '
-                         'supplied.')
-    client = ImgurClient(imgur_client_id, imgur_client_secret)
-    title = '{} Image Upload'.format(current_app.config['APP_NAME'])
-
-    description = 'This is part of an idling vehicle report on {}.'.format(
-        current_app.config['APP_NAME'])
-
-    if image_url is not None:
-        result = client.upload_from_url(url=image_url, config={
-            'title': title,
-            'description': description,
-        })
-    else:
-        result = client.upload_from_path(path=image_file_path, config={
-            'title': title,
-            'description': description,
-        })
-        os.remove(image_file_path)
-
-    return result['link'], result['deletehash']
-
-
-def delete_image(deletehash, imgur_client_id, imgur_client_secret):
-    """Attempts to delete a specific image from Imgur using its deletehash."""
-    client = ImgurClient(imgur_client_id, imgur_client_secret)
-
-    client.delete_image(deletehash)
-
-
-def attach_image_to_incident_report(incident_report, image_job_id):
-    """Attach the image uploaded by the job with image_job_id to the given
-    incident_report."""
-    link, deletehash = get_queue().fetch_job(image_job_id).result
-    incident_report.picture_url = link
-    incident_report.picture_deletehash = deletehash
-    db.session.add(incident_report)
-    db.session.commit()
-
-
 def url_for_external(endpoint, **kwargs):
     """Get a full url (e.g. http:app.com/hello instead of just /hello"""
     if current_app.config['DOMAIN']:
@@ -1,5 +1,6 @@
 import os
 import urlparse
+from datetime import timedelta
 from raygun4py.middleware import flask as flask_raygun
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -39,6 +40,60 @@ class Config:
 
     GOOGLE_GEOCODE_KEY = os.environ.get('GOOGLE_GEOCODE_KEY')
 
+    # How long geocoding results are cached. Failed geocodes are cached for
+    # less time, in case they were caused by a transient error.
+    GEOCODE_CACHE_TTL = timedelta(days=365)
+    GEOCODE_NEGATIVE_CACHE_TTL = timedelta(days=1)
+
+    # Batch geocoding (e.g. for csv imports) runs this many requests at once,
+    # limited to GEOCODE_RATE_LIMIT requests a second to stay under the
+    # Google API quota. Requests over the quota are retried with backoff.
+    GEOCODE_WORKERS = 8
+    GEOCODE_RATE_LIMIT = 10
+    GEOCODE_MAX_RETRIES = 3
+
+    # Weather lookups for new reports, made by RQ workers, are limited to
+    # this many a minute (the OpenWeatherMap free plan allows 60).
+    WEATHER_RATE_LIMIT = 60
+
+    # The weather is cached, in each process and in Redis, for a grid cell
+    # of WEATHER_CACHE_CELL degrees (about 5km) during a WEATHER_CACHE_TTL
+    # long window, so that reports near each other share a lookup.
+    WEATHER_CACHE_CELL = 0.05
+    WEATHER_CACHE_TTL = timedelta(minutes=15)
+
+    # Pictures uploaded with the report form are kept in Redis for this long
+    # waiting to be stored, e.g. if the upload job fails and has
+    # to be retried.
+    IMAGE_SPOOL_TTL = timedelta(days=1)
+
+    # Uploaded pictures are re-encoded as JPEGs of at most
+    # IMAGE_MAX_DIMENSION pixels on their longest side, without the EXIF data
+    # that may say where they were taken, along with a thumbnail for
+    # previews.
+    IMAGE_MAX_DIMENSION = 1600
+    IMAGE_THUMBNAIL_DIMENSION = 320
+    IMAGE_QUALITY = 85
+
+    # Where pictures are stored: 'imgur', or 'local' to keep them in the
+    # IMAGE_STORAGE_PATH directory. Local pictures are served from
+    # IMAGE_STORAGE_URL, which defaults to the app's /images/ route but is
+    # better pointed at e.g. nginx serving the same directory.
+    IMAGE_STORAGE = os.environ.get('IMAGE_STORAGE') or 'imgur'
+    IMAGE_STORAGE_PATH = os.environ.get('IMAGE_STORAGE_PATH') or \
+        os.path.join(basedir, 'images')
+    IMAGE_STORAGE_URL = os.environ.get('IMAGE_STORAGE_URL')
+
+    # A picture that was stored before is reused rather than stored again.
+    # Pictures are matched by their sha256, and if IMAGE_DEDUP_PERCEPTUAL by
+    # a perceptual hash too, which also matches e.g. a picture that was
+    # recompressed by a phone carrier (or, rarely, a different picture that
+    # looks much the same).
+    IMAGE_DEDUP_PERCEPTUAL = False
+
+    # An SMS conversation is forgotten this long after its last message.
+    SMS_CONVERSATION_TTL = timedelta(hours=1)
+
     # Parse the REDIS_URL to set RQ config variables
     urlparse.uses_netloc.append('redis')
     url = urlparse.urlparse(REDIS_URL)
@@ -60,6 +115,20 @@ class Config:
     # Send all incident report emails to this address.
     SEND_ALL_REPORTS_TO = os.environ.get('SEND_ALL_REPORTS_TO')
 
+    # Per-request SQL statistics. DB_STATS_HEADERS sends them in response
+    # headers, and defaults to on in debug mode. Requests over the SLOW_*
+    # thresholds (in seconds, or number of queries) are logged along with
+    # their DB_STATS_SLOWEST slowest statements; None turns a check off.
+    DB_STATS_HEADERS = None
+    DB_STATS_SLOWEST = 3
+    SLOW_REQUEST_TIME = None
+    SLOW_REQUEST_QUERIES = None
+    SLOW_QUERY_TIME = None
+
+    # Bearer token with which a Prometheus server can scrape /admin/metrics
+    # without logging in as an administrator.
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
     @staticmethod
     def init_app(app):
         pass
@@ -77,6 +146,9 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
     WTF_CSRF_ENABLED = False
+    # Tests shouldn't need Imgur
+    IMAGE_STORAGE = 'local'
+    IMAGE_STORAGE_PATH = os.path.join(basedir, 'images-test')
 
 
 class ProductionConfig(Config):
@@ -85,6 +157,10 @@ class ProductionConfig(Config):
     # TODO: add to flask-base
     SSL_DISABLE = (os.environ.get('SSL_DISABLE') or 'True') == 'True'
 
+    SLOW_REQUEST_TIME = float(os.environ.get('SLOW_REQUEST_TIME') or 1.0)
+    SLOW_REQUEST_QUERIES = int(os.environ.get('SLOW_REQUEST_QUERIES') or 50)
+    SLOW_QUERY_TIME = float(os.environ.get('SLOW_QUERY_TIME') or 0.25)
+
     @classmethod
     def init_app(cls, app):
         Config.init_app(app)
@@ -92,6 +168,12 @@ class ProductionConfig(Config):
         if app.config['RAYGUN_APIKEY'] is not None:
             flask_raygun.Provider(app, app.config['RAYGUN_APIKEY']).attach()
 
+        # Log warnings, such as slow requests, to stderr
+        import logging
+        stream_handler = logging.StreamHandler()
+        stream_handler.setLevel(logging.WARNING)
+        app.logger.addHandler(stream_handler)
+
 
 class HerokuConfig(ProductionConfig):
     @classmethod
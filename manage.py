@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import json
 import os
+import time
 from app import create_app, db
 from app.models import (
     User,
@@ -7,7 +9,8 @@ from app.models import (
     Agency,
     Permission,
     IncidentReport,
-    EditableHTML
+    EditableHTML,
+    GeocodeResult
 )
 from flask.ext.script import Manager, Shell
 from flask.ext.migrate import Migrate, MigrateCommand
@@ -126,9 +129,231 @@ def setup_dev():
                 type=str,
                 help='Filename of csv to parse',
                 dest='filename')
-def parse_csv(filename):
-    """Parses the given csv file into the database."""
-    parse_to_db(db, filename)
+@manager.option('-b',
+                '--batch-size',
+                default=1000,
+                type=int,
+                help='Number of rows to insert at a time',
+                dest='batch_size')
+@manager.option('-r',
+                '--resume',
+                action='store_true',
+                default=False,
+                help='Continue an interrupted import of the same file',
+                dest='resume')
+@manager.option('-w',
+                '--workers',
+                default=1,
+                type=int,
+                help='Number of processes to validate rows with',
+                dest='workers')
+def parse_csv(filename, batch_size, resume, workers):
+    """Parses the given csv file into the database. Rejected rows are written
+    to <filename>.rejected.csv."""
+    parse_to_db(db, filename, batch_size=batch_size, resume=resume,
+                workers=workers)
+
+
+@manager.option('-z',
+                '--max-zoom',
+                default=15,
+                type=int,
+                help='Highest zoom level to load clusters for',
+                dest='max_zoom')
+def benchmark_map(max_zoom):
+    """
+    Compares the server side of two ways to load the map's markers in the
+    default viewport: paging through every report from /api/reports, and
+    loading /api/clusters at each zoom level. Prints the markers, payload
+    bytes, server time until the first markers can be drawn, and total server
+    time of each, measured through the test client. It doesn't render the old
+    map page that inlined every report as JavaScript (a larger payload than
+    all the markers as JSON), nor measure network or browser paint time. Run
+    add_fake_data first for a meaningful number of reports.
+    """
+    client = app.test_client()
+    south_west, north_east = app.config['VIEWPORT'].split('|')
+    bbox = '{},{}'.format(south_west, north_east)
+
+    def fetch(url):
+        start = time.time()
+        response = client.get(url)
+        return response, time.time() - start
+
+    row = '{:<16}{:>10}{:>14}{:>12.1f}{:>12.1f}'
+    total_bytes, total_time, first_time, after, count = 0, 0.0, None, 0, 0
+    while after is not None:
+        response, elapsed = fetch('/api/reports?bbox={}&after={}'
+                                  .format(bbox, after))
+        data = json.loads(response.data)
+        total_bytes += len(response.data)
+        total_time += elapsed
+        if first_time is None:
+            first_time = elapsed
+        count += len(data['reports'])
+        after = data['next']
+    print('{:<16}{:>10}{:>14}{:>12}{:>12}'.format(
+        '', 'markers', 'bytes', 'first ms', 'total ms'))
+    print(row.format('all markers', count, total_bytes, first_time * 1000,
+                     total_time * 1000))
+
+    for zoom in range(10, max_zoom + 1):
+        response, elapsed = fetch('/api/clusters?bbox={}&zoom={}'
+                                  .format(bbox, zoom))
+        data = json.loads(response.data)
+        print(row.format('zoom {}'.format(zoom),
+                         len(data['clusters']) + len(data['reports']),
+                         len(response.data), elapsed * 1000, elapsed * 1000))
+
+
+@manager.option('-n',
+                '--number-addresses',
+                default=200,
+                type=int,
+                help='Number of addresses to geocode',
+                dest='number_addresses')
+@manager.option('-l',
+                '--latency',
+                default=0.2,
+                type=float,
+                help='Seconds the stub geocoder takes per request',
+                dest='latency')
+@manager.option('-r',
+                '--rate',
+                default=None,
+                type=float,
+                help='Rate limit in requests a second',
+                dest='rate')
+def benchmark_geocode(number_addresses, latency, rate):
+    """
+    Compares the throughput of geocoding addresses one at a time, as csv
+    imports used to, against batch_geocode. Uses a local stub geocoder that
+    takes the given latency per request. A quarter of the addresses are
+    repeats, as in real imports.
+    """
+    from random import choice
+    from app.batch_geocode import batch_geocode
+
+    distinct = ['{} & Market'.format(i)
+                for i in range(number_addresses * 3 / 4)]
+    addresses = distinct + [choice(distinct)
+                            for _ in range(number_addresses - len(distinct))]
+
+    def stub_geocoder(address):
+        time.sleep(latency)
+        return 39.95, -75.16
+
+    start = time.time()
+    for address in addresses:
+        stub_geocoder(address)
+    sequential = time.time() - start
+
+    start = time.time()
+    batch_geocode(addresses, rate=rate, geocoder=stub_geocoder,
+                  use_cache=False)
+    batch = time.time() - start
+
+    print('{:<12}{:>10}{:>18}'.format('', 'seconds', 'addresses/second'))
+    for name, elapsed in [('sequential', sequential), ('batch', batch)]:
+        print('{:<12}{:>10.1f}{:>18.1f}'.format(name, elapsed,
+                                                len(addresses) / elapsed))
+
+
+@manager.option('-m',
+                '--max-entries',
+                default=None,
+                type=int,
+                help='Maximum number of geocoding results to keep',
+                dest='max_entries')
+def prune_geocode_cache(max_entries):
+    """Deletes expired (and optionally the oldest) cached geocodes."""
+    print('Deleted {} cached geocodes.'
+          .format(GeocodeResult.evict(max_entries=max_entries)))
+
+
+@manager.command
+def create_indexes():
+    """Creates the indexes of the models that an existing database is
+    missing, such as those added since its tables were created."""
+    from sqlalchemy import inspect
+
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                print('Created index {}.'.format(index.name))
+
+
+@manager.command
+def create_columns():
+    """Adds the tables and columns of the models that an existing database
+    is missing, such as those added since its tables were created."""
+    from sqlalchemy import inspect
+
+    db.create_all()
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(column['name']
+                       for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, column.name,
+                    column.type.compile(db.engine.dialect)))
+                print('Added column {}.{}.'.format(table.name, column.name))
+
+
+@manager.command
+def convert_coordinates():
+    """Converts the location coordinates of databases created before they
+    were numeric, and creates the spatial index."""
+    from sqlalchemy import inspect
+    from app.models import Location, SPATIAL_INDEX_DDL
+
+    engine = db.engine
+    columns = dict((c['name'], c['type'])
+                   for c in inspect(engine).get_columns('locations'))
+    if isinstance(columns['latitude'], db.Float):
+        print('Coordinates are already numeric.')
+        return
+
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            for column in ['latitude', 'longitude']:
+                connection.execute(
+                    'ALTER TABLE locations ALTER COLUMN {0} '
+                    'TYPE double precision '
+                    "USING CAST(NULLIF({0}, '') AS double precision)"
+                    .format(column))
+            for index in Location.__table__.indexes:
+                index.create(connection)
+            for statement in SPATIAL_INDEX_DDL['postgresql']:
+                connection.execute(statement)
+        elif engine.dialect.name == 'sqlite':
+            # SQLite can't change column types, so the table is rebuilt
+            connection.execute('ALTER TABLE locations RENAME TO locations_old')
+            Location.__table__.create(connection)
+            connection.execute(
+                'INSERT INTO locations (id, latitude, longitude, '
+                'original_user_text, incident_report_id) '
+                "SELECT id, CAST(NULLIF(latitude, '') AS REAL), "
+                "CAST(NULLIF(longitude, '') AS REAL), original_user_text, "
+                'incident_report_id FROM locations_old')
+            connection.execute('DROP TABLE locations_old')
+        else:
+            print('Converting {} databases is not supported.'
+                  .format(engine.dialect.name))
+            return
+    print('Converted coordinates.')
 
 
 @manager.command
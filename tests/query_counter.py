@@ -0,0 +1,36 @@
+from sqlalchemy import event
+from app import db
+
+
+class QueryCounter(object):
+    """Counts the SQL statements executed and the model instances loaded
+    while in use as a context manager:
+
+        with QueryCounter() as counter:
+            client.get('/reports/all')
+        self.assertEqual(counter.statements, 3)
+
+    loaded counts instances by model name, so that a test can check that a
+    page didn't load rows it doesn't show.
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.loaded = {}
+
+    def __enter__(self):
+        event.listen(db.engine, 'after_cursor_execute', self.count_statement)
+        event.listen(db.Model, 'load', self.count_instance, propagate=True)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'after_cursor_execute', self.count_statement)
+        event.remove(db.Model, 'load', self.count_instance)
+
+    def count_statement(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        self.statements += 1
+
+    def count_instance(self, target, context):
+        name = type(target).__name__
+        self.loaded[name] = self.loaded.get(name, 0) + 1
@@ -0,0 +1,130 @@
+import csv
+import gzip
+import json
+import unittest
+import datetime
+from io import BytesIO
+from app import create_app, db
+from app.models import Agency, IncidentReport, Location, Role, User
+
+
+class AdminExportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        Role.insert_roles()
+        admin = User(first_name='Admin', last_name='Account', confirmed=True,
+                     email=self.app.config['ADMIN_EMAIL'],
+                     password='password')
+        db.session.add(admin)
+        db.session.commit()
+        self.client.post('/account/login', data={
+            'email': admin.email,
+            'password': 'password'
+        })
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_report(self, date, agency, description='Truck idling!'):
+        report = IncidentReport(
+            vehicle_id='123456',
+            license_plate='ABC123',
+            location=Location(latitude='39.951', longitude='-75.197',
+                              original_user_text=u'3700 Spruce St.'),
+            date=date,
+            duration=datetime.timedelta(minutes=5),
+            agency=agency,
+            description=description,
+            send_email_upon_creation=False
+        )
+        db.session.add(report)
+        db.session.commit()
+        return report
+
+    def download(self, url='/admin/download_reports'):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return list(csv.reader(response.data.splitlines()))
+
+    def download_ids(self, query):
+        rows = self.download('/admin/download_reports?' + query)
+        return [int(row[-1]) for row in rows[1:]]
+
+    def test_download_reports(self):
+        agency = Agency(name='SEPTA')
+        self.add_report(datetime.datetime(2016, 1, 1, 12, 30), agency,
+                        description=u'Idling by the caf\xe9')
+        self.add_report(datetime.datetime(2016, 1, 2), agency)
+
+        rows = self.download()
+        self.assertEqual(rows[0], ['DATE', 'LOCATION', 'AGENCY ID',
+                                   'VEHICLE ID', 'DURATION', 'LICENSE PLATE',
+                                   'DESCRIPTION', 'REPORT ID'])
+        self.assertEqual(rows[1], ['2016-01-01 12:30:00', '3700 Spruce St.',
+                                   'SEPTA', '123456', '0:05:00', 'ABC123',
+                                   'Idling by the caf\xc3\xa9', '1'])
+        self.assertEqual(len(rows), 3)
+
+    def test_download_streamed(self):
+        response = self.client.get('/admin/download_reports')
+        self.assertTrue(response.is_streamed)
+        self.assertTrue(response.headers['Content-Disposition'].startswith(
+            'attachment; filename=IncidentReports-'))
+
+    def test_download_filters(self):
+        septa = Agency(name='SEPTA')
+        peco = Agency(name='PECO')
+        r1 = self.add_report(datetime.datetime(2016, 1, 1), septa)
+        r2 = self.add_report(datetime.datetime(2016, 1, 31, 23), peco)
+        r3 = self.add_report(datetime.datetime(2016, 2, 1), septa)
+
+        self.assertEqual(self.download_ids('start=2016-01-02&end=2016-01-31'),
+                         [r2.id])
+        self.assertEqual(self.download_ids('agency={}'.format(septa.id)),
+                         [r1.id, r3.id])
+        self.assertEqual(self.download_ids('since_id={}'.format(r1.id)),
+                         [r2.id, r3.id])
+        self.assertEqual(self.download_ids('since_date=2016-01-31T23:00:00'),
+                         [r3.id])
+        self.assertEqual(self.download_ids(
+            'since_id={}&agency={}'.format(r1.id, septa.id)), [r3.id])
+
+        response = self.client.get('/admin/download_reports?since_id=first')
+        self.assertEqual(response.status_code, 400)
+
+    def test_download_jsonl(self):
+        report = self.add_report(datetime.datetime(2016, 1, 1, 12, 30),
+                                 Agency(name='SEPTA'))
+        response = self.client.get('/admin/download_reports?format=jsonl')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.splitlines()
+        self.assertEqual(json.loads(lines[0]), {
+            'id': report.id,
+            'date': '2016-01-01T12:30:00',
+            'location': '3700 Spruce St.',
+            'agency': 'SEPTA',
+            'vehicle_id': '123456',
+            'duration': 300,
+            'license_plate': 'ABC123',
+            'description': 'Truck idling!'
+        })
+        self.assertEqual(len(lines), 1)
+
+        response = self.client.get('/admin/download_reports?format=xml')
+        self.assertEqual(response.status_code, 400)
+
+    def test_download_gzip(self):
+        self.add_report(datetime.datetime(2016, 1, 1), Agency(name='SEPTA'))
+        plain = self.client.get('/admin/download_reports').data
+        response = self.client.get('/admin/download_reports',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            gzip.GzipFile(fileobj=BytesIO(response.data)).read(), plain)
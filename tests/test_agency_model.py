@@ -50,4 +50,5 @@ class AgencyTestCase(unittest.TestCase):
         self.assertEqual(agency.name, 'SEPTA')
         self.assertTrue(agency.is_official)
         self.assertFalse(agency.is_public)
-        self.assertEqual(agency.incident_reports, [incident1, incident2])
+        self.assertItemsEqual(agency.incident_reports.all(),
+                              [incident1, incident2])
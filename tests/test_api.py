@@ -0,0 +1,183 @@
+import unittest
+import datetime
+import json
+from app import create_app, db
+from app.models import IncidentReport, Location, Agency
+
+
+class ApiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_report(self, latitude, longitude, date, agency,
+                   duration=datetime.timedelta(minutes=5)):
+        report = IncidentReport(
+            vehicle_id='123456',
+            location=Location(latitude=latitude, longitude=longitude,
+                              original_user_text='3700 Spruce St.'),
+            date=date,
+            duration=duration,
+            agency=agency,
+            description='Truck idling on the road!',
+            send_email_upon_creation=False
+        )
+        db.session.add(report)
+        db.session.commit()
+        return report
+
+    def get_json(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_reports_in_bounds(self):
+        agency = Agency(name='SEPTA', is_public=True)
+        date = datetime.datetime(2016, 1, 1, 12, 30)
+        inside = self.add_report('39.951', '-75.197', date, agency)
+        self.add_report('40.5', '-75.197', date, agency)
+
+        data = self.get_json('/api/reports?bbox=39.9,-75.3,40.1,-75.1')
+        self.assertEqual(len(data['reports']), 1)
+        report = data['reports'][0]
+        self.assertEqual(report['id'], inside.id)
+        self.assertAlmostEqual(report['lat'], 39.951)
+        self.assertAlmostEqual(report['lng'], -75.197)
+        self.assertEqual(report['date'], '2016-01-01T12:30:00')
+        self.assertEqual(report['duration'], 300)
+        self.assertEqual(report['agency'], 'SEPTA')
+        self.assertTrue(data['next'] is None)
+
+    def test_reports_date_range(self):
+        agency = Agency(name='SEPTA')
+        self.add_report('39.951', '-75.197',
+                        datetime.datetime(2015, 6, 1), agency)
+        june = self.add_report('39.951', '-75.197',
+                               datetime.datetime(2016, 6, 30, 23), agency)
+
+        data = self.get_json('/api/reports?start=2016-06-01&end=2016-06-30')
+        self.assertEqual([r['id'] for r in data['reports']], [june.id])
+
+    def test_reports_pagination(self):
+        agency = Agency(name='SEPTA')
+        date = datetime.datetime(2016, 1, 1)
+        ids = [self.add_report('39.951', '-75.197', date, agency).id
+               for _ in range(5)]
+
+        data = self.get_json('/api/reports?limit=2')
+        self.assertEqual([r['id'] for r in data['reports']], ids[:2])
+        self.assertEqual(data['next'], ids[1])
+
+        seen = [r['id'] for r in data['reports']]
+        while data['next'] is not None:
+            data = self.get_json('/api/reports?limit=2&after={}'
+                                 .format(data['next']))
+            seen.extend(r['id'] for r in data['reports'])
+        self.assertEqual(seen, ids)
+
+    def test_private_agency_hidden(self):
+        agency = Agency(name='SEPTA', is_public=False)
+        report = self.add_report('39.951', '-75.197',
+                                 datetime.datetime(2016, 1, 1), agency)
+
+        data = self.get_json('/api/reports')
+        self.assertTrue(data['reports'][0]['agency'] is None)
+
+        data = self.get_json('/api/reports/{}'.format(report.id))
+        self.assertFalse('agency' in data)
+        self.assertFalse('vehicle_id' in data)
+        self.assertEqual(data['description'], 'Truck idling on the road!')
+
+    def test_reports_near(self):
+        agency = Agency(name='SEPTA')
+        date = datetime.datetime(2016, 1, 1)
+        near = self.add_report(39.9515, -75.197, date, agency)
+        self.add_report(39.96, -75.197, date, agency)
+
+        data = self.get_json('/api/reports?near=39.951,-75.197&radius=100')
+        self.assertEqual([r['id'] for r in data['reports']], [near.id])
+
+        response = self.client.get('/api/reports?near=39.951,-75.197')
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_bounds(self):
+        response = self.client.get('/api/reports?bbox=north,west')
+        self.assertEqual(response.status_code, 400)
+
+    def test_clusters(self):
+        agency = Agency(name='SEPTA')
+        date = datetime.datetime(2016, 1, 1)
+        for i in range(15):
+            self.add_report('39.9510', '-75.1970', date, agency)
+        sparse = self.add_report('39.9800', '-75.1000', date, agency)
+
+        data = self.get_json(
+            '/api/clusters?zoom=12&bbox=39.9,-75.3,40.1,-75.0')
+        self.assertEqual(len(data['clusters']), 1)
+        cluster = data['clusters'][0]
+        self.assertEqual(cluster['count'], 15)
+        self.assertAlmostEqual(cluster['lat'], 39.951)
+        self.assertAlmostEqual(cluster['lng'], -75.197)
+        self.assertEqual([r['id'] for r in data['reports']], [sparse.id])
+
+        # At a low enough zoom level all reports share one cell
+        data = self.get_json('/api/clusters?zoom=6')
+        self.assertEqual([c['count'] for c in data['clusters']], [16])
+        self.assertEqual(data['reports'], [])
+
+    def test_clusters_require_zoom(self):
+        response = self.client.get('/api/clusters')
+        self.assertEqual(response.status_code, 400)
+
+    def test_hotspots(self):
+        septa = Agency(name='SEPTA', is_public=True)
+        peco = Agency(name='PECO', is_public=True)
+        date = datetime.datetime(2016, 1, 1)
+        for _ in range(3):
+            self.add_report(39.9510, -75.1970, date, septa)
+        for _ in range(2):
+            self.add_report(39.9800, -75.1000, date, peco,
+                            duration=datetime.timedelta(hours=1))
+        self.add_report(39.9800, -75.1000, datetime.datetime(2015, 1, 1),
+                        septa)
+
+        data = self.get_json('/api/hotspots?zoom=16')
+        self.assertEqual([(c['count'], c['duration'])
+                          for c in data['hotspots']], [(3, 900), (3, 7500)])
+        cell = data['hotspots'][0]
+        self.assertAlmostEqual(cell['lat'], 39.951)
+        self.assertAlmostEqual(cell['lng'], -75.197)
+        self.assertTrue(cell['south'] <= 39.951 < cell['north'])
+        self.assertTrue(cell['west'] <= -75.197 < cell['east'])
+
+        data = self.get_json('/api/hotspots?order=duration&limit=1')
+        self.assertEqual([c['count'] for c in data['hotspots']], [3])
+        self.assertAlmostEqual(data['hotspots'][0]['lat'], 39.98)
+
+        data = self.get_json('/api/hotspots?agency={}'.format(septa.id))
+        self.assertEqual([c['count'] for c in data['hotspots']], [3, 1])
+
+        data = self.get_json('/api/hotspots?start=2016-01-01')
+        self.assertEqual([c['count'] for c in data['hotspots']], [3, 2])
+
+    def test_hotspots_private_agency(self):
+        agency = Agency(name='SEPTA', is_public=False)
+        self.add_report(39.951, -75.197, datetime.datetime(2016, 1, 1),
+                        agency)
+
+        data = self.get_json('/api/hotspots?agency={}'.format(agency.id))
+        self.assertEqual(data['hotspots'], [])
+        data = self.get_json('/api/hotspots')
+        self.assertEqual([c['count'] for c in data['hotspots']], [1])
+
+    def test_hotspots_invalid_order(self):
+        response = self.client.get('/api/hotspots?order=name')
+        self.assertEqual(response.status_code, 400)
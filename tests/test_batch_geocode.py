@@ -0,0 +1,124 @@
+import threading
+import time
+import unittest
+from app import create_app, db, http_client
+from app.batch_geocode import batch_geocode
+from app.models import GeocodeResult
+from app.rate_limit import TokenBucket
+from app.utils import GeocodeError
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(20, capacity=1)
+        start = time.time()
+        for _ in range(11):
+            bucket.acquire()
+        self.assertTrue(time.time() - start >= 0.45)
+
+    def test_burst(self):
+        bucket = TokenBucket(1, capacity=5)
+        start = time.time()
+        for _ in range(5):
+            bucket.acquire()
+        self.assertTrue(time.time() - start < 0.5)
+
+
+class GeocodeResponse(object):
+    def __init__(self, result):
+        self.result = result
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.result
+
+
+class FakeGoogle(object):
+    def __init__(self):
+        self.keys = []
+        self.lock = threading.Lock()
+
+    def get(self, url, params):
+        with self.lock:
+            self.keys.append(params['key'])
+        if params['address'] == 'nowhere':
+            return GeocodeResponse({'status': 'ZERO_RESULTS', 'results': []})
+        location = {'lat': 39.95, 'lng': -75.16}
+        return GeocodeResponse({'status': 'OK',
+                                'results': [{'geometry': {
+                                    'location': location}}]})
+
+
+class BatchGeocodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.viewport = self.app.config['VIEWPORT']
+        self.requested = []
+        self.lock = threading.Lock()
+        self.google = http_client.google
+
+    def tearDown(self):
+        http_client.google = self.google
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def geocoder(self, address):
+        with self.lock:
+            self.requested.append(address)
+        if address.startswith('nowhere'):
+            return None, None
+        if address.startswith('timeout'):
+            raise GeocodeError('UNKNOWN_ERROR')
+        return 39.95, -75.16
+
+    def test_duplicates_geocoded_once(self):
+        addresses = ['Broad & Arch', 'broad  &  arch', '3700 Spruce St.',
+                     'Broad & Arch']
+        coords = batch_geocode(addresses, rate=100, geocoder=self.geocoder)
+        self.assertEqual(len(self.requested), 2)
+        self.assertEqual(sorted(coords.keys()), sorted(set(addresses)))
+        for address in addresses:
+            self.assertEqual(coords[address], (39.95, -75.16))
+
+    def test_cached_results_used(self):
+        GeocodeResult.store('broad & arch', self.viewport, 39.954659,
+                            -75.163059)
+        db.session.commit()
+
+        coords = batch_geocode(['Broad & Arch', '3700 Spruce St.'], rate=100,
+                               geocoder=self.geocoder)
+        self.assertEqual(self.requested, ['3700 Spruce St.'])
+        self.assertEqual(coords['Broad & Arch'], (39.954659, -75.163059))
+
+    def test_results_cached(self):
+        batch_geocode(['3700 Spruce St.', 'nowhere', 'timeout'], rate=100,
+                      geocoder=self.geocoder)
+        db.session.commit()
+
+        result = GeocodeResult.lookup('3700 Spruce St.', self.viewport)
+        self.assertEqual((result.latitude, result.longitude), (39.95, -75.16))
+        result = GeocodeResult.lookup('nowhere', self.viewport)
+        self.assertTrue(result.latitude is None)
+        # Transient failures are not cached
+        self.assertTrue(GeocodeResult.lookup('timeout', self.viewport) is None)
+
+    def test_failures_have_no_coordinates(self):
+        coords = batch_geocode(['timeout'], rate=100, geocoder=self.geocoder)
+        self.assertEqual(coords['timeout'], (None, None))
+
+    def test_google_geocoder(self):
+        # Geocoded in threads without an app context, without a key
+        http_client.google = FakeGoogle()
+        self.assertIsNone(self.app.config['GOOGLE_GEOCODE_KEY'])
+        coords = batch_geocode(['Broad & Arch', '3700 Spruce St.', 'nowhere'],
+                               workers=2, rate=100)
+        self.assertEqual(coords, {'Broad & Arch': (39.95, -75.16),
+                                  '3700 Spruce St.': (39.95, -75.16),
+                                  'nowhere': (None, None)})
+        self.assertEqual(http_client.google.keys, [None] * 3)
@@ -0,0 +1,83 @@
+import time
+import unittest
+from app import create_app, db
+from app.cache import LRUCache, RedisStore
+from app.models import Location
+from app.utils import get_current_weather, weather_cache, weather_cache_key
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1, ttl=60)
+        cache.set('b', 2, ttl=60)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3, ttl=60)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expires(self):
+        cache = LRUCache()
+        cache.set('a', 1, ttl=0.01)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+
+
+class RedisStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_set_and_get(self):
+        # Kept in this process if there's no Redis server to keep it
+        store = RedisStore('test-store:')
+        self.assertIsNone(store.get('a'))
+        store.set('a', [1, 'b'], ttl=60)
+        self.assertEqual(store.get('a'), [1, 'b'])
+
+
+class WeatherCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        weather_cache.clear_local()
+
+    def tearDown(self):
+        weather_cache.clear_local()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_key_by_cell_and_window(self):
+        now = 1451649600  # 2016-01-01 12:00 UTC, the start of a window
+        key, ttl = weather_cache_key(39.951, -75.197, now)
+        self.assertEqual(ttl, 15 * 60)
+
+        # Within the same 0.05 degree cell and 15 minutes
+        self.assertEqual(weather_cache_key(39.999, -75.151, now + 899)[0],
+                         key)
+        self.assertNotEqual(weather_cache_key(40.001, -75.197, now)[0], key)
+        self.assertNotEqual(weather_cache_key(39.951, -75.201, now)[0], key)
+        self.assertNotEqual(weather_cache_key(39.951, -75.197, now + 900)[0],
+                            key)
+
+    def test_cached_weather_reused_nearby(self):
+        key, ttl = weather_cache_key(39.951, -75.197)
+        weather_cache.set(key, 'Description: clear sky', ttl)
+
+        # Doesn't ask the weather service for a report in the same cell
+        nearby = Location(latitude=39.952, longitude=-75.198)
+        self.assertEqual(get_current_weather(nearby),
+                         'Description: clear sky')
+
+    def test_no_weather_without_coordinates(self):
+        self.assertIsNone(get_current_weather(
+            Location(original_user_text='broad & arch')))
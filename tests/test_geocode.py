@@ -1,5 +1,25 @@
 import unittest
-from app.utils import geocode
+import datetime
+from app import create_app, db, http_client
+from app.models import GeocodeResult
+from app.utils import geocode, normalize_address
+
+
+class OverQueryLimitResponse(object):
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {'status': 'OVER_QUERY_LIMIT', 'results': []}
+
+
+class FakeUpstream(object):
+    def __init__(self):
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return OverQueryLimitResponse()
 
 
 class ParseCsvTestCase(unittest.TestCase):
@@ -23,3 +43,81 @@ class ParseCsvTestCase(unittest.TestCase):
         loc4 = geocode('I am happy!')
         self.assertTrue(loc4[0] is None)
         self.assertTrue(loc4[1] is None)
+
+
+class GeocodeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.viewport = self.app.config['VIEWPORT']
+        self.google = http_client.google
+
+    def tearDown(self):
+        http_client.google = self.google
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_normalize_address(self):
+        self.assertEqual(normalize_address('Broad & Arch'), 'broad & arch')
+        self.assertEqual(normalize_address(' broad and  arch. '),
+                         'broad & arch')
+        self.assertEqual(normalize_address('Broad&ARCH'), 'broad & arch')
+        self.assertEqual(normalize_address('34th St at Spruce'),
+                         '34th st & spruce')
+
+    def test_cached_geocode(self):
+        GeocodeResult.store('Broad & Arch', self.viewport, 39.954659,
+                            -75.163059)
+        db.session.commit()
+
+        # No geocoding key is configured, so these can only come from the
+        # cache
+        self.assertEqual(geocode('broad and arch'), (39.954659, -75.163059))
+        self.assertEqual(geocode('BROAD & ARCH '), (39.954659, -75.163059))
+
+    def test_cached_failed_geocode(self):
+        GeocodeResult.store('I am happy!', self.viewport, None, None)
+        db.session.commit()
+        self.assertEqual(geocode('i am happy'), (None, None))
+
+    def test_cache_keyed_on_viewport(self):
+        GeocodeResult.store('Broad & Arch', self.viewport, 39.954659,
+                            -75.163059)
+        db.session.commit()
+        self.assertTrue(GeocodeResult.lookup('Broad & Arch',
+                                             '0,0|1,1') is None)
+
+    def test_expired_results_evicted(self):
+        expired = GeocodeResult.store('Broad & Arch', self.viewport,
+                                      39.954659, -75.163059)
+        expired.expires = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=1)
+        GeocodeResult.store('15 & chestnut', self.viewport, 39.951304,
+                            -75.165601)
+        db.session.commit()
+
+        self.assertTrue(GeocodeResult.lookup('Broad & Arch',
+                                             self.viewport) is None)
+        self.assertEqual(GeocodeResult.evict(), 1)
+        self.assertEqual(GeocodeResult.query.count(), 1)
+
+    def test_evict_max_entries(self):
+        for address in ['Broad & Arch', '15 & chestnut', 'Poplar & American']:
+            GeocodeResult.store(address, self.viewport, 39.95, -75.16)
+        db.session.commit()
+
+        GeocodeResult.evict(max_entries=2)
+        self.assertEqual(GeocodeResult.query.count(), 2)
+        self.assertTrue(GeocodeResult.lookup('Broad & Arch',
+                                             self.viewport) is None)
+
+    def test_over_query_limit_not_retried(self):
+        # Geocoding in a web request doesn't wait to retry
+        http_client.google = FakeUpstream()
+        self.assertEqual(geocode('broad & arch'), (None, None))
+        self.assertEqual(http_client.google.requests, 1)
+        # Nor caches the failure, as it's temporary
+        self.assertIsNone(GeocodeResult.lookup('broad & arch', self.viewport))
@@ -0,0 +1,96 @@
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+
+import requests
+from app.http_client import Upstream
+from app.metrics import upstream_latency
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    """Answers each request with the next (status, delay) in the server's
+    script, and keeps the connections it was sent on."""
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        self.server.connections.add(self.client_address)
+        status, delay = self.server.script.pop(0)
+        time.sleep(delay)
+        body = '{"ok": true}'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class UpstreamServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class UpstreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer(('127.0.0.1', 0), UpstreamHandler)
+        self.server.script = []
+        self.server.connections = set()
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_port)
+        self.upstream = Upstream('test', read_timeout=0.2, backoff=0)
+        upstream_latency.clear()
+
+    def tearDown(self):
+        upstream_latency.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def outcome_count(self, outcome):
+        histogram = upstream_latency.get('test', outcome)
+        return histogram.cumulative_counts()[-1][1] if histogram else 0
+
+    def test_connections_reused(self):
+        self.server.script = [(200, 0)] * 3
+        for i in range(3):
+            self.assertEqual(self.upstream.get(self.url).json(), {'ok': True})
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(self.outcome_count('2xx'), 3)
+
+    def test_retries_server_errors(self):
+        self.server.script = [(503, 0), (502, 0), (200, 0)]
+        response = self.upstream.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.outcome_count('5xx'), 2)
+        self.assertEqual(self.outcome_count('2xx'), 1)
+
+        # Up to max_retries times
+        self.server.script = [(503, 0)] * 3
+        self.assertEqual(self.upstream.get(self.url).status_code, 503)
+        self.assertEqual(self.server.script, [])
+
+    def test_post_not_retried(self):
+        self.server.script = [(503, 0), (200, 0)]
+        self.assertEqual(self.upstream.post(self.url).status_code, 503)
+        self.assertEqual(len(self.server.script), 1)
+
+    def test_client_errors_not_retried(self):
+        self.server.script = [(404, 0), (200, 0)]
+        self.assertEqual(self.upstream.get(self.url).status_code, 404)
+        self.assertEqual(self.outcome_count('4xx'), 1)
+
+    def test_timeout(self):
+        self.server.script = [(200, 0.5)] * 3
+        self.assertRaises(requests.Timeout, self.upstream.get, self.url)
+        self.assertEqual(self.outcome_count('timeout'), 3)
+
+    def test_connection_error(self):
+        upstream = Upstream('test', max_retries=1, backoff=0)
+        self.assertRaises(requests.ConnectionError, upstream.get,
+                          'http://127.0.0.1:1/')
+        self.assertEqual(self.outcome_count('connection_error'), 2)
@@ -0,0 +1,289 @@
+import hashlib
+import struct
+import unittest
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+from werkzeug.datastructures import FileStorage
+from app import create_app, db, images
+from app.images import (
+    SPOOL_PREFIX,
+    attach_picture,
+    attach_uploaded_picture,
+    process_image,
+    release_pictures,
+    spool_image,
+    upload_report_picture,
+)
+from app.models import Agency, GeocodeResult, IncidentReport, StoredImage
+from test_incident_report import FakeQueue
+
+# EXIF data with only an orientation of 6, i.e. the picture must be rotated
+# 90 degrees clockwise to be upright
+ROTATED_EXIF = (b'Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08' +
+                struct.pack('>HHHIHHI', 1, 0x0112, 3, 1, 6, 0, 0))
+
+
+def image_data(size, mode='RGB', color='red', format='JPEG', **kwargs):
+    output = BytesIO()
+    Image.new(mode, size, color).save(output, format, **kwargs)
+    return output.getvalue()
+
+
+def striped_image_data(quality):
+    image = Image.new('RGB', (400, 300), 'white')
+    draw = ImageDraw.Draw(image)
+    for x in range(0, 400, 40):
+        draw.rectangle([x, 0, x + 20, 300], fill=(x // 2, 0, 255 - x // 2))
+    output = BytesIO()
+    image.save(output, 'JPEG', quality=quality)
+    return output.getvalue()
+
+
+class ProcessImageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_downscaled(self):
+        image, thumbnail = process_image(image_data((4000, 3000)))
+        image, thumbnail = Image.open(BytesIO(image)), \
+            Image.open(BytesIO(thumbnail))
+        self.assertEqual(image.format, 'JPEG')
+        self.assertEqual(image.size, (1600, 1200))
+        self.assertEqual(thumbnail.size, (320, 240))
+
+    def test_small_image_not_enlarged(self):
+        image, thumbnail = process_image(image_data((200, 100)))
+        self.assertEqual(Image.open(BytesIO(image)).size, (200, 100))
+        self.assertEqual(Image.open(BytesIO(thumbnail)).size, (200, 100))
+
+    def test_exif_removed_after_rotating(self):
+        data = image_data((200, 100), exif=ROTATED_EXIF)
+        self.assertEqual(Image.open(BytesIO(data))._getexif()[0x0112], 6)
+
+        image = Image.open(BytesIO(process_image(data)[0]))
+        self.assertEqual(image.size, (100, 200))
+        self.assertNotIn('exif', image.info)
+
+    def test_transparent_png(self):
+        data = image_data((100, 100), mode='RGBA', color=(0, 0, 0, 0),
+                          format='PNG')
+        image = Image.open(BytesIO(process_image(data)[0]))
+        self.assertEqual(image.format, 'JPEG')
+        # Transparent parts become white
+        self.assertGreater(min(image.getpixel((50, 50))), 250)
+
+    def test_not_an_image(self):
+        self.assertRaises(IOError, process_image, b'<svg></svg>')
+
+
+class AttachPictureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.uploads = []
+        self.upload_image = images.upload_image
+        images.upload_image = self.fake_upload_image
+        self.queue = FakeQueue()
+        self.get_queue = images.get_queue
+        images.get_queue = lambda: self.queue
+
+    def tearDown(self):
+        images.upload_image = self.upload_image
+        images.get_queue = self.get_queue
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def fake_upload_image(self, image_data, **kwargs):
+        self.uploads.append(Image.open(BytesIO(image_data)).size)
+        n = len(self.uploads)
+        return 'http://i.imgur.com/{}.jpg'.format(n), 'hash{}'.format(n)
+
+    def add_report(self):
+        report = IncidentReport(description='Idling',
+                                send_email_upon_creation=False,
+                                picture_pending=True)
+        db.session.add(report)
+        db.session.commit()
+        return report
+
+    def test_picture_and_thumbnail_uploaded(self):
+        report = self.add_report()
+        attach_picture(report, image_data((3200, 1600)))
+
+        self.assertEqual(self.uploads, [(1600, 800), (320, 160)])
+        report = IncidentReport.query.get(report.id)
+        self.assertEqual(report.picture_url, 'http://i.imgur.com/1.jpg')
+        self.assertEqual(report.picture_deletehash, 'hash1')
+        self.assertEqual(report.picture_thumbnail_url,
+                         'http://i.imgur.com/2.jpg')
+        self.assertEqual(report.picture_thumbnail_deletehash, 'hash2')
+        self.assertFalse(report.picture_pending)
+
+    def test_not_an_image(self):
+        report = self.add_report()
+        attach_picture(report, b'not an image')
+
+        self.assertEqual(self.uploads, [])
+        report = IncidentReport.query.get(report.id)
+        self.assertIsNone(report.picture_url)
+        self.assertFalse(report.picture_pending)
+
+    def test_same_picture_stored_once(self):
+        first, second = self.add_report(), self.add_report()
+        data = image_data((3200, 1600))
+        attach_picture(first, data)
+        attach_picture(second, data)
+
+        self.assertEqual(len(self.uploads), 2)  # the picture and thumbnail
+        self.assertEqual(StoredImage.query.count(), 1)
+        second = IncidentReport.query.get(second.id)
+        self.assertEqual(second.picture_url, 'http://i.imgur.com/1.jpg')
+        self.assertEqual(second.picture_thumbnail_url,
+                         'http://i.imgur.com/2.jpg')
+        self.assertFalse(second.picture_pending)
+
+    def test_perceptual_dedup(self):
+        attach_picture(self.add_report(), striped_image_data(quality=95))
+        attach_picture(self.add_report(), striped_image_data(quality=50))
+        self.assertEqual(len(self.uploads), 4)
+
+        self.app.config['IMAGE_DEDUP_PERCEPTUAL'] = True
+        attach_picture(self.add_report(), striped_image_data(quality=70))
+        self.assertEqual(len(self.uploads), 4)
+        self.assertEqual(StoredImage.query.count(), 2)
+
+    def test_release_shared_picture(self):
+        first, second = self.add_report(), self.add_report()
+        data = image_data((3200, 1600))
+        attach_picture(first, data)
+        attach_picture(second, data)
+
+        # Still used by the second report
+        release_pictures(first)
+        self.assertEqual(self.queue.jobs, [])
+        db.session.delete(first)
+        db.session.commit()
+
+        release_pictures(second)
+        self.assertEqual([args for func, args in self.queue.jobs],
+                         [('hash1',), ('hash2',)])
+        self.assertEqual(StoredImage.query.count(), 0)
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+
+    def setex(self, name, value, time):
+        self.values[name] = value
+
+    def get(self, name):
+        return self.values.get(name)
+
+
+class SpooledPictureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.redis = FakeRedis()
+        self.get_connection = images.get_connection
+        images.get_connection = lambda: self.redis
+        self.queue = FakeQueue()
+        self.get_queue = images.get_queue
+        images.get_queue = lambda: self.queue
+        self.uploads = 0
+        self.upload_image = images.upload_image
+        images.upload_image = self.fake_upload_image
+
+    def tearDown(self):
+        images.get_connection = self.get_connection
+        images.get_queue = self.get_queue
+        images.upload_image = self.upload_image
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def fake_upload_image(self, image_data):
+        self.uploads += 1
+        return ('http://i.imgur.com/{}.jpg'.format(self.uploads),
+                'hash{}'.format(self.uploads))
+
+    def add_report(self):
+        report = IncidentReport(description='Idling',
+                                send_email_upon_creation=False,
+                                picture_pending=True)
+        db.session.add(report)
+        db.session.commit()
+        return report
+
+    def test_spool_image(self):
+        data = image_data((100, 100))
+        key = spool_image(data)
+        self.assertEqual(key, hashlib.sha256(data).hexdigest())
+        self.assertEqual(self.redis.get(SPOOL_PREFIX + key), data)
+        self.assertEqual(spool_image(data), key)
+
+    def test_attach_uploaded_picture(self):
+        data = image_data((100, 100))
+        report = IncidentReport(description='Idling',
+                                send_email_upon_creation=False)
+        key = attach_uploaded_picture(
+            report, FileStorage(BytesIO(data), filename='bus.jpg'))
+        self.assertTrue(report.picture_pending)
+        self.assertEqual(self.redis.get(SPOOL_PREFIX + key), data)
+
+    def test_upload_report_picture(self):
+        report = self.add_report()
+        upload_report_picture(report.id, spool_image(image_data((100, 100))))
+
+        report = IncidentReport.query.get(report.id)
+        self.assertEqual(report.picture_url, 'http://i.imgur.com/1.jpg')
+        self.assertEqual(report.picture_deletehash, 'hash1')
+        self.assertEqual(report.picture_thumbnail_url,
+                         'http://i.imgur.com/2.jpg')
+        self.assertFalse(report.picture_pending)
+
+    def test_upload_expired_picture(self):
+        report = self.add_report()
+        upload_report_picture(report.id, 'expired')
+
+        self.assertEqual(self.uploads, 0)
+        report = IncidentReport.query.get(report.id)
+        self.assertIsNone(report.picture_url)
+        self.assertFalse(report.picture_pending)
+
+    def test_report_form_enqueues_upload(self):
+        Agency.insert_agencies()
+        GeocodeResult.store('broad & arch', self.app.config['VIEWPORT'],
+                            39.954659, -75.163059)
+        db.session.commit()
+        data = image_data((100, 100))
+
+        self.app.test_client().post('/', data={
+            'vehicle_id': '105014',
+            'location': 'broad & arch',
+            'date': '2016-01-01',
+            'time': '12:30',
+            'duration': '5',
+            'agency': str(Agency.query.filter_by(
+                is_official=True).first().id),
+            'picture_file': (BytesIO(data), 'bus.jpg'),
+        })
+
+        report = IncidentReport.query.one()
+        self.assertTrue(report.picture_pending)
+        key = hashlib.sha256(data).hexdigest()
+        self.assertEqual(self.redis.get(SPOOL_PREFIX + key), data)
+        self.assertEqual(self.queue.jobs,
+                         [(upload_report_picture, (report.id, key))])
@@ -2,6 +2,7 @@ import unittest
 import datetime
 from app import create_app, db
 from app.models import IncidentReport, Location, Agency, User
+from app.models import incident_report
 
 
 class IncidentReportTestCase(unittest.TestCase):
@@ -171,3 +172,213 @@ class IncidentReportTestCase(unittest.TestCase):
 
         self.assertTrue(incident1.show_agency_publicly)
         self.assertFalse(incident2.show_agency_publicly)
+
+
+def query_plan(query):
+    """The details of SQLite's EXPLAIN QUERY PLAN for a query, joined."""
+    sql = query.with_labels().statement.compile(
+        db.engine, compile_kwargs={'literal_binds': True})
+    plan = db.session.execute('EXPLAIN QUERY PLAN ' + str(sql))
+    return ' '.join(row[3] for row in plan)
+
+
+class ReportListingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_listing_newest_first(self):
+        agency = Agency(name='SEPTA')
+        for day in [2, 3, 1]:
+            db.session.add(IncidentReport(
+                date=datetime.datetime(2016, 1, day),
+                agency=agency,
+                description='Truck idling on the road!',
+                send_email_upon_creation=False
+            ))
+        db.session.commit()
+
+        reports = IncidentReport.listing_query(agency_ids=[agency.id]).all()
+        self.assertEqual([r.date.day for r in reports], [3, 2, 1])
+
+    def test_agency_listing_uses_index(self):
+        plan = query_plan(IncidentReport.listing_query(agency_ids=[1]))
+        self.assertTrue('ix_incident_reports_agency_id_date' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def test_user_listing_uses_index(self):
+        plan = query_plan(IncidentReport.listing_query(user_id=1))
+        self.assertTrue('ix_incident_reports_user_id_date' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def test_listing_uses_index(self):
+        plan = query_plan(IncidentReport.listing_query())
+        self.assertTrue('ix_incident_reports_date' in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+
+class LocationSpatialTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_location(self, latitude, longitude):
+        location = Location(latitude=latitude, longitude=longitude,
+                            original_user_text='3700 Spruce St.')
+        db.session.add(location)
+        db.session.commit()
+        return location
+
+    def locations_within(self, criterion):
+        return [location.id for location in Location.query.filter(criterion)
+                .order_by(Location.id)]
+
+    def test_numeric_coordinates(self):
+        location = self.add_location('39.951039', '-75.197428')
+        db.session.expire_all()
+        self.assertEqual(location.latitude, 39.951039)
+        self.assertEqual(location.longitude, -75.197428)
+
+    def test_within_bounds(self):
+        inside = self.add_location(39.951, -75.197)
+        edge = self.add_location(39.9, -75.1)
+        self.add_location(40.5, -75.197)
+        self.add_location(None, None)
+
+        within = Location.within_bounds(39.9, -75.3, 40.1, -75.1)
+        self.assertEqual(self.locations_within(within), [inside.id, edge.id])
+
+        # The spatial index follows moved and deleted locations
+        inside.latitude = 41.0
+        db.session.delete(edge)
+        db.session.commit()
+        self.assertEqual(self.locations_within(within), [])
+        self.assertEqual(self.locations_within(
+            Location.within_bounds(40.9, -75.3, 41.1, -75.1)), [inside.id])
+
+    def test_within_bounds_uses_index(self):
+        plan = query_plan(Location.query.filter(
+            Location.within_bounds(39.9, -75.3, 40.1, -75.1)))
+        self.assertTrue('VIRTUAL TABLE INDEX' in plan, plan)
+        self.assertTrue('SEARCH locations USING INTEGER PRIMARY KEY' in plan,
+                        plan)
+
+    def test_within_radius(self):
+        # Roughly 110m north and 170m east of the center
+        center = (39.951, -75.197)
+        north = self.add_location(39.952, -75.197)
+        east = self.add_location(39.951, -75.195)
+        self.add_location(39.953, -75.195)
+
+        self.assertEqual(self.locations_within(
+            Location.within_radius(center[0], center[1], 150)), [north.id])
+        self.assertEqual(self.locations_within(
+            Location.within_radius(center[0], center[1], 200)),
+            [north.id, east.id])
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.jobs = []
+
+    def enqueue(self, func, *args):
+        self.jobs.append((func, args))
+
+
+class WeatherEnrichmentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        self.queue = FakeQueue()
+        self.get_queue = incident_report.get_queue
+        incident_report.get_queue = lambda: self.queue
+
+    def tearDown(self):
+        incident_report.get_queue = self.get_queue
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def new_report(self, date=None):
+        return IncidentReport(
+            vehicle_id='123456',
+            date=date,
+            duration=datetime.timedelta(minutes=5),
+            location=Location(latitude=39.951, longitude=-75.197,
+                              original_user_text='3700 Spruce St.'),
+            description='Truck idling on the road!',
+            send_email_upon_creation=False
+        )
+
+    def test_weather_looked_up_after_commit(self):
+        report = self.new_report()
+        self.assertIsNone(report.weather)
+
+        db.session.add(report)
+        db.session.flush()
+        self.assertEqual(self.queue.jobs, [])
+        db.session.commit()
+        self.assertEqual(self.queue.jobs,
+                         [(incident_report.fill_in_weather, (report.id,))])
+
+        # Later commits don't look it up again
+        report.vehicle_id = '654321'
+        db.session.commit()
+        self.assertEqual(len(self.queue.jobs), 1)
+
+    def test_weather_not_looked_up_for_old_reports(self):
+        db.session.add(self.new_report(datetime.datetime(2016, 1, 1)))
+        db.session.commit()
+        self.assertEqual(self.queue.jobs, [])
+
+    def test_weather_not_looked_up_after_rollback(self):
+        db.session.add(self.new_report())
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(self.queue.jobs, [])
+
+    def test_fill_in_weather_keeps_existing_weather(self):
+        report = self.new_report()
+        report.weather = 'Sunny'
+        db.session.add(report)
+        db.session.commit()
+        self.assertEqual(self.queue.jobs, [])
+
+        # Returns before looking up the weather
+        incident_report.fill_in_weather(report.id)
+        self.assertEqual(IncidentReport.query.get(report.id).weather, 'Sunny')
+
+    def test_fill_in_weather_skips_location_without_coordinates(self):
+        report = self.new_report()
+        report.location.latitude = report.location.longitude = None
+        db.session.add(report)
+        db.session.commit()
+        self.assertEqual(len(self.queue.jobs), 1)
+
+        def get_current_weather(location, rate_limiter=None):
+            self.fail('Looked up the weather without coordinates')
+        original = incident_report.get_current_weather
+        incident_report.get_current_weather = get_current_weather
+        try:
+            incident_report.fill_in_weather(report.id)
+        finally:
+            incident_report.get_current_weather = original
+        self.assertIsNone(IncidentReport.query.get(report.id).weather)
@@ -0,0 +1,82 @@
+import logging
+import unittest
+from app import create_app, db
+from app.instrumentation import RequestStats
+from app.models import Agency
+from query_counter import QueryCounter
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        Agency.insert_agencies()
+
+        self.log = ListHandler()
+        self.app.logger.addHandler(self.log)
+
+    def tearDown(self):
+        self.app.logger.removeHandler(self.log)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_no_headers_by_default(self):
+        response = self.client.get('/api/reports')
+        self.assertFalse('X-DB-Queries' in response.headers)
+        self.assertEqual(self.log.messages, [])
+
+    def test_headers(self):
+        self.app.config['DB_STATS_HEADERS'] = True
+        with QueryCounter() as counter:
+            response = self.client.get('/')
+        self.assertEqual(response.headers['X-DB-Queries'],
+                         str(counter.statements))
+        self.assertTrue(float(response.headers['X-DB-Time']) >= 0)
+        self.assertTrue(float(response.headers['X-Request-Time']) >=
+                        float(response.headers['X-DB-Time']))
+
+    def test_slow_request_logged(self):
+        with QueryCounter() as counter:
+            self.client.get('/?ref=test')
+        self.assertEqual(self.log.messages, [])
+
+        self.app.config['SLOW_REQUEST_QUERIES'] = counter.statements - 1
+        self.client.get('/?ref=test')
+        self.assertEqual(len(self.log.messages), 1)
+        message = self.log.messages[0]
+        self.assertTrue(message.startswith(
+            'Slow request GET /?ref=test: ran {} queries'.format(
+                counter.statements)), message)
+        self.assertTrue('FROM agencies' in message, message)
+
+        self.app.config['SLOW_REQUEST_QUERIES'] = counter.statements
+        self.client.get('/?ref=test')
+        self.assertEqual(len(self.log.messages), 1)
+
+    def test_slow_query_logged(self):
+        self.app.config['SLOW_QUERY_TIME'] = 0
+        self.client.get('/api/reports')
+        self.assertEqual(len(self.log.messages), 1)
+        self.assertTrue('ran slow queries' in self.log.messages[0])
+
+    def test_keeps_slowest_statements(self):
+        stats = RequestStats(keep_slowest=2)
+        for statement, duration in [('a', 0.3), ('b', 0.1), ('c', 0.5),
+                                    ('d', 0.2)]:
+            stats.record(statement, duration)
+        self.assertEqual(stats.queries, 4)
+        self.assertAlmostEqual(stats.db_time, 1.1)
+        self.assertEqual(stats.slowest_statements(), [(0.5, 'c'), (0.3, 'a')])
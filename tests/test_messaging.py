@@ -0,0 +1,86 @@
+import unittest
+import twilio.twiml
+from app import create_app, db
+from app.models import Agency, GeocodeResult, IncidentReport
+from app.main.messaging import (
+    STEP_AGENCY,
+    STEP_INIT,
+    STEP_LOCATION,
+    conversations,
+    handle_location_step,
+    load_conversation,
+    save_conversation,
+)
+
+
+class MessagingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        conversations.clear_local()
+
+    def tearDown(self):
+        conversations.clear_local()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_conversation_round_trip(self):
+        conversation = load_conversation('+12155550100')
+        self.assertEqual(conversation['step'], STEP_INIT)
+
+        conversation.update(step=STEP_AGENCY, location='broad & arch',
+                            lat=39.954659, lng=-75.163059)
+        save_conversation('+12155550100', conversation)
+        self.assertEqual(load_conversation('+12155550100'), conversation)
+        self.assertEqual(load_conversation('+12155550101')['step'],
+                         STEP_INIT)
+
+    def test_report_by_sms(self):
+        Agency.insert_agencies()
+        GeocodeResult.store('broad & arch', self.app.config['VIEWPORT'],
+                            39.954659, -75.163059)
+        db.session.commit()
+        client = self.app.test_client()
+
+        def send(body):
+            response = client.get('/report_incident', query_string={
+                'Body': body, 'NumMedia': '0', 'From': '+12155550100',
+                'MessageSid': 'SM1'})
+            self.assertNotIn('messagecount',
+                             response.headers.get('Set-Cookie', ''))
+            return response.data
+
+        send('report')
+        send('broad & arch')
+        send('A')
+        send('no')
+        send('105014')
+        send('10')
+        send('The driver is sleeping')
+        self.assertIn('Thanks!', send('no'))
+
+        report = IncidentReport.query.one()
+        self.assertEqual(report.vehicle_id, '105014')
+        self.assertEqual(report.description, 'the driver is sleeping')
+        self.assertEqual(report.location.original_user_text, 'broad & arch')
+        self.assertAlmostEqual(float(report.location.latitude), 39.954659)
+        self.assertEqual(report.duration.total_seconds(), 600)
+        self.assertEqual(load_conversation('+12155550100')['step'],
+                         STEP_INIT)
+
+    def test_location_step_keeps_coordinates(self):
+        Agency.insert_agencies()
+        GeocodeResult.store('broad & arch', self.app.config['VIEWPORT'],
+                            39.954659, -75.163059)
+        db.session.commit()
+
+        with self.app.test_request_context():
+            twiml = twilio.twiml.Response()
+            location, lat, lng, step = handle_location_step(
+                'broad & arch', STEP_LOCATION, twiml)
+        self.assertEqual(location, 'broad & arch')
+        self.assertEqual((lat, lng), (39.954659, -75.163059))
+        self.assertEqual(step, STEP_AGENCY)
@@ -0,0 +1,102 @@
+import time
+import unittest
+from app import create_app, db
+from app.metrics import Histogram, latency, log_linear_bounds, timed_phase
+from app.models import Role, User
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_log_linear_bounds(self):
+        self.assertEqual(log_linear_bounds(1, 8, 1), [1, 2, 4, 8])
+        bounds = log_linear_bounds(0.001, 1.024, 4)
+        self.assertEqual(len(bounds), 41)
+        for lower, upper in zip(bounds, bounds[1:]):
+            self.assertAlmostEqual(upper / lower, 2 ** 0.25, places=6)
+
+    def test_cumulative_counts(self):
+        histogram = Histogram(bounds=[1, 2, 4])
+        for value in [0.5, 1, 1.5, 3, 3, 10]:
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative_counts(),
+                         [(1, 2), (2, 3), (4, 5), (float('inf'), 6)])
+        self.assertEqual(histogram.sum, 19)
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        Role.insert_roles()
+        latency.clear()
+
+        @self.app.route('/slow-call')
+        def slow_call():
+            with timed_phase('http'):
+                time.sleep(0.01)
+            return 'OK'
+
+    def tearDown(self):
+        latency.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, email):
+        user = User(first_name='Test', last_name='User', confirmed=True,
+                    email=email, password='password')
+        db.session.add(user)
+        db.session.commit()
+        self.client.post('/account/login', data={
+            'email': email,
+            'password': 'password'
+        })
+
+    def test_phases_recorded(self):
+        self.client.get('/')
+        self.client.get('/')
+        total = latency.get('main.index', 'total')
+        self.assertEqual(total.cumulative_counts()[-1][1], 2)
+        self.assertTrue(latency.get('main.index', 'template').sum > 0)
+        self.assertTrue(latency.get('main.index', 'db').sum > 0)
+        self.assertTrue(total.sum >= latency.get('main.index',
+                                                 'template').sum)
+
+        self.client.get('/slow-call')
+        self.assertTrue(latency.get('slow_call', 'http').sum >= 0.01)
+        self.assertEqual(latency.get('slow_call', 'template').sum, 0)
+
+    def test_prometheus_text(self):
+        self.client.get('/slow-call')
+        self.login(self.app.config['ADMIN_EMAIL'])
+        response = self.client.get('/admin/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        lines = response.data.splitlines()
+        self.assertTrue('# TYPE request_duration_seconds histogram' in lines)
+        self.assertTrue('request_duration_seconds_bucket{endpoint="slow_call",'
+                        'phase="http",le="+Inf"} 1' in lines)
+        self.assertTrue('request_duration_seconds_count{endpoint="slow_call",'
+                        'phase="total"} 1' in lines)
+
+    def test_metrics_protected(self):
+        response = self.client.get('/admin/metrics')
+        self.assertEqual(response.status_code, 302)
+
+        self.login('user@example.com')
+        response = self.client.get('/admin/metrics')
+        self.assertEqual(response.status_code, 403)
+
+    def test_metrics_token(self):
+        headers = {'Authorization': 'Bearer secret'}
+        response = self.client.get('/admin/metrics', headers=headers)
+        self.assertEqual(response.status_code, 302)
+
+        self.app.config['METRICS_TOKEN'] = 'secret'
+        response = self.client.get('/admin/metrics', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/admin/metrics', headers={
+            'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 302)
@@ -1,7 +1,17 @@
+import csv
+import os
+import shutil
+import tempfile
 import unittest
 from app import create_app, db
-from app.models import Location, IncidentReport
-from app.parse_csv import parse_to_db
+from app.models import (
+    Agency,
+    GeocodeResult,
+    ImportCheckpoint,
+    IncidentReport,
+    Location
+)
+from app.parse_csv import hash_file, parse_to_db, shard_file
 
 
 class ParseCsvTestCase(unittest.TestCase):
@@ -84,3 +94,147 @@ class ParseCsvTestCase(unittest.TestCase):
         self.assertTrue(str(i3.duration) == duration3)
         self.assertTrue(i3.picture_url == pic3)
         self.assertTrue(i3.description == desc3)
+
+
+class BulkParseCsvTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        # Seed the geocode cache so that importing needs no network access
+        viewport = self.app.config['VIEWPORT']
+        GeocodeResult.store('15 & chestnut', viewport, 39.951304, -75.165601)
+        GeocodeResult.store('Poplar & n American', viewport, 39.964792,
+                            -75.141594)
+        GeocodeResult.store('Broad & arch', viewport, 39.954659, -75.163059)
+        GeocodeResult.store('Nowhere', viewport, None, None)
+        Agency.insert_agencies()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def write_csv(self, bad_rows=()):
+        """Copies the sample csv with the given extra rows, each a dict of
+        column index to value overriding a copy of the last sample row."""
+        with open('tests/poll244_sample.csv', 'rb') as f:
+            rows = list(csv.reader(f))
+        last_row = rows[-1]
+        for bad_row in bad_rows:
+            row = list(last_row)
+            for index, value in bad_row.items():
+                row[index] = value
+            rows.append(row)
+
+        filename = os.path.join(self.directory, 'import.csv')
+        with open(filename, 'wb') as f:
+            csv.writer(f).writerows(rows)
+        return filename
+
+    def check_import(self):
+        self.assertEqual(IncidentReport.query.count(), 3)
+        self.assertEqual(Location.query.count(), 3)
+
+        i1 = IncidentReport.query.filter_by(license_plate='AG26081').first()
+        self.assertEqual(i1.vehicle_id, '250')
+        self.assertEqual(i1.agency.name, 'ABBONIZIO TRANSFER')
+        self.assertTrue(i1.show_agency_publicly)
+        self.assertEqual(str(i1.duration), '0:03:00')
+        self.assertEqual(i1.location.original_user_text, '15 & chestnut ')
+        self.assertAlmostEqual(float(i1.location.latitude), 39.951304)
+
+        # Existing agencies are reused, and keep their visibility
+        i3 = IncidentReport.query.filter_by(license_plate='MG0512E').first()
+        self.assertEqual(i3.agency, Agency.get_agency_by_name('STREETS'))
+        self.assertFalse(i3.show_agency_publicly)
+        self.assertEqual(Agency.query.count(), 8)
+
+    def test_bulk_import(self):
+        parse_to_db(db, 'tests/poll244_sample.csv')
+        self.check_import()
+
+    def test_bulk_import_small_batches(self):
+        parse_to_db(db, 'tests/poll244_sample.csv', batch_size=1)
+        self.check_import()
+
+    def test_rejected_rows_file(self):
+        filename = self.write_csv([{4: 'Nowhere'}, {13: 'not a url'}])
+        parse_to_db(db, filename)
+        self.assertEqual(IncidentReport.query.count(), 3)
+
+        with open(filename + '.rejected.csv', 'rb') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0][:3], ['Row', 'Reason', 'Timestamp:first'])
+        self.assertEqual([row[0] for row in rows[1:]], ['5', '6'])
+        self.assertEqual(rows[1][1], 'Failed to geocode "Nowhere"')
+        self.assertTrue(rows[2][1].startswith('Picture URL must be'))
+        self.assertEqual(rows[2][2:4], ['10/2/2015 9:29', '10/2/2015 9:35'])
+
+    def test_checkpoint(self):
+        filename = self.write_csv([{4: 'Nowhere'}])
+        parse_to_db(db, filename, batch_size=2)
+        checkpoint = ImportCheckpoint.query.one()
+        self.assertEqual(checkpoint.file_hash, hash_file(filename))
+        self.assertEqual(checkpoint.last_row, 5)
+
+    def test_resume(self):
+        filename = self.write_csv([{4: 'Nowhere'}])
+
+        # As if an import was interrupted after the first two rows
+        db.session.add(ImportCheckpoint(filename=filename,
+                                        file_hash=hash_file(filename),
+                                        last_row=3))
+        db.session.commit()
+        with open(filename + '.rejected.csv', 'wb') as f:
+            csv.writer(f).writerow(['Row', 'Reason'])
+
+        parse_to_db(db, filename, resume=True)
+        self.assertEqual([r.license_plate for r in IncidentReport.query],
+                         ['MG0512E'])
+        with open(filename + '.rejected.csv', 'rb') as f:
+            self.assertEqual([row[0] for row in csv.reader(f)],
+                             ['Row', '5'])
+
+        # Resuming a finished import imports nothing more
+        parse_to_db(db, filename, resume=True)
+        self.assertEqual(IncidentReport.query.count(), 1)
+
+        # Without resume the whole file is imported again
+        parse_to_db(db, filename)
+        self.assertEqual(IncidentReport.query.count(), 4)
+        with open(filename + '.rejected.csv', 'rb') as f:
+            self.assertEqual([row[0] for row in csv.reader(f)],
+                             ['Row', '5'])
+
+    def test_parallel_import(self):
+        filename = self.write_csv([{4: 'Nowhere'}, {13: 'not a url'}] +
+                                  [{}] * 20)
+        parse_to_db(db, filename, batch_size=4, workers=3)
+        self.assertEqual(IncidentReport.query.count(), 23)
+        self.assertEqual(ImportCheckpoint.query.one().last_row, 26)
+        with open(filename + '.rejected.csv', 'rb') as f:
+            self.assertEqual([row[0] for row in csv.reader(f)],
+                             ['Row', '5', '6'])
+
+    def test_shard_file(self):
+        # A quoted newline must not split a row across shards
+        filename = self.write_csv([{11: 'Idling\nfor ages'}] * 10)
+        shards = list(shard_file(filename, shard_size=300))
+        self.assertTrue(len(shards) > 1)
+        self.assertEqual(shards[0][2], 2)
+        self.assertEqual(shards[-1][3], 14)
+
+        with open(filename, 'rb') as f:
+            data = f.read()
+        for i, (start, end, first_number, last_number) in enumerate(shards):
+            rows = list(csv.reader(data[start:end].splitlines(True)))
+            self.assertEqual(len(rows), last_number - first_number + 1)
+            if i > 0:
+                self.assertEqual(start, shards[i - 1][1])
+                self.assertEqual(first_number, shards[i - 1][3] + 1)
+        self.assertEqual(shards[-1][1], len(data))
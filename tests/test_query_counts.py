@@ -0,0 +1,109 @@
+import unittest
+import datetime
+import twilio.twiml
+from app import create_app, db
+from app.main.messaging import STEP_AGENCY, handle_agency_step
+from app.models import Agency, IncidentReport, Role, User
+from query_counter import QueryCounter
+
+
+class QueryCountTestCase(unittest.TestCase):
+    """Guards against pages whose number of queries grows with the number of
+    rows shown, and against pages loading reports they don't show."""
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+        Role.insert_roles()
+        Agency.insert_agencies()
+        admin = User(first_name='Admin', last_name='Account', confirmed=True,
+                     email=self.app.config['ADMIN_EMAIL'],
+                     password='password')
+        db.session.add(admin)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self):
+        self.client.post('/account/login', data={
+            'email': self.app.config['ADMIN_EMAIL'],
+            'password': 'password'
+        })
+
+    def add_reports(self, count):
+        for agency in Agency.query.all():
+            for i in range(count):
+                db.session.add(IncidentReport(
+                    vehicle_id='123456',
+                    date=datetime.datetime(2016, 1, 1),
+                    duration=datetime.timedelta(minutes=5),
+                    agency=agency,
+                    description='Truck idling on the road!',
+                    send_email_upon_creation=False
+                ))
+        db.session.commit()
+
+    def add_users(self, count):
+        agencies = Agency.query.all()
+        first = User.query.count()
+        for i in range(first, first + count):
+            db.session.add(User(first_name='Agency', last_name='Worker',
+                                email='worker{}@example.com'.format(i),
+                                password='password', agencies=agencies))
+        db.session.commit()
+
+    def count_get(self, url):
+        """Returns a QueryCounter for a GET of url."""
+        db.session.expunge_all()
+        with QueryCounter() as counter:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return counter
+
+    def assertConstantQueries(self, url, add_rows):
+        """Checks that a page takes the same number of queries before and
+        after add_rows() adds more rows to it."""
+        add_rows()
+        before = self.count_get(url)
+        add_rows()
+        after = self.count_get(url)
+        self.assertEqual(before.statements, after.statements)
+        return after
+
+    def test_map_page(self):
+        # The agency field of the report form doesn't load reports
+        counter = self.assertConstantQueries('/', lambda: self.add_reports(3))
+        self.assertEqual(counter.loaded.get('IncidentReport', 0), 0)
+
+    def test_report_listing(self):
+        self.login()
+        counter = self.assertConstantQueries('/reports/all',
+                                             lambda: self.add_reports(2))
+        self.assertEqual(counter.loaded['IncidentReport'], 24)
+
+    def test_all_agencies(self):
+        self.login()
+        counter = self.assertConstantQueries('/admin/agencies',
+                                             lambda: self.add_reports(3))
+        self.assertEqual(counter.loaded.get('IncidentReport', 0), 0)
+        self.assertEqual(counter.loaded['Agency'], 6)
+
+    def test_registered_users(self):
+        self.login()
+        self.assertConstantQueries('/admin/users', lambda: self.add_users(3))
+
+    def test_sms_agency_step(self):
+        self.add_reports(3)
+        db.session.expunge_all()
+        with self.app.test_request_context():
+            with QueryCounter() as counter:
+                handle_agency_step('A', STEP_AGENCY, twilio.twiml.Response())
+        self.assertEqual(counter.statements, 1)
+        self.assertEqual(counter.loaded, {'Agency': 6})
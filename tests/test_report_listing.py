@@ -0,0 +1,132 @@
+import re
+import unittest
+import datetime
+from app import create_app, db
+from app.models import Agency, IncidentReport, Permission, Role, User
+from app.reports import views
+
+
+class ReportListingViewTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        Role.insert_roles()
+
+        self.septa = Agency(name='SEPTA')
+        self.peco = Agency(name='PECO')
+        db.session.add_all([self.septa, self.peco])
+        db.session.commit()
+
+        self.page_size = views.REPORTS_PER_PAGE
+        views.REPORTS_PER_PAGE = 2
+
+    def tearDown(self):
+        views.REPORTS_PER_PAGE = self.page_size
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, email, agencies=(), admin=False):
+        role = Role.query.filter_by(
+            permissions=Permission.ADMINISTER if admin
+            else Permission.AGENCY_WORKER).first()
+        user = User(first_name='Test', last_name='User', confirmed=True,
+                    email=email, password='password', role=role,
+                    agencies=list(agencies))
+        db.session.add(user)
+        db.session.commit()
+        self.client.post('/account/login', data={
+            'email': email,
+            'password': 'password'
+        })
+        return user
+
+    def add_report(self, date, agency, vehicle_id='123456'):
+        report = IncidentReport(
+            vehicle_id=vehicle_id,
+            date=date,
+            duration=datetime.timedelta(minutes=5),
+            agency=agency,
+            description='Truck idling on the road!',
+            send_email_upon_creation=False
+        )
+        db.session.add(report)
+        db.session.commit()
+        return report.id
+
+    def get_page(self, url):
+        """Returns the report ids on a listing page, and the url of the next
+        page."""
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        html = response.data.decode('utf-8')
+        ids = [int(i) for i in re.findall(r"/reports/(\d+)/info'", html)]
+        next_page = re.search(r'href="([^"]*)">\s*Next page', html)
+        if next_page is not None:
+            next_page = next_page.group(1).replace('&amp;', '&')
+        return ids, next_page
+
+    def get_all_pages(self, url):
+        ids = []
+        while url is not None:
+            page, url = self.get_page(url)
+            ids.extend(page)
+        return ids
+
+    def test_pages_newest_first(self):
+        self.login('admin@example.com', admin=True)
+        # Reports on the same date are ordered by id across page boundaries
+        same_day = datetime.datetime(2016, 1, 2)
+        r1 = self.add_report(same_day, self.septa)
+        r2 = self.add_report(datetime.datetime(2016, 1, 3), self.peco)
+        r3 = self.add_report(same_day, self.septa)
+        r4 = self.add_report(same_day, self.peco)
+        r5 = self.add_report(datetime.datetime(2016, 1, 1), self.septa)
+
+        ids, next_page = self.get_page('/reports/all')
+        self.assertEqual(ids, [r2, r4])
+        self.assertTrue('after_id={}'.format(r4) in next_page)
+        self.assertEqual(self.get_all_pages('/reports/all'),
+                         [r2, r4, r3, r1, r5])
+        self.assertEqual(self.get_all_pages('/reports/all?order=oldest'),
+                         [r5, r1, r3, r4, r2])
+
+    def test_filters(self):
+        self.login('admin@example.com', admin=True)
+        r1 = self.add_report(datetime.datetime(2016, 1, 1), self.septa)
+        r2 = self.add_report(datetime.datetime(2016, 1, 2), self.peco, 'A1')
+        r3 = self.add_report(datetime.datetime(2016, 1, 3), self.septa, 'A1')
+        r4 = self.add_report(datetime.datetime(2016, 1, 4), self.septa)
+
+        self.assertEqual(self.get_all_pages(
+            '/reports/all?agency={}'.format(self.septa.id)), [r4, r3, r1])
+        self.assertEqual(self.get_all_pages(
+            '/reports/all?start=2016-01-02&end=2016-01-03'), [r3, r2])
+        self.assertEqual(self.get_all_pages(
+            '/reports/all?vehicle_id=A1'), [r3, r2])
+
+        # Filters are kept when paging
+        self.assertEqual(self.get_all_pages(
+            '/reports/all?agency={}&order=oldest'.format(self.septa.id)),
+            [r1, r3, r4])
+
+    def test_agency_worker_sees_own_agencies(self):
+        self.login('worker@example.com', agencies=[self.septa])
+        r1 = self.add_report(datetime.datetime(2016, 1, 1), self.septa)
+        self.add_report(datetime.datetime(2016, 1, 2), self.peco)
+
+        self.assertEqual(self.get_all_pages('/reports/all'), [r1])
+        self.assertEqual(self.get_all_pages(
+            '/reports/all?agency={}'.format(self.peco.id)), [])
+
+    def test_my_reports(self):
+        user = self.login('worker@example.com')
+        r1 = self.add_report(datetime.datetime(2016, 1, 1), self.septa)
+        self.add_report(datetime.datetime(2016, 1, 2), self.septa)
+        IncidentReport.query.get(r1).user = user
+        db.session.commit()
+
+        self.assertEqual(self.get_all_pages('/reports/my-reports'), [r1])
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import create_app
+from app.storage import LocalStorage, delete_image, upload_image
+
+JPEG_DATA = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00' + b'\x00' * 32
+
+
+class LocalStorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.path = tempfile.mkdtemp()
+        self.app.config['IMAGE_STORAGE_PATH'] = self.path
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.app_context.pop()
+        shutil.rmtree(self.path)
+
+    def test_stored_by_contents(self):
+        storage = LocalStorage(self.path, 'http://example.com/images/')
+        url, handle = storage.upload(JPEG_DATA)
+        self.assertTrue(handle.endswith('.jpg'))
+        self.assertEqual(url, 'http://example.com/images/' + handle)
+        with open(os.path.join(self.path, handle), 'rb') as image_file:
+            self.assertEqual(image_file.read(), JPEG_DATA)
+
+        # The same image is stored once
+        self.assertEqual(storage.upload(JPEG_DATA), (url, handle))
+        self.assertNotEqual(storage.upload(JPEG_DATA + b'\x00')[1], handle)
+
+        storage.delete(handle)
+        self.assertFalse(os.path.exists(os.path.join(self.path, handle)))
+        storage.delete(handle)  # already deleted
+
+    def test_upload_and_serve(self):
+        url, deletehash = upload_image(image_data=JPEG_DATA)
+        self.assertTrue(url.startswith('/images/'))
+        self.assertTrue(deletehash.startswith('local:'))
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, JPEG_DATA)
+        self.assertIn('max-age=31536000', response.headers['Cache-Control'])
+
+        delete_image(deletehash)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_upload_file(self):
+        image_path = os.path.join(self.path, 'upload.jpg')
+        with open(image_path, 'wb') as image_file:
+            image_file.write(JPEG_DATA)
+        self.assertEqual(upload_image(image_file_path=image_path),
+                         upload_image(image_data=JPEG_DATA))
+
+    def test_paths_outside_storage_not_served(self):
+        self.assertEqual(self.client.get('/images/../config.py').status_code,
+                         404)